@@ -0,0 +1,155 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Backend helper
+Contains the functions that are shared by the scheduler backends. Every
+backend module (qsub_module, slurm_module, single_cpu_module and
+dry_run_module) provides the same functions:
+
+    init(param)
+    submit_jobs(param, indices, py_file, job_id, cores, mem_free, hold_jobs)
+    wait_for_jobs(param, scheduler_ids)
+    cancel_jobs(param, scheduler_ids)
+    get_status(param, scheduler_id)
+
+and SIDE_EFFECTS, which is False if the backend does not run the jobs but
+only records them (dry_run_module). The pipeline then neither removes nor
+writes results and treats every submitted sample as successful.
+"""
+from hydra_pkg.logs import writeLog
+from hydra_pkg import sentinel as SENTINEL
+
+
+def get_max_cores(cores):
+    """Upper bound of the number of cores a step asked for
+
+    :Parameter cores: number of cores as specified for qsub, e.g. '1-8' or '4'
+    """
+    return int(str(cores).split('-')[-1])
+
+def get_num_tasks(param):
+    """Number of tasks of an array job, one for every batch of batch_size
+    samples
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    return (param['num_samples']+param['batch_size']-1)/param['batch_size']
+
+def get_batches(param, indices):
+    """Groups the samples into the batches that are run by the same job. The
+    batches are the same in every step, so a batch can wait for the same
+    batch in another step.
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter indices: indices of the files that should be run
+    :return parameter: list of lists with the indices of every batch
+    """
+    batches = dict()
+    for idx in indices:
+        batches.setdefault(idx/param['batch_size'], []).append(idx)
+    return [batches[batch] for batch in sorted(batches.keys())]
+
+def get_task_commands(param, indices, py_file, index_variable, cores_variable):
+    """Commands of a job script that runs one sample of an array job. The
+    array always has one task per sample, so that the task of a sample can
+    wait for the task of the same sample in another array job. Tasks of
+    samples that are not in indices finish right away. With a batch_size
+    above 1 every task runs a batch of samples with run_batch instead.
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter indices: indices of the files that should be run
+    :Parameter py_file: wrapper that needs to be called to run the current step
+    :Parameter index_variable: shell expression for the index of the task
+    :Parameter cores_variable: shell variable with the number of cores
+    """
+    cmd = []
+    if param['job_prologue'] != '':
+        cmd.append(param['job_prologue'])
+    cmd.append('#samples that are run, the tasks of all other samples finish right away')
+    cmd.append('RUN=" ' + ' '.join([str(idx) for idx in indices]) + ' "')
+    if param['batch_size'] == 1:
+        cmd.append('INDEX=' + index_variable)
+        cmd.append('if [[ "$RUN" != *" $INDEX "* ]]; then exit 0; fi')
+        cmd.append(py_file +
+                   ' -i $INDEX' +
+                   ' -n ' + cores_variable +
+                   ' -d ' +  param['working_dir'] +
+                   ' -p ' + param['parameter_json'])
+        return cmd
+
+    #the samples of the batch of this task that are run
+    batch_size = str(param['batch_size'])
+    cmd.append('TASK=' + index_variable)
+    cmd.append('INDICES=""')
+    cmd.append('for INDEX in $(seq $((TASK*' + batch_size + ')) $((TASK*' +
+               batch_size + '+' + batch_size + '-1))); do')
+    cmd.append('    if [[ "$RUN" == *" $INDEX "* ]]; then INDICES="$INDICES,$INDEX"; fi')
+    cmd.append('done')
+    cmd.append('if [ -z "$INDICES" ]; then exit 0; fi')
+    cmd.append('run_batch -s ' + py_file +
+               ' -i ${INDICES#,}' +
+               ' -n ' + cores_variable +
+               ' -d ' +  param['working_dir'] +
+               ' -p ' + param['parameter_json'])
+    return cmd
+
+def get_array_ids(scheduler_ids):
+    """Unique ids of the array jobs of a step
+
+    :Parameter scheduler_ids: job id for every sample, empty if not submitted
+    """
+    return list(set([jid for jid in scheduler_ids if jid != '']))
+
+def wait_for_sentinels(param, scheduler_ids, is_queued):
+    """Waits until the jobs of all submitted samples wrote their sentinel file.
+    The sentinel directory is watched with inotify if possible, otherwise it
+    is checked in increasing intervals up to qsub_wait_time. Jobs that are not
+    known to the scheduler anymore but never wrote a sentinel file, e.g.
+    because they were killed, are not waited for any longer.
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter scheduler_ids: job ids returned by the scheduler for the current batch
+    :Parameter is_queued: function that checks if a job id is still known
+                          to the scheduler
+    """
+    indices = [idx for idx in range(len(scheduler_ids)) if scheduler_ids[idx] != '']
+    writeLog('Waiting for single '+
+             param['current_flag']+
+             ' jobs to finish.... \n',
+             param)
+    watch = SENTINEL.watch_directory(SENTINEL.get_sentinel_dir(param))
+    wait_time = 1
+    job_gone = False
+    while True:
+        indices = [idx for idx in indices if SENTINEL.get_status(param, idx) == '']
+        if len(indices) == 0:
+            break
+        if SENTINEL.wait_for_event(watch, wait_time):
+            wait_time = 1
+            continue
+        #ask the scheduler only if nothing happened in a while, sentinel
+        #files of jobs that just ended get one more interval to show up
+        qjobs = get_array_ids([scheduler_ids[idx] for idx in indices])
+        if any([is_queued(jid) for jid in qjobs]):
+            job_gone = False
+        elif job_gone:
+            writeLog('No sentinel file for '+
+                     ', '.join([param['stub'][idx] for idx in indices])+
+                     ' although the jobs are not queued anymore\n',
+                     param)
+            break
+        else:
+            job_gone = True
+        wait_time = min(wait_time*2, param['qsub_wait_time'])
+    SENTINEL.stop_watching(watch)
@@ -25,6 +25,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pylab
 
+#parameters the results of this module depend on, see cache.py
+CACHE_PARAMETERS = ['bamqc_script']
+
 def copy_files(param):
     """Copies all relevant bamqc files from the results directory into the report directory
 
@@ -700,9 +703,12 @@ def main():
         os.makedirs(outdir)
 
 
+    #sorted bam files that the aligner indexed are split into regions that
+    #are processed in parallel
     call = [param['bamqc_script'],
             '-i', param['working_file'],
-            '-o', outdir]
+            '-o', outdir,
+            '-n', param['num_processors']]
 
     param['file_handle'].write('CALL: '+' '.join(call)+'\n')
     output, error = subprocess.Popen(call,
@@ -0,0 +1,86 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Batch module
+Runs the wrapper of a step on several samples one after the other in the
+same process (batch_size > 1). The samples of a batch share one scheduler
+job, one python start and the state the modules keep between calls, e.g.
+the annotation index of the built-in counter or the shared STAR genome.
+Every sample still goes through initialize_module and wrapup_module, so
+its log file, ENDING flag and sentinel file are the same as if it was run
+in a job of its own, and a failing sample does not stop the others. After
+the last sample the batch calls finish_batch of the module if it has one,
+e.g. to remove the shared STAR genome, however the samples ended.
+
+    run_batch -s run_star -i 0,1,2 -n 8 -d working_dir -p parameters.json
+"""
+import getopt
+import importlib
+import json
+import os
+import sys
+import traceback
+
+def get_module(py_file):
+    """Module of a wrapper, e.g. hydra_pkg.star for run_star
+
+    :Parameter py_file: wrapper that is called to run a step
+    """
+    return importlib.import_module('hydra_pkg.'+os.path.basename(py_file)[4:])
+
+def finish_batch(module, options):
+    """Runs the finish_batch function of a module after all samples of the
+    batch, the messages go to the output of the job
+
+    :Parameter module: module of the wrapper
+    :Parameter options: options of the batch
+    """
+    if not hasattr(module, 'finish_batch'):
+        return
+    parameter_file = options.get('-p', '')
+    if parameter_file == '':
+        parameter_file = options.get('-d', './')+'results/parameters.json'
+    with open(parameter_file) as filehandle:
+        param = json.load(filehandle)
+    param['num_processors'] = options['-n']
+    param['in_batch'] = False
+    param['file_handle'] = sys.stdout
+    module.finish_batch(param)
+
+def main():
+    """Main function that runs the wrapper on every sample of the batch
+    """
+    optlist, _ = getopt.getopt(sys.argv[1:], 's:i:n:d:p:')
+    options = dict(optlist)
+    py_file = options['-s']
+    module = get_module(py_file)
+    indices = options['-i'].split(',')
+    for index in indices:
+        sys.argv = [py_file,
+                    '-i', index,
+                    '-n', options['-n'],
+                    '-d', options.get('-d', './'),
+                    '-p', options.get('-p', ''),
+                    #tells the wrapper that it runs in a batch, which is
+                    #finished after the last sample
+                    '-b']
+        try:
+            module.main()
+        except SystemExit:
+            #the wrappers exit after a sample failed or was skipped
+            pass
+        except Exception:
+            #the sample is reported as failed when the batch ends
+            traceback.print_exc()
+    finish_batch(module, options)
@@ -18,6 +18,19 @@ a wrapper that that runs bowtie2 using those parameters on a single sample.
 """
 
 from hydra_pkg import module_helper as MODULE_HELPER
+from hydra_pkg import fastq_io as FASTQ_IO
+from hydra_pkg import resources as RESOURCES
+
+#parameters the results of this module depend on, see cache.py
+CACHE_PARAMETERS = ['bowtie2_exec', 'bowtie2_index', 'bowtie2_type',
+                    'bowtie2_N', 'bowtie2_D', 'bowtie2_R', 'bowtie2_L',
+                    'bowtie2_i', 'bowtie2_rdg', 'bowtie2_rfg', 'sam_exec', 'paired']
+
+#formats of the fastq files this module reads, see fastq_io.negotiate_format
+INPUT_FORMATS = ['gzip', 'zstd', 'plain']
+
+#bowtie2 reads the fastq files once, so they can be named pipes (see trim_align)
+STREAMING = True
 
 def init(param):
     """Initialization function that checks the all relevant bowtie2 parameters
@@ -34,16 +47,19 @@ def init(param):
     MODULE_HELPER.check_parameter(param, key='bowtie2_i', dtype=str)
     MODULE_HELPER.check_parameter(param, key='bowtie2_rdg', dtype=str)
     MODULE_HELPER.check_parameter(param, key='bowtie2_rfg', dtype=str)
+    MODULE_HELPER.check_parameter(param, key='sam_exec', dtype=str)
 
 
-def main():
-    """Main function that is run on each samples, which in turn calls runs
-    bowtie2 on a sample.
+def align(param):
+    """Runs bowtie2 on the working files of a sample, the job stops if
+    bowtie2 fails
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :return parameter: bam file
     """
     import subprocess
     import sys
     import os
-    param = MODULE_HELPER.initialize_module()
     #run create output directory
     outdir = param['module_dir']+param['outstub']+'/'
     if not os.path.exists(outdir):
@@ -84,65 +100,94 @@ def main():
     call.append('-p')
     call.append(param['num_processors'])
 
+    #compressed files are decompressed with several threads into named pipes,
+    #bowtie2 would decompress gzipped files with a single thread and cannot
+    #read zstd files
+    input_files = [param['working_file']]
+    if param['paired']:
+        input_files.append(param['working_file2'])
+    fifos = []
+    feeders = []
+    if FASTQ_IO.get_codec(param['working_file']) != 'plain':
+        fifos, feeders = FASTQ_IO.open_fifos(input_files,
+                                             outdir,
+                                             FASTQ_IO.get_threads(param['num_processors'],
+                                                                  len(input_files)))
+        input_files = fifos
+
     #if paired add second working file
     if param['paired']:
     	call.append('-1')
-    	call.append(param['working_file'])
+    	call.append(input_files[0])
     	
     	call.append('-2')
-        call.append(param['working_file2'])
+        call.append(input_files[1])
     else:
     	call.append('-U')
-    	call.append(param['working_file'])
-    
-    call.append('-S')
-    call.append(outdir + 'accepted_hits.sam')
-
-    param['file_handle'].write('CALL: '+' '.join(call)+'\n')
-    output, error = subprocess.Popen(call, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    param['file_handle'].write(error)
-    param['file_handle'].write(output)
-    
-    # Convert .sam to .bam and sort
-    outfile = open(outdir + 'accepted_hits.bam','w')
-    
-    call2 = ['samtools']
-    call2.append('view')
-    call2.append('-bS')
-    call2.append(outdir + 'accepted_hits.sam')
-    
-    param['file_handle'].write('CALL: '+' '.join(call2)+'\n')
-    output, error = subprocess.Popen(call2, stdout = outfile, stderr=subprocess.PIPE).communicate()
-    outfile.close()
-    
-    call3 = ['samtools']
-    call3.append('sort')
-    call3.append(outdir + 'accepted_hits.bam')
-    call3.append(outdir + 'accepted_hits')
-    
-    param['file_handle'].write('CALL: '+' '.join(call3)+'\n')
-    output, error = subprocess.Popen(call3, stdout = subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    param['file_handle'].write(error)
-    param['file_handle'].write(output)
-    
-    # Remove SAM file
-    call4 = ['rm']
-    call4.append('-f')
-    call4.append(outdir + 'accepted_hits.sam')
-    
-    param['file_handle'].write('CALL: '+' '.join(call4)+'\n')
-    output, error = subprocess.Popen(call4, stdout = subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    param['file_handle'].write(error)
-    param['file_handle'].write(output)
+    	call.append(input_files[0])
+    
+    #bowtie2 writes the alignments to stdout, which are converted to an
+    #uncompressed bam stream and sorted into the bam file right away, so
+    #there is no intermediate sam file. samtools 0.1.19, the version of the
+    #conda package, only sorts bam files and takes the prefix of the output
+    call2 = [param['sam_exec'], 'view', '-bSu', '-']
+    sort_threads = param['num_processors']
+    call3 = [param['sam_exec'], 'sort']
+    call3 = call3 + ['-@', sort_threads]
+    call3 = call3 + ['-m', RESOURCES.get_sort_memory(param, sort_threads)]
+    call3.append('-')
+    call3.append(outdir+'accepted_hits')
+
+    param['file_handle'].write('Pipe CALL 1: '+' '.join(call)+'\n')
+    param['file_handle'].write('Pipe CALL 2: '+' '.join(call2)+'\n')
+    param['file_handle'].write('Pipe CALL 3: '+' '.join(call3)+'\n')
+    #the messages of all tools go straight into the log file
+    param['file_handle'].flush()
+    process1 = subprocess.Popen(call,
+                                stdout=subprocess.PIPE,
+                                stderr=param['file_handle'])
+    process2 = subprocess.Popen(call2,
+                                stdin=process1.stdout,
+                                stdout=subprocess.PIPE,
+                                stderr=param['file_handle'])
+    process1.stdout.close()
+    process3 = subprocess.Popen(call3,
+                                stdin=process2.stdout,
+                                stderr=param['file_handle'])
+    process2.stdout.close()
+    process3.communicate()
+    process2.wait()
+    process1.wait()
+    decompressed = FASTQ_IO.close_fifos(fifos, feeders, abort=process1.returncode != 0)
+
+    #a failed alignment leaves a truncated bam file behind
+    if (process1.returncode != 0 or process2.returncode != 0 or
+            process3.returncode != 0 or not decompressed):
+        param['file_handle'].write('bowtie2 exited with '+str(process1.returncode)+
+                                   ', samtools view with '+str(process2.returncode)+
+                                   ', samtools sort with '+str(process3.returncode)+'\n')
+        if not decompressed:
+            param['file_handle'].write('The fastq files could not be decompressed\n')
+        if os.path.exists(outdir+'accepted_hits.bam'):
+            os.remove(outdir+'accepted_hits.bam')
 
     #check if the run was successful
     if not os.path.exists(outdir+'accepted_hits.bam'):
         param['file_handle'].write('bowtie2 did not run successfully...')
         sys.exit(0)
+    MODULE_HELPER.index_bam(param, outdir+'accepted_hits.bam')
+    return outdir+'accepted_hits.bam'
+
+def main():
+    """Main function that is run on each samples, which in turn calls runs
+    bowtie2 on a sample.
+    """
+    param = MODULE_HELPER.initialize_module()
+    bam_file = align(param)
 
     #wrap up and return the current workingfile
     MODULE_HELPER.wrapup_module(param, 
-                                [outdir+'accepted_hits.bam'],
+                                [bam_file],
                                 remove_intermediate=True)
     
 
@@ -0,0 +1,187 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Cache module
+Computes a cache key for every sample of a step, which is stored with the
+state of the sample. A sample is only run again if its key changed. The key
+is built from
+
+- the input files of the sample: the cache key of the step that created them
+  or, for the raw files, their path, size and modification time
+- the parameters the step uses (CACHE_PARAMETERS of the module), where
+  executables, indices and annotation files also contribute their size and
+  modification time, so a new tool version changes the key
+- the source of the wrapper module and of the hydra_pkg modules and R
+  scripts that compute its results, directly or through other modules;
+  scripts that are run through a parameter (e.g. bamqc_script) contribute
+  their source and the modules they import as well. The modules that only
+  run the pipeline (INFRASTRUCTURE_MODULES, e.g. the scheduler, the
+  backends and the state) are left out, so a change of them does not rerun
+  every step
+
+Since the input of a step is described by the key of the step before, a
+change in e.g. the cutadapt adapters changes the keys of the trimming and of
+every step after it, while a change of HTSeq_m only changes the htseq keys.
+"""
+import hashlib
+import os
+import re
+from distutils.spawn import find_executable
+from hydra_pkg import RNASEQ_PIPELINE_DIR
+
+#imports of hydra_pkg modules, e.g. 'from hydra_pkg import fastq_io as
+#FASTQ_IO', 'from hydra_pkg.logs import writeLog' or 'import hydra_pkg.star'
+IMPORT_PATTERN = re.compile(r'^[ \t]*(?:from[ \t]+hydra_pkg(?:\.(\w+))?[ \t]+import[ \t]+'+
+                            r'([\w \t,]+)|import[ \t]+hydra_pkg\.(\w+))',
+                            re.MULTILINE)
+
+#modules that submit, track and report the steps but do not change their
+#results, which are not followed when the sources of a step are collected
+INFRASTRUCTURE_MODULES = ['backend_helper', 'batch', 'cache', 'dry_run_module',
+                          'helper', 'logs', 'module_helper', 'pipeline',
+                          'qsub_module', 'r_scripts', 'resources', 'scheduler',
+                          'sentinel', 'single_cpu_module', 'slurm_module',
+                          'state']
+
+#R scripts that are run from the r_scripts directory of the package
+R_SCRIPT_PATTERN = re.compile(r'get_script_path\([\'"]([^\'"]+)[\'"]\)')
+
+
+def get_file_fingerprint(filename):
+    """Path, size and modification time of a file, which is much faster than
+    hashing the content of large files
+
+    :Parameter filename: file or directory
+    """
+    if filename == '' or not os.path.exists(filename):
+        return filename
+    stat = os.stat(filename)
+    return '%s:%d:%d' %(os.path.abspath(filename), stat.st_size, int(stat.st_mtime))
+
+def get_parameter_fingerprint(param, key):
+    """Value of a parameter, for executables and existing files including the
+    fingerprint of the file
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter key: name of the parameter
+    """
+    value = str(param.get(key, ''))
+    fingerprint = key+'='+value
+    if key.endswith('_exec') or key.endswith('_script'):
+        executable = find_executable(value.split(' ')[0])
+        if executable is not None:
+            fingerprint += '|'+get_file_fingerprint(executable)
+            #scripts of the package also depend on the modules they import
+            if executable.endswith('.py'):
+                fingerprint += '|'+get_source_fingerprint([executable])
+    elif os.path.isfile(value):
+        fingerprint += '|'+get_file_fingerprint(value)
+    return fingerprint
+
+def get_imported_files(source):
+    """Files of the hydra_pkg modules and R scripts that a source uses,
+    without the INFRASTRUCTURE_MODULES
+
+    :Parameter source: python source code
+    """
+    names = []
+    for match in IMPORT_PATTERN.finditer(source):
+        if match.group(3) is not None:
+            names.append(match.group(3))
+        elif match.group(1) is not None:
+            names.append(match.group(1))
+        else:
+            #the imported names are modules of the package, or names of
+            #its __init__ like RNASEQ_PIPELINE_DIR, which are skipped
+            names += [name.split()[0] for name in match.group(2).split(',')
+                      if name.strip() != '']
+    filenames = [RNASEQ_PIPELINE_DIR+'/'+name+'.py' for name in names
+                 if name not in INFRASTRUCTURE_MODULES]
+    filenames += [RNASEQ_PIPELINE_DIR+'/r_scripts/'+name
+                  for name in R_SCRIPT_PATTERN.findall(source)]
+    return [filename for filename in filenames if os.path.isfile(filename)]
+
+def get_source_fingerprint(filenames):
+    """Hash of the source of files and of the hydra_pkg modules and R
+    scripts they use, directly or through other modules, see
+    get_imported_files
+
+    :Parameter filenames: source files
+    """
+    source_hash = hashlib.sha1()
+    done = set()
+    pending = [os.path.abspath(filename) for filename in filenames]
+    while len(pending) > 0:
+        filename = pending.pop(0)
+        if filename in done:
+            continue
+        done.add(filename)
+        handle = open(filename)
+        source = handle.read()
+        handle.close()
+        source_hash.update(filename.split('/')[-1]+'\n'+source+'\n')
+        if filename.endswith('.py'):
+            pending += [os.path.abspath(imported)
+                        for imported in get_imported_files(source)]
+    return source_hash.hexdigest()
+
+def get_module_fingerprint(param):
+    """Hash of the source of the wrapper module of the current step and of
+    the modules that compute its results
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    filename = RNASEQ_PIPELINE_DIR+'/'+param['current_dir']+'.py'
+    if not os.path.exists(filename):
+        return ''
+    return get_source_fingerprint([filename])
+
+def get_cache_parameters(param, cache_parameters):
+    """Parameters the current step depends on. If the step does not name
+    them, all parameters that start with the name of the module are used.
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter cache_parameters: list of parameter names or None
+    """
+    if cache_parameters is not None:
+        return cache_parameters
+    return sorted([key for key in param.keys()
+                   if key.lower().startswith(param['current_dir'].lower()+'_')])
+
+def get_cache_keys(param, cache_parameters=None):
+    """Cache keys of all samples of the current step
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter cache_parameters: names of the parameters the step depends on
+    :return parameter: list with the cache key of every sample
+    """
+    step_hash = hashlib.sha1()
+    step_hash.update(param['current_flag']+'\n')
+    step_hash.update(get_module_fingerprint(param)+'\n')
+    for key in get_cache_parameters(param, cache_parameters):
+        step_hash.update(get_parameter_fingerprint(param, key)+'\n')
+
+    upstream_keys = param['cache_keys'].get(param['input_flag'], [])
+    keys = []
+    for idx in range(param['num_samples']):
+        sample_hash = step_hash.copy()
+        if len(upstream_keys) > 0:
+            sample_hash.update(upstream_keys[idx]+'\n')
+        else:
+            sample_hash.update(get_file_fingerprint(param[param['input_files']][idx])+'\n')
+            if param['paired'] and param['input_files']+'2' in param:
+                sample_hash.update(
+                    get_file_fingerprint(param[param['input_files']+'2'][idx])+'\n')
+        keys.append(sample_hash.hexdigest())
+    return keys
@@ -0,0 +1,454 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Count matrix module
+Merges the output files of a counting step (one per sample) into a single
+matrix. All files are read at the same time, line by line, and the ids of
+every line have to be the same in all files, so only a single row of the
+matrix is in memory. If there are more files than can be opened at once,
+they are merged in blocks into temporary files first.
+
+The rows are produced by merge_rows and can be passed to any writer, e.g.
+write_matrix for the tab delimited deliverables.
+
+update_matrix keeps a manifest with the samples that are in a matrix and the
+fingerprints of their files (see cache.py). If only new samples were added,
+their columns are appended to the existing matrix instead of reading the
+files of all samples again, and if nothing changed the matrix is not written
+at all. A changed or removed file of a sample rebuilds the whole matrix.
+
+Next to the tab delimited file the matrix can be written as a compressed
+numpy archive (.npz) with typed values, e.g. int32 for raw counts and
+float32 for FPKM values. The matrix is stored in blocks of GENE_CHUNK genes
+and SAMPLE_CHUNK samples, together with the ids of the genes and the names
+of the samples, so read_sample and read_gene only decompress the blocks of
+a single sample or gene:
+
+>>> from hydra_pkg import count_matrix
+>>> ids, counts = count_matrix.read_sample('htseq_raw_counts.npz', 'sample1')
+>>> samples, counts = count_matrix.read_gene('htseq_raw_counts.npz', 'ENSG00000141510')
+"""
+import collections
+import csv
+import io
+import itertools
+import json
+import os
+import tempfile
+import zipfile
+import numpy as np
+from hydra_pkg import cache as CACHE
+
+#number of files that are opened at the same time
+MAX_OPEN_FILES = 256
+
+#size of the blocks of the binary matrix
+GENE_CHUNK = 4096
+SAMPLE_CHUNK = 64
+
+def read_rows(filename, skip_lines=0):
+    """Rows of a tab delimited file
+
+    :Parameter filename: file
+    :Parameter skip_lines: number of lines at the top that are not returned
+    """
+    handle = open(filename)
+    reader = csv.reader(handle, delimiter='\t')
+    for _ in range(skip_lines):
+        next(reader, None)
+    for row in reader:
+        yield row
+    handle.close()
+
+def iter_rows(filenames, id_columns, value_columns, skip_lines=0, previous=None):
+    """Rows of the matrix, which are built from the same line of every file
+
+    :Parameter filenames: files of all samples
+    :Parameter id_columns: columns with the ids of a line
+    :Parameter value_columns: columns that are taken from every file, None
+                              for all columns after the ids
+    :Parameter skip_lines: number of lines at the top of every file that are
+                           not part of the matrix
+    :Parameter previous: rows (ids and values) of an existing matrix, whose
+                         values are put in front of the values of the files
+    :return parameter: tuples of the ids and the values of all files
+    """
+    readers = [read_rows(filename, skip_lines) for filename in filenames]
+    line = skip_lines
+    while True:
+        rows = [next(reader, None) for reader in readers]
+        previous_row = None if previous is None else next(previous, None)
+        if all([row is None for row in rows]):
+            if previous_row is not None:
+                raise ValueError('the existing matrix has more lines than '+filenames[0])
+            return
+        line += 1
+        if previous is not None and previous_row is None:
+            raise ValueError('the existing matrix ends before line '+str(line)+
+                             ' of '+filenames[0])
+        ids = None
+        values = []
+        for idx in range(len(rows)):
+            if rows[idx] is None:
+                raise ValueError(filenames[idx]+' ends after '+str(line-1)+' lines')
+            row_ids = [rows[idx][col] for col in id_columns]
+            if ids is None:
+                ids = row_ids
+            elif row_ids != ids:
+                raise ValueError(filenames[idx]+' has '+' '.join(row_ids)+
+                                 ' in line '+str(line)+' instead of '+' '.join(ids))
+            if value_columns is None:
+                values += rows[idx][len(id_columns):]
+            else:
+                values += [rows[idx][col] for col in value_columns]
+        if previous_row is not None:
+            if previous_row[:len(id_columns)] != ids:
+                raise ValueError('the existing matrix has '+
+                                 ' '.join(previous_row[:len(id_columns)])+
+                                 ' in line '+str(line)+' instead of '+' '.join(ids))
+            values = previous_row[len(id_columns):]+values
+        yield ids, values
+
+def iter_block_rows(block_files, num_ids, previous=None):
+    """Rows of the matrix from the merged blocks, the temporary files are
+    removed once all rows were read
+
+    :Parameter block_files: temporary files of the blocks
+    :Parameter num_ids: number of id columns
+    :Parameter previous: rows of an existing matrix, see iter_rows
+    """
+    try:
+        for row in merge_rows(block_files, range(num_ids), None, previous=previous):
+            yield row
+    finally:
+        for filename in block_files:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+def merge_rows(filenames, id_columns, value_columns, skip_lines=0, tmp_dir=None,
+               previous=None):
+    """Rows of the matrix of any number of files
+
+    :Parameter filenames: files of all samples
+    :Parameter id_columns: columns with the ids of a line
+    :Parameter value_columns: columns that are taken from every file, None
+                              for all columns after the ids
+    :Parameter skip_lines: number of lines at the top of every file that are
+                           not part of the matrix
+    :Parameter tmp_dir: directory of the temporary files of the blocks
+    :Parameter previous: rows of an existing matrix, see iter_rows
+    :return parameter: tuples of the ids and the values of all files
+    """
+    if len(filenames) <= MAX_OPEN_FILES:
+        return iter_rows(filenames, id_columns, value_columns, skip_lines, previous)
+
+    block_files = []
+    try:
+        for start in range(0, len(filenames), MAX_OPEN_FILES):
+            handle, filename = tempfile.mkstemp(suffix='.txt', dir=tmp_dir)
+            block_files.append(filename)
+            handle = os.fdopen(handle, 'w')
+            for ids, values in iter_rows(filenames[start:start+MAX_OPEN_FILES],
+                                         id_columns,
+                                         value_columns,
+                                         skip_lines):
+                handle.write('\t'.join(ids+values)+'\n')
+            handle.close()
+    except ValueError:
+        for filename in block_files:
+            os.remove(filename)
+        raise
+    return iter_block_rows(block_files, len(id_columns), previous)
+
+def add_array(binary, name, array):
+    """Adds an array to a binary matrix
+
+    :Parameter binary: binary matrix that was created by open_binary
+    :Parameter name: name of the array
+    :Parameter array: numpy array
+    """
+    buf = io.BytesIO()
+    np.lib.format.write_array(buf, array)
+    binary['archive'].writestr(name+'.npy', buf.getvalue())
+
+def open_binary(filename, samples, dtype):
+    """Starts a binary matrix, which is written under a temporary name until
+    it is closed
+
+    :Parameter filename: output file (.npz)
+    :Parameter samples: names of the samples
+    :Parameter dtype: numpy type of the values
+    """
+    binary = dict()
+    binary['filename'] = filename
+    binary['archive'] = zipfile.ZipFile(filename+'.tmp', 'w',
+                                        zipfile.ZIP_DEFLATED,
+                                        allowZip64=True)
+    binary['samples'] = samples
+    binary['dtype'] = dtype
+    binary['ids'] = []
+    #the rows of the current block are converted as they are added
+    binary['block'] = np.empty((GENE_CHUNK, len(samples)), dtype=dtype)
+    binary['num_rows'] = 0
+    return binary
+
+def flush_binary(binary):
+    """Writes the rows that were added since the last block
+
+    :Parameter binary: binary matrix that was created by open_binary
+    """
+    if binary['num_rows'] == 0:
+        return
+    gene_chunk = (len(binary['ids'])-1)/GENE_CHUNK
+    matrix = binary['block'][:binary['num_rows']]
+    for start in range(0, len(binary['samples']), SAMPLE_CHUNK):
+        add_array(binary,
+                  'block_%d_%d' %(gene_chunk, start/SAMPLE_CHUNK),
+                  matrix[:, start:start+SAMPLE_CHUNK])
+    binary['num_rows'] = 0
+
+def add_binary_row(binary, ids, values):
+    """Adds a row to a binary matrix
+
+    :Parameter binary: binary matrix that was created by open_binary
+    :Parameter ids: ids of the row
+    :Parameter values: values of all samples
+    """
+    if len(values) != len(binary['samples']):
+        raise ValueError('Row '+'\t'.join(ids)+' has '+str(len(values))+
+                         ' values for '+str(len(binary['samples']))+' samples')
+    binary['block'][binary['num_rows']] = np.array(values, dtype=binary['dtype'])
+    binary['ids'].append(ids)
+    binary['num_rows'] += 1
+    if binary['num_rows'] == GENE_CHUNK:
+        flush_binary(binary)
+
+def close_binary(binary, remove=False):
+    """Finishes a binary matrix
+
+    :Parameter binary: binary matrix that was created by open_binary
+    :Parameter remove: removes the temporary file instead, e.g. after an error
+    """
+    if not remove:
+        flush_binary(binary)
+        add_array(binary, 'ids', np.array(binary['ids'], dtype=str))
+        add_array(binary, 'samples', np.array(binary['samples'], dtype=str))
+        add_array(binary, 'chunks', np.array([GENE_CHUNK, SAMPLE_CHUNK,
+                                              len(binary['ids'])]))
+    binary['archive'].close()
+    if remove:
+        os.remove(binary['filename']+'.tmp')
+    else:
+        os.rename(binary['filename']+'.tmp', binary['filename'])
+
+def read_sample(filename, sample):
+    """Values of a single sample of a binary matrix
+
+    :Parameter filename: binary matrix (.npz)
+    :Parameter sample: name of the sample
+    :return parameter: tuple of the ids of all rows and the values
+    """
+    archive = np.load(filename)
+    gene_chunk, sample_chunk, num_rows = archive['chunks']
+    column = list(archive['samples']).index(sample)
+    values = [archive['block_%d_%d' %(chunk, column/sample_chunk)][:, column%sample_chunk]
+              for chunk in range((num_rows+gene_chunk-1)/gene_chunk)]
+    ids = archive['ids']
+    archive.close()
+    return ids, np.concatenate(values) if len(values) > 0 else np.array([])
+
+def read_gene(filename, gene_id):
+    """Values of a single gene (row) of a binary matrix
+
+    :Parameter filename: binary matrix (.npz)
+    :Parameter gene_id: first id of the row
+    :return parameter: tuple of the names of the samples and the values
+    """
+    archive = np.load(filename)
+    gene_chunk, sample_chunk, _ = archive['chunks']
+    samples = archive['samples']
+    row = list(archive['ids'][:, 0]).index(gene_id)
+    values = [archive['block_%d_%d' %(row/gene_chunk, chunk)][row%gene_chunk, :]
+              for chunk in range((len(samples)+sample_chunk-1)/sample_chunk)]
+    archive.close()
+    return samples, np.concatenate(values) if len(values) > 0 else np.array([])
+
+def write_matrix(rows, out_file, header, tail_file='', tail_header='', tail_lines=0,
+                 binary_file='', dtype=np.int32, binary_skip_rows=0):
+    """Writes the rows of a matrix into a tab delimited file. The file is
+    written under a temporary name first, so an error while merging never
+    leaves a partial matrix behind.
+
+    :Parameter rows: rows from merge_rows
+    :Parameter out_file: output file
+    :Parameter header: first line of the output file
+    :Parameter tail_file: file that gets the last rows instead, e.g. the
+                          summary lines of htseq-count
+    :Parameter tail_header: first line of the tail file
+    :Parameter tail_lines: number of rows at the end that go into tail_file
+    :Parameter binary_file: the rows of the output file are also written
+                            into this binary matrix (.npz)
+    :Parameter dtype: numpy type of the values in the binary matrix
+    :Parameter binary_skip_rows: number of rows at the top that are not
+                                 written into the binary matrix, e.g. a header
+    :return parameter: number of rows in the output file
+    """
+    tmp_file = out_file+'.tmp'
+    handle = open(tmp_file, 'w')
+    handle.write(header+'\n')
+    binary = None
+    tail = collections.deque()
+    num_rows = 0
+    try:
+        for ids, values in rows:
+            tail.append((ids, values))
+            if len(tail) > tail_lines:
+                row_ids, row_values = tail.popleft()
+                handle.write('\t'.join(row_ids+row_values)+'\n')
+                if binary_file != '' and num_rows >= binary_skip_rows:
+                    #the columns of the header after the ids are the samples
+                    if binary is None:
+                        binary = open_binary(binary_file,
+                                             header.split('\t')[len(row_ids):],
+                                             dtype)
+                    add_binary_row(binary, row_ids, row_values)
+                num_rows += 1
+    except ValueError:
+        handle.close()
+        os.remove(tmp_file)
+        if binary is not None:
+            close_binary(binary, remove=True)
+        raise
+    handle.close()
+    os.rename(tmp_file, out_file)
+    if binary is not None:
+        close_binary(binary)
+
+    if tail_file != '':
+        handle = open(tail_file, 'w')
+        handle.write(tail_header+'\n')
+        handle.write(''.join(['\t'.join(ids+values)+'\n' for ids, values in tail]))
+        handle.close()
+    return num_rows
+
+def read_manifest(manifest_file):
+    """Manifest of a matrix, None if there is none
+
+    :Parameter manifest_file: manifest (.json)
+    """
+    if not os.path.exists(manifest_file):
+        return None
+    handle = open(manifest_file)
+    manifest = json.load(handle)
+    handle.close()
+    return manifest
+
+def write_manifest(manifest_file, id_header, samples, fingerprints):
+    """Writes the manifest of a matrix
+
+    :Parameter manifest_file: manifest (.json)
+    :Parameter id_header: names of the id columns
+    :Parameter samples: names of the samples in the order of the columns
+    :Parameter fingerprints: fingerprint of the file of every sample
+    """
+    handle = open(manifest_file+'.tmp', 'w')
+    json.dump({'ids':id_header,
+               'samples':[[samples[idx], fingerprints[idx]] for idx in range(len(samples))]},
+              handle)
+    handle.close()
+    os.rename(manifest_file+'.tmp', manifest_file)
+
+def get_new_samples(manifest, id_header, samples, fingerprints, out_files):
+    """Samples that are not in the matrix yet
+
+    :Parameter manifest: manifest of the matrix or None
+    :Parameter id_header: names of the id columns
+    :Parameter samples: names of the samples
+    :Parameter fingerprints: fingerprint of the file of every sample
+    :Parameter out_files: files of the existing matrix
+    :return parameter: list of the new samples, None if the matrix has to be
+                       rebuilt because a sample was removed or its file changed,
+                       or a new sample comes before a merged one
+    """
+    if manifest is None or manifest['ids'] != id_header:
+        return None
+    if not all([os.path.exists(filename) for filename in out_files]):
+        return None
+    current = dict(zip(samples, fingerprints))
+    for sample, fingerprint in manifest['samples']:
+        if current.get(sample) != fingerprint:
+            return None
+    #the columns are only appended if they keep the order of the samples,
+    #createRawCountESet.R matches the columns to the samples by position
+    merged = [sample for sample, _ in manifest['samples']]
+    if samples[:len(merged)] != merged:
+        return None
+    return samples[len(merged):]
+
+def update_matrix(samples, filenames, id_header, id_columns, value_columns, out_file,
+                  manifest_file, skip_lines=0, incremental=True, tail_file='',
+                  tail_lines=0, binary_file='', dtype=np.int32, binary_skip_rows=0):
+    """Writes the matrix of the samples into a tab delimited file, or only
+    appends the columns of the samples that are not in the matrix yet
+
+    :Parameter samples: names of the samples
+    :Parameter filenames: file of every sample
+    :Parameter id_header: names of the id columns
+    :Parameter id_columns: columns with the ids of a line, see merge_rows
+    :Parameter value_columns: columns that are taken from every file
+    :Parameter out_file: output file
+    :Parameter manifest_file: manifest of the samples in the output file
+    :Parameter skip_lines: number of lines at the top of every file that are
+                           not part of the matrix
+    :Parameter incremental: reuse the existing matrix, otherwise it is rebuilt
+    :Parameter tail_file: file that gets the last rows, see write_matrix. It
+                          has the same header as the output file.
+    :Parameter tail_lines: number of rows at the end that go into tail_file
+    :Parameter binary_file: binary matrix (.npz), see write_matrix
+    :Parameter dtype: numpy type of the values in the binary matrix
+    :Parameter binary_skip_rows: number of rows at the top that are not
+                                 written into the binary matrix
+    :return parameter: True if the matrix was written, False if it was up to date
+    """
+    fingerprints = [CACHE.get_file_fingerprint(filename) for filename in filenames]
+    out_files = [filename for filename in [out_file, tail_file, binary_file]
+                 if filename != '']
+    manifest = read_manifest(manifest_file) if incremental else None
+    new_samples = get_new_samples(manifest, id_header, samples, fingerprints, out_files)
+    if new_samples is not None and len(new_samples) == 0:
+        return False
+
+    if new_samples is None:
+        rows = merge_rows(filenames, id_columns, value_columns, skip_lines)
+    else:
+        #the rows of the existing matrix, followed by the rows in the tail file
+        previous = read_rows(out_file, 1)
+        if tail_file != '':
+            previous = itertools.chain(previous, read_rows(tail_file, 1))
+        rows = merge_rows([filenames[samples.index(sample)] for sample in new_samples],
+                          id_columns,
+                          value_columns,
+                          skip_lines,
+                          previous=previous)
+
+    header = '\t'.join(id_header+samples)
+    write_matrix(rows, out_file, header,
+                 tail_file=tail_file,
+                 tail_header=header,
+                 tail_lines=tail_lines,
+                 binary_file=binary_file,
+                 dtype=dtype,
+                 binary_skip_rows=binary_skip_rows)
+    write_manifest(manifest_file, id_header, samples, fingerprints)
+    return True
@@ -20,9 +20,16 @@ as well as functions for reporting the results
 
 from hydra_pkg import module_helper as MODULE_HELPER
 from hydra_pkg import helper as HELPER
+from hydra_pkg import count_matrix as COUNT_MATRIX
 from hydra_pkg.r_scripts import get_script_path
 import os
 import subprocess
+import numpy as np
+
+#parameters the results of this module depend on, see cache.py
+CACHE_PARAMETERS = ['cufflinks_exec', 'cufflinks_compatible_hits',
+                    'cufflinks_total_hits', 'cufflinks_N', 'cufflinks_u',
+                    'genome_annotation_gft', 'stranded', 'paired']
 
 def init(param):
     """Initialization function that checks the all relevant tophat parameters
@@ -122,43 +129,45 @@ def finalize(param, input_files='count_files'):
 
     """
     HELPER.writeLog('Collecting Cufflinks FPKM data ... \n', param)
-    #extracts the counts from the cufflinks output
-    import csv
     #check which of these files are actually available
-
     working_files = [iFile for iFile in param[input_files] if iFile != '']
-        
+
     if len(working_files) > 0:
-        #get gene annotation
-        csv_file = open(working_files[0])
-        csv_reader = csv.reader(csv_file, delimiter='\t')
-        counts = [row[0]+'\t'+row[4] for row in csv_reader]
-        csv_file.close()
-        no_lines = len(counts)
-        #get all the expression values
-        header = 'ENS_ID\tSymbol'
+        #only samples with the same number of lines as the first one are used
+        no_lines = file_len(working_files[0])
+        samples = []
+        sample_files = []
         for idx in range(param['num_samples']):
             if os.path.exists(param[input_files][idx]):
                 if file_len(param[input_files][idx]) != no_lines:
-                    HELPER.writeLog('WARNING: Sample - ' + 
-                                    param['stub'][idx] + 
-                                    ' has an unexpected number of lines, SKIPPING this sample', 
-                                    param)         
+                    HELPER.writeLog('WARNING: Sample - ' +
+                                    param['stub'][idx] +
+                                    ' has an unexpected number of lines, SKIPPING this sample',
+                                    param)
                 else:
-                    header = header + '\t' + param['stub'][idx]
-                    csv_file = open(param[input_files][idx])
-                    csv_reader = csv.reader(csv_file, delimiter='\t')
-                    i = 0
-                    for row in csv_reader:
-                        counts[i] = counts[i] + '\t' + row[9]
-                        i += 1
-                    csv_file.close()
-        #output the file
-        out_handle = open(param['working_dir']+'deliverables/cufflinks_counts_fpkm.txt', 'w')
-        out_handle.write(header+'\n')
-        for i in range(len(counts)):
-            out_handle.write(counts[i]+'\n')
-        out_handle.close()
+                    samples.append(param['stub'][idx])
+                    sample_files.append(param[input_files][idx])
+        #output the file with the gene identifiers, symbols and the FPKM
+        #values (10th column) of every sample, and a binary matrix without
+        #the header line of the cufflinks files
+        try:
+            COUNT_MATRIX.update_matrix(samples,
+                                       sample_files,
+                                       ['ENS_ID', 'Symbol'],
+                                       [0, 4],
+                                       [9],
+                                       param['working_dir']+
+                                       'deliverables/cufflinks_counts_fpkm.txt',
+                                       param['working_dir']+
+                                       'results/cufflinks/cufflinks_counts_fpkm.json',
+                                       incremental=param['incremental_count_matrix'],
+                                       binary_file=(param['working_dir']+
+                                                    'deliverables/cufflinks_counts_fpkm.npz'),
+                                       dtype=np.float32,
+                                       binary_skip_rows=1)
+        except ValueError as error:
+            HELPER.writeLog('ERROR: The Cufflinks FPKM values could not be merged: '+
+                            str(error)+'\n', param)
     else:
         print 'Cufflinks was not run successfully on any of the files..\n'
 
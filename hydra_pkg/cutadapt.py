@@ -13,14 +13,24 @@
 #limitations under the License.
 
 """Cutadapt module
-This module contains functions for running the cutadapt tool
+This module contains functions for running the cutadapt tool, or the
+built-in trimmer (cutadapt_trimmer = builtin, see trimmer.py) that trims
+the same way in the pipeline process
 """
 
 import hydra_pkg.module_helper as MODULE_HELPER
+from hydra_pkg import fastq_io as FASTQ_IO
+from hydra_pkg import trimmer as TRIMMER
 import os
 import sys
 import subprocess
 
+#parameters the results of this module depend on, see cache.py
+CACHE_PARAMETERS = ['cutadapt_exec', 'cutadapt_trimmer', 'cutadapt_first_adapter',
+                    'cutadapt_second_adapter', 'cutadapt_m', 'cutadapt_q_end',
+                    'cutadapt_q_start', 'cutadapt_u', 'paired', 'trimmed_format',
+                    'intermediate_compression_level']
+
 def init(param):
     """Initialization function, that checks if the bamqc_script that is run
     on every single samples is available
@@ -36,10 +46,17 @@ def init(param):
     MODULE_HELPER.check_parameter(param, key='cutadapt_q_start', dtype=str)
     MODULE_HELPER.check_parameter(param, key='cutadapt_quality', dtype=str)
     MODULE_HELPER.check_parameter(param, key='cutadapt_u', dtype=str)
+    MODULE_HELPER.check_parameter(param, key='cutadapt_trimmer', dtype=str, optional=True)
+    if param['cutadapt_trimmer'] == '':
+        param['cutadapt_trimmer'] = 'cutadapt'
+    if param['cutadapt_trimmer'] not in ['cutadapt', 'builtin']:
+        print 'Parameter cutadapt_trimmer can only be one of the following: cutadapt, builtin'
+        sys.exit(0)
 
 
 def run_cutadapt(param, outfile, outfile2=''):
-    """Runs cutadapt on a file that remove an adapter sequence
+    """Runs cutadapt on a file that remove an adapter sequence, cutadapt
+    picks the compression of the output by its extension with its own level
 
     :Parameter param: dictionary that contains all general RNASeq pipeline parameters
     :Parameter infile: input filename
@@ -78,32 +95,64 @@ def run_cutadapt(param, outfile, outfile2=''):
         sys.exit(0)
     else:
         #check if the file integrity is alright
-        call = ['gzip', '-t', outfile] 
-        output, error = subprocess.Popen(call,
-                                         stdout=subprocess.PIPE,
-                                         stderr=subprocess.PIPE).communicate()
-        if 'unexpected end of file' in error:
+        if not FASTQ_IO.test_file(outfile,
+                                  FASTQ_IO.get_threads(param['num_processors'])):
             param['file_handle'].write('ERROR: File integrity corrupted, please rerun')
             sys.exit(0)
-            
+
+
+def run_trimmer(param, outfile, outfile2=''):
+    """Trims the files with the built-in trimmer, which writes the summary
+    where cutadapt writes it. The output files are renamed once they are
+    complete, so there is no integrity check afterwards.
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter outfile: output filename
+    :Parameter outfile2: output filename of the second mates
+    """
+    input_files = [param['working_file']]
+    output_files = [outfile]
+    if param['paired']:
+        input_files.append(param['working_file2'])
+        output_files.append(outfile2)
+    param['file_handle'].write('Trimming '+' '.join(input_files)+
+                               ' with the built-in trimmer\n')
+    try:
+        TRIMMER.trim_files(input_files,
+                           output_files,
+                           outfile+'.txt',
+                           TRIMMER.get_options(param),
+                           int(param['num_processors']))
+    except (IOError, OSError, ValueError) as error:
+        param['file_handle'].write('ERROR: '+str(error)+'\n')
+        sys.exit(0)
+    with open(outfile+'.txt') as filehandle:
+        param['file_handle'].write(filehandle.read())
+
 
 def main():
     """Main function that is run on each samples, which in turn calls the
     cutadapt tool
     """
     param = MODULE_HELPER.initialize_module()
+    if param['cutadapt_trimmer'] == 'builtin':
+        trim = run_trimmer
+    else:
+        trim = run_cutadapt
 
-    #run fastqc
+    #the format of the trimmed files is negotiated with the steps that
+    #read them, see pipeline.get_trimmed_format
+    extension = FASTQ_IO.EXTENSIONS[param['trimmed_format']]
     outfile = (param['module_dir']+
                param['outstub']+
-               '.clipped.fastq.gz')
+               '.clipped'+extension)
 
     if not param['paired']:
-        run_cutadapt(param, outfile)
+        trim(param, outfile)
         MODULE_HELPER.wrapup_module(param, [outfile])
     else:
         outfile2 = (param['module_dir']+
                     param['outstub']+
-                    '.clipped.2.fastq.gz')
-        run_cutadapt(param, outfile, outfile2)
+                    '.clipped.2'+extension)
+        trim(param, outfile, outfile2)
         MODULE_HELPER.wrapup_module(param, [outfile, outfile2])
@@ -0,0 +1,104 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Dry run module, which does not run any job but records every call of the
+pipeline to the scheduler in results/dry_run.log. Every submitted sample is
+treated as successful, so the whole dependency graph of the pipeline is
+walked without a cluster or any of the tools being installed.
+"""
+
+import json
+import time
+from hydra_pkg import backend_helper as BACKEND_HELPER
+
+#no job is run and the files of earlier runs are left alone, see
+#backend_helper
+SIDE_EFFECTS = False
+
+#all calls to the backend in the order they were made
+CALLS = []
+
+def init(param):
+    """ Init function of the dry run backend
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+
+def record_call(param, call):
+    """Records a call in memory and in results/dry_run.log
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter call: dictionary describing the call
+    """
+    call['time'] = time.time()
+    CALLS.append(call)
+    handle = open(param['working_dir']+'results/dry_run.log', 'a')
+    handle.write(json.dumps(call)+'\n')
+    handle.close()
+
+def submit_jobs(param, indices, py_file, job_id, cores, mem_free, hold_jobs):
+    """Records the submission of a step
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter indices: indices of the files that should be run
+    :Parameter py_file: wrapper that would be called to run the current step
+    :Parameter job_id: name of the job
+    :Parameter cores: number of cores that should be used
+    :Parameter mem_free: memory that should be reserved for each job
+    :Parameter hold_jobs: list with the job ids for every sample that have to
+                          finish before the sample can start
+    :return parameter: dry run job id for every sample
+    """
+    scheduler_id = 'dry_'+str(len([call for call in CALLS
+                                   if call['call'] == 'submit'])+1)
+    record_call(param, {'call':'submit',
+                        'job':scheduler_id,
+                        'flag':param['current_flag'],
+                        'py_file':py_file,
+                        'name':job_id,
+                        'samples':[param['stub'][idx] for idx in indices],
+                        'cores':cores,
+                        'mem_free':mem_free,
+                        'hold':hold_jobs})
+    return [scheduler_id if idx in indices else ''
+            for idx in range(param['num_samples'])]
+
+def wait_for_jobs(param, scheduler_ids):
+    """Records waiting for a step, which returns right away
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter scheduler_ids: dry run job ids of the current batch
+    """
+    record_call(param, {'call':'wait',
+                        'flag':param['current_flag'],
+                        'jobs':BACKEND_HELPER.get_array_ids(scheduler_ids)})
+
+def cancel_jobs(param, scheduler_ids):
+    """Records the cancellation of a step
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter scheduler_ids: dry run job ids of the current batch
+    """
+    record_call(param, {'call':'cancel',
+                        'flag':param['current_flag'],
+                        'jobs':BACKEND_HELPER.get_array_ids(scheduler_ids)})
+
+def get_status(param, scheduler_id):
+    """Dry run jobs are finished as soon as they are submitted
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter scheduler_id: dry run job id
+    :return parameter: 'finished'
+    """
+    return 'finished'
@@ -0,0 +1,721 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Fastq IO module
+Reading and writing of plain, gzipped and zstd compressed fastq files for
+all steps.
+
+Gzipped files are written as BGZF, i.e. a series of gzip members of at most
+BLOCK_SIZE bytes with the block size in the header, which is a valid gzip
+file that can be decompressed block by block in parallel. The blocks are
+compressed by a pool of threads (zlib releases the GIL), so compressing
+does not need an external tool.
+
+BGZF files are decompressed by bgzip with several threads if it is
+installed, or by the blocks in a pool of threads otherwise. Other gzip
+files are decompressed by pigz if it is installed, gzip otherwise, in a
+separate process. get_decompress_command builds the same commands for
+tools that decompress their input themselves, e.g. the readFilesCommand
+of STAR, and open_fifos feeds them to tools that only read plain files
+through named pipes.
+
+Intermediate fastq files can be written in any of the FORMATS, which is
+set by the extension of the file name (see EXTENSIONS). zstd compresses
+several times faster than gzip and is run in a separate process, plain
+files are not compressed at all, which is the fastest on local scratch.
+The format of a file that is read is found by its magic number, so the
+steps reading it do not depend on the file name.
+
+Named pipes are written by a PipeWriter (see get_writer), which hands the
+reads from one step to another in the same job without writing them to
+disk (see trim_align).
+
+Usage: python -m hydra_pkg.fastq_io [-@ threads] file.fastq.gz
+decompresses a file to stdout.
+"""
+import fcntl
+import getopt
+import os
+import Queue
+import signal
+import stat
+import struct
+import subprocess
+import sys
+import threading
+import zlib
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+
+#uncompressed bytes per BGZF block, as in samtools
+BLOCK_SIZE = 65280
+#compressed blocks have to fit the 16 bit block size of the header
+MAX_BLOCK_SIZE = 65536
+
+#empty block that marks the end of a BGZF file
+BGZF_EOF = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43'+
+            '\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+#gzip compression level
+COMPRESSION_LEVEL = 6
+
+#formats of intermediate fastq files and their file name extensions
+FORMATS = ['gzip', 'zstd', 'plain']
+EXTENSIONS = {'gzip':'.fastq.gz', 'zstd':'.fastq.zst', 'plain':'.fastq'}
+
+#default and highest compression level of every compressed format
+DEFAULT_LEVELS = {'gzip':COMPRESSION_LEVEL, 'zstd':3}
+MAX_LEVELS = {'gzip':9, 'zstd':19}
+
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+
+#number of blocks that are (de)compressed at once per thread
+BLOCKS_PER_THREAD = 16
+
+#buffer size of files and pipes
+BUFFER_SIZE = 4*1024*1024
+
+#more threads do not make the decompression of a file any faster
+MAX_THREADS = 4
+
+#pieces of data that wait to be written into a named pipe
+MAX_QUEUED = 4
+
+def get_threads(num_processors, num_files=1):
+    """Number of (de)compression threads per file
+
+    :Parameter num_processors: number of processors of the job
+    :Parameter num_files: number of files that are read at the same time
+    """
+    return max(1, min(MAX_THREADS, int(num_processors)//max(1, num_files)))
+
+def read_header(filename, size=18):
+    """First bytes of a file"""
+    handle = open(filename, 'rb')
+    header = handle.read(size)
+    handle.close()
+    return header
+
+def is_gzipped(filename):
+    """Checks the magic number of a file
+
+    :Parameter filename: file name
+    """
+    return read_header(filename, 2) == '\x1f\x8b'
+
+def is_zstd(filename):
+    """Checks the magic number of a file
+
+    :Parameter filename: file name
+    """
+    return read_header(filename, 4) == ZSTD_MAGIC
+
+def is_fifo(filename):
+    """Checks if a file is a named pipe
+
+    :Parameter filename: file name
+    """
+    return os.path.exists(filename) and stat.S_ISFIFO(os.stat(filename).st_mode)
+
+def get_codec(filename):
+    """Format of an existing file by its magic number, named pipes are
+    always plain since reading the magic number would take it from the reader
+
+    :Parameter filename: file name
+    :return parameter: one of FORMATS
+    """
+    if is_fifo(filename):
+        return 'plain'
+    if is_gzipped(filename):
+        return 'gzip'
+    if is_zstd(filename):
+        return 'zstd'
+    return 'plain'
+
+def get_format(filename):
+    """Format a file is written in by the extension of its name
+
+    :Parameter filename: file name
+    :return parameter: one of FORMATS
+    """
+    if filename.endswith('.gz'):
+        return 'gzip'
+    if filename.endswith('.zst'):
+        return 'zstd'
+    return 'plain'
+
+def get_level(file_format, level=''):
+    """Compression level of a format, the default level if none is given,
+    levels that are too high for the format are lowered
+
+    :Parameter file_format: one of FORMATS
+    :Parameter level: compression level of the parameter file, or ''
+    """
+    if file_format not in DEFAULT_LEVELS:
+        return 0
+    if level == '' or level is None:
+        return DEFAULT_LEVELS[file_format]
+    return max(1, min(int(level), MAX_LEVELS[file_format]))
+
+def negotiate_format(requested, readers):
+    """Format of intermediate files that every step reading them supports
+
+    :Parameter requested: format of the parameter file
+    :Parameter readers: INPUT_FORMATS of the steps that read the files
+    :return parameter: the requested format, or gzip which all steps read
+    """
+    for input_formats in readers:
+        if requested not in input_formats:
+            return 'gzip'
+    return requested
+
+def is_bgzf(filename):
+    """Checks if a file starts with a BGZF block
+
+    :Parameter filename: file name
+    """
+    header = read_header(filename)
+    return (len(header) == 18 and header[:4] == '\x1f\x8b\x08\x04' and
+            header[12:14] == 'BC')
+
+def get_decompress_command(filename, threads=1):
+    """Command that decompresses a file to stdout, the file name is added
+    as the last argument
+
+    :Parameter filename: gzipped or zstd compressed file
+    :Parameter threads: number of threads
+    """
+    if is_zstd(filename):
+        return ['zstd', '-dcq']
+    if is_bgzf(filename):
+        bgzip = find_executable('bgzip')
+        if bgzip is not None:
+            return [bgzip, '-dc', '-@', str(threads)]
+        if threads > 1:
+            return [sys.executable, '-m', 'hydra_pkg.fastq_io', '-@', str(threads)]
+    pigz = find_executable('pigz')
+    if pigz is not None:
+        return [pigz, '-dc', '-p', str(threads)]
+    return ['gzip', '-dc']
+
+def compress_block(data, level=COMPRESSION_LEVEL):
+    """Compresses data of at most BLOCK_SIZE bytes into a BGZF block
+
+    :Parameter data: uncompressed data
+    :Parameter level: gzip compression level
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = compressor.compress(data)+compressor.flush()
+    if len(cdata)+26 > MAX_BLOCK_SIZE:
+        #data that does not compress is stored
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -zlib.MAX_WBITS)
+        cdata = compressor.compress(data)+compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6,
+                         ord('B'), ord('C'), 2, len(cdata)+25)
+    return header+cdata+struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+def compress_bgzf(data, level=COMPRESSION_LEVEL):
+    """Compresses data into BGZF blocks, without the end of file block
+
+    :Parameter data: uncompressed data
+    :Parameter level: gzip compression level
+    """
+    return ''.join([compress_block(data[pos:pos+BLOCK_SIZE], level)
+                    for pos in xrange(0, len(data), BLOCK_SIZE)])
+
+def decompress_block(block):
+    """Decompresses a BGZF block and checks its checksum
+
+    :Parameter block: complete block
+    """
+    data = zlib.decompress(block[18:-8], -zlib.MAX_WBITS)
+    crc, size = struct.unpack('<II', block[-8:])
+    if size != len(data) or crc != zlib.crc32(data) & 0xffffffff:
+        raise IOError('BGZF block with a wrong checksum')
+    return data
+
+def read_blocks(handle, filename):
+    """Compressed BGZF blocks of a file
+
+    :Parameter handle: file handle
+    :Parameter filename: file name, for error messages
+    """
+    while True:
+        header = handle.read(18)
+        if header == '':
+            return
+        if len(header) < 18 or header[:4] != '\x1f\x8b\x08\x04' or header[12:14] != 'BC':
+            raise IOError(filename+' is not a BGZF file or it is truncated')
+        size = struct.unpack('<H', header[16:18])[0]+1
+        rest = handle.read(size-18)
+        if len(rest) < size-18:
+            raise IOError(filename+' is truncated')
+        yield header+rest
+
+class Reader(object):
+    """Buffered reader of a plain, gzipped, BGZF or zstd file, which is used
+    like a file opened for reading
+    """
+
+    def __init__(self, filename, threads=1):
+        """Opens a file
+
+        :Parameter filename: file name
+        :Parameter threads: number of decompression threads
+        """
+        self.filename = filename
+        self.process = None
+        self.pool = None
+        self.blocks = None
+        self.buffer = ''
+        self.offset = 0
+        if threads > 1 and is_bgzf(filename) and find_executable('bgzip') is None:
+            self.handle = open(filename, 'rb', BUFFER_SIZE)
+            self.pool = ThreadPool(threads)
+            self.blocks = self.decompress(threads*BLOCKS_PER_THREAD)
+        elif get_codec(filename) != 'plain':
+            self.process = subprocess.Popen(get_decompress_command(filename, threads)+
+                                            [filename],
+                                            stdout=subprocess.PIPE,
+                                            bufsize=BUFFER_SIZE)
+            self.handle = self.process.stdout
+        else:
+            self.handle = open(filename, 'rb', BUFFER_SIZE)
+
+    def decompress(self, batch_size):
+        """Decompressed data of batches of blocks
+
+        :Parameter batch_size: number of blocks that are decompressed at once
+        """
+        blocks = read_blocks(self.handle, self.filename)
+        while True:
+            batch = [block for _, block in zip(xrange(batch_size), blocks)]
+            if len(batch) == 0:
+                return
+            yield ''.join(self.pool.map(decompress_block, batch))
+
+    def read_data(self):
+        """Decompressed data of the next blocks, '' at the end of the file"""
+        if self.blocks is None:
+            return self.handle.read(BUFFER_SIZE)
+        return next(self.blocks, '')
+
+    def readline(self):
+        """Next line, '' at the end of the file"""
+        if self.blocks is None:
+            return self.handle.readline()
+        while True:
+            end = self.buffer.find('\n', self.offset)
+            if end >= 0:
+                line = self.buffer[self.offset:end+1]
+                self.offset = end+1
+                return line
+            data = next(self.blocks, '')
+            if data == '':
+                line = self.buffer[self.offset:]
+                self.buffer = ''
+                self.offset = 0
+                return line
+            self.buffer = self.buffer[self.offset:]+data
+            self.offset = 0
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self, abort=False):
+        """Closes the file
+
+        :Parameter abort: the file was not read to the end, which stops the
+                          decompression without an error
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+        if self.process is not None and abort and self.process.poll() is None:
+            self.process.terminate()
+        self.handle.close()
+        if self.process is not None:
+            self.process.wait()
+            if not abort and self.process.returncode != 0:
+                raise IOError('Could not decompress '+self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        self.close(abort=error_type is not None)
+
+class Writer(object):
+    """Buffered writer of a plain file, a BGZF file if the name ends with .gz
+    or a zstd file if it ends with .zst, which is used like a file opened for
+    writing. The file is written under a temporary name until it is closed.
+    """
+
+    def __init__(self, filename, threads=1, level=''):
+        """Opens a file
+
+        :Parameter filename: file name
+        :Parameter threads: number of compression threads
+        :Parameter level: compression level, the default of the format if
+                          none is given
+        """
+        self.filename = filename
+        self.format = get_format(filename)
+        self.level = get_level(self.format, level)
+        self.pool = None
+        self.process = None
+        if self.format == 'gzip' and threads > 1:
+            self.pool = ThreadPool(threads)
+        self.batch_size = max(1, threads)*BLOCKS_PER_THREAD*BLOCK_SIZE
+        self.pending = []
+        self.size = 0
+        self.handle = open(filename+'.tmp', 'wb', BUFFER_SIZE)
+        self.output = self.handle
+        if self.format == 'zstd':
+            self.process = subprocess.Popen(['zstd', '-cq', '-'+str(self.level),
+                                             '-T'+str(max(1, threads))],
+                                            stdin=subprocess.PIPE,
+                                            stdout=self.handle,
+                                            bufsize=BUFFER_SIZE)
+            self.output = self.process.stdin
+
+    def write(self, data):
+        """Writes data
+
+        :Parameter data: string
+        """
+        self.pending.append(data)
+        self.size += len(data)
+        if self.size >= self.batch_size:
+            self.flush()
+
+    def write_blocks(self, blocks):
+        """Writes data that is already compressed into BGZF blocks, e.g. by
+        compress_bgzf in another process
+
+        :Parameter blocks: BGZF blocks without the end of file block
+        """
+        self.flush()
+        self.handle.write(blocks)
+
+    def flush(self):
+        """Compresses and writes the pending data"""
+        data = ''.join(self.pending)
+        self.pending = []
+        self.size = 0
+        if self.format != 'gzip':
+            self.output.write(data)
+            return
+        pieces = [data[pos:pos+BLOCK_SIZE] for pos in xrange(0, len(data), BLOCK_SIZE)]
+        if self.pool is not None:
+            blocks = self.pool.map(lambda piece: compress_block(piece, self.level), pieces)
+        else:
+            blocks = [compress_block(piece, self.level) for piece in pieces]
+        self.handle.write(''.join(blocks))
+
+    def close(self, abort=False):
+        """Closes the file and renames it
+
+        :Parameter abort: removes the file instead
+        """
+        if not abort:
+            self.flush()
+            if self.format == 'gzip':
+                self.handle.write(BGZF_EOF)
+        if self.pool is not None:
+            self.pool.terminate()
+        if self.process is not None:
+            if abort:
+                self.process.terminate()
+            try:
+                self.output.close()
+            except IOError:
+                #the process stopped, which its return code tells
+                pass
+            self.process.wait()
+        self.handle.close()
+        if abort:
+            os.remove(self.filename+'.tmp')
+        elif self.process is not None and self.process.returncode != 0:
+            os.remove(self.filename+'.tmp')
+            raise IOError('Could not compress '+self.filename)
+        else:
+            os.rename(self.filename+'.tmp', self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        self.close(abort=error_type is not None)
+
+class PipeWriter(object):
+    """Writer of a named pipe, which is used like a Writer of a plain file.
+    The data is written by a thread, so a reader that reads the pipes of
+    both mates in lockstep is not blocked by a full pipe of one mate while
+    the reads of the other one are written.
+    """
+
+    def __init__(self, filename):
+        """Starts the thread, which opens the pipe once a reader opens it
+
+        :Parameter filename: name of the pipe
+        """
+        self.filename = filename
+        self.format = 'plain'
+        self.level = 0
+        self.error = None
+        self.queue = Queue.Queue(MAX_QUEUED)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """Writes the queued data into the pipe until None is queued"""
+        data = ''
+        try:
+            #the data is not buffered, a reader waiting for the reads of
+            #this pipe while the other one is full would never get them
+            handle = open(self.filename, 'wb', 0)
+            #processes started by the reader, e.g. samtools after bowtie2,
+            #must not keep the pipe open, the reader would not see its end
+            fcntl.fcntl(handle.fileno(), fcntl.F_SETFD,
+                        fcntl.fcntl(handle.fileno(), fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            try:
+                while data is not None:
+                    data = self.queue.get()
+                    if data is not None:
+                        handle.write(data)
+            finally:
+                handle.close()
+        except (IOError, OSError) as error:
+            #the reader stopped, the rest of the data is dropped
+            self.error = error
+            while data is not None:
+                data = self.queue.get()
+
+    def write(self, data):
+        """Writes data
+
+        :Parameter data: string
+        """
+        if self.error is not None:
+            raise IOError('Could not write '+self.filename+': '+str(self.error))
+        self.queue.put(data)
+
+    def close(self, abort=False):
+        """Waits until the data is written and closes the pipe
+
+        :Parameter abort: the data was not written completely, which is not
+                          an error of the pipe
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if not abort and self.error is not None:
+            raise IOError('Could not write '+self.filename+': '+str(self.error))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        self.close(abort=error_type is not None)
+
+def get_writer(filename, threads=1, level=''):
+    """Writer of a file, a PipeWriter for a named pipe and a Writer otherwise
+
+    :Parameter filename: file name
+    :Parameter threads: number of compression threads
+    :Parameter level: compression level
+    """
+    if is_fifo(filename):
+        return PipeWriter(filename)
+    return Writer(filename, threads, level)
+
+def test_file(filename, threads=1):
+    """Checks the integrity of a compressed file by decompressing it, plain
+    files have no checksum and always pass
+
+    :Parameter filename: fastq file
+    :Parameter threads: number of threads
+    :return parameter: True if the file is complete
+    """
+    if get_codec(filename) == 'plain':
+        return True
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(get_decompress_command(filename, threads)+[filename],
+                                   stdout=devnull,
+                                   stderr=devnull)
+        process.wait()
+    return process.returncode == 0
+
+def make_fifos(fifo_dir, count):
+    """Creates named pipes, replacing the pipes of a previous run
+
+    :Parameter fifo_dir: directory of the pipes
+    :Parameter count: number of pipes
+    :return parameter: names of the pipes
+    """
+    fifos = []
+    for idx in range(count):
+        fifo = fifo_dir+'reads_'+str(idx+1)+'.fastq'
+        if os.path.exists(fifo):
+            os.remove(fifo)
+        os.mkfifo(fifo)
+        fifos.append(fifo)
+    return fifos
+
+def release_fifos(fifos):
+    """Opens and closes named pipes for reading, so a writer that waits for
+    a reader that stopped, or never started, gets a broken pipe
+
+    :Parameter fifos: names of the pipes
+    """
+    for fifo in fifos:
+        try:
+            os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+        except OSError:
+            pass
+
+def end_fifos(fifos):
+    """Closes named pipes without writing to them, so a reader that waits
+    for them, or opens them later, gets their end instead of waiting forever
+
+    :Parameter fifos: names of the pipes
+    """
+    writers = [PipeWriter(fifo) for fifo in fifos]
+    for writer in writers:
+        writer.close(abort=True)
+
+class PipeFeeder(object):
+    """Decompresses a file into a named pipe. The process is started by a
+    thread once a reader opened the pipe, so no data is lost in a pipe that
+    was never read and the process gets a broken pipe if the reader stops.
+    """
+
+    def __init__(self, filename, fifo, threads=1):
+        """Starts the thread, which waits for the reader of the pipe
+
+        :Parameter filename: compressed file
+        :Parameter fifo: name of the pipe
+        :Parameter threads: number of decompression threads
+        """
+        self.fifo = fifo
+        self.command = get_decompress_command(filename, threads)+[filename]
+        self.process = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """Opens the pipe for writing and starts the decompression"""
+        try:
+            handle = open(self.fifo, 'wb', 0)
+        except (IOError, OSError):
+            return
+        try:
+            #the reader, e.g. bowtie2, must not keep its own pipe open
+            fcntl.fcntl(handle.fileno(), fcntl.F_SETFD,
+                        fcntl.fcntl(handle.fileno(), fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            self.process = subprocess.Popen(self.command,
+                                            stdout=handle,
+                                            close_fds=True,
+                                            preexec_fn=restore_sigpipe)
+        except OSError:
+            pass
+        finally:
+            handle.close()
+
+    def wait(self, abort=False):
+        """Waits for the process, a pipe that the reader never opened is
+        released, which stops the process with a broken pipe
+
+        :Parameter abort: the reader stopped before the end of the file,
+                          which terminates the process
+        :return parameter: True if the file was decompressed completely
+        """
+        self.thread.join(1)
+        while self.thread.is_alive():
+            release_fifos([self.fifo])
+            self.thread.join(1)
+        if self.process is None:
+            return False
+        success = True
+        if abort and self.process.poll() is None:
+            self.process.terminate()
+            success = False
+        self.process.wait()
+        return success and self.process.returncode == 0
+
+def restore_sigpipe():
+    """Python ignores SIGPIPE, which is inherited by its child processes,
+    a decompression process should stop as soon as its reader stopped
+    """
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+def open_fifos(filenames, fifo_dir, threads=1):
+    """Decompresses files into named pipes, for tools that read plain fastq
+    files but decompress gzipped files with a single thread or cannot read
+    zstd files
+
+    :Parameter filenames: compressed files
+    :Parameter fifo_dir: directory of the pipes
+    :Parameter threads: number of decompression threads per file
+    :return parameter: tuple of the names of the pipes and their PipeFeeders
+    """
+    fifos = make_fifos(fifo_dir, len(filenames))
+    feeders = [PipeFeeder(filenames[idx], fifos[idx], threads)
+               for idx in range(len(filenames))]
+    return fifos, feeders
+
+def close_fifos(fifos, feeders, abort=False):
+    """Waits for the PipeFeeders of open_fifos and removes the pipes
+
+    :Parameter fifos: names of the pipes
+    :Parameter feeders: PipeFeeders of the pipes
+    :Parameter abort: the reader stopped before the end of the files, which
+                      terminates the processes
+    :return parameter: True if all files were decompressed completely
+    """
+    success = True
+    for feeder in feeders:
+        success = feeder.wait(abort) and success
+    for fifo in fifos:
+        if os.path.exists(fifo):
+            os.remove(fifo)
+    return success
+
+def main():
+    """Decompresses a file to stdout"""
+    threads = 1
+    optlist, args = getopt.getopt(sys.argv[1:], '@:')
+    for opt in optlist:
+        if opt[0] == '-@':
+            threads = int(opt[1])
+    if len(args) != 1:
+        print __doc__
+        sys.exit(1)
+    reader = Reader(args[0], threads)
+    try:
+        while True:
+            data = reader.read_data()
+            if data == '':
+                break
+            sys.stdout.write(data)
+    except IOError as error:
+        reader.close(abort=True)
+        sys.stderr.write(str(error)+'\n')
+        sys.exit(1)
+    reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Fastq stats module
+QC statistics of fastq files that are collected while the reads are
+trimmed (see qc_trim), and written as the summary.txt, fastqc_data.txt and
+fastqc_report.html files of FastQC, so the fastqc reports and the QC
+filter work on them as well. The statistics of a chunk of reads are
+counted with numpy by get_stats and added up by add_stats.
+
+The modules and the PASS/WARN/FAIL limits follow the defaults of FastQC,
+with these differences:
+- the overrepresented sequences are counted in the first
+  OVERREPRESENTED_READS reads of a file
+- the k-mers are counted in every KMER_SAMPLE-th read and a k-mer is
+  reported if its count at a position is at least KMER_MIN_COUNT and
+  KMER_WARN times higher than expected from its overall count
+- there are no per tile, duplication and adapter content modules
+"""
+import cgi
+import os
+import numpy as np
+
+#the overrepresented sequences are counted in the first reads of a file
+OVERREPRESENTED_READS = 100000
+#sequences longer than 75 bases are truncated to 50 bases, as in FastQC
+OVERREPRESENTED_LENGTH = 50
+
+#k-mer statistics
+KMER_LENGTH = 7
+KMER_SAMPLE = 50
+KMER_MIN_COUNT = 20
+
+#limits of FastQC, tuples of the warning and the failure limit
+QUALITY_LOWER_QUARTILE = (10, 5)
+QUALITY_MEDIAN = (25, 20)
+QUALITY_SEQUENCE = (27, 20)
+BASE_CONTENT = (10, 20)
+GC_DEVIATION = (15, 30)
+N_CONTENT = (5, 20)
+OVERREPRESENTED = (0.1, 1)
+KMER_WARN = 5
+KMER_FAIL = 10
+
+#bases are counted in the order A, C, G, T, N
+BASE_CODES = np.full(256, 4, dtype=np.int64)
+for IDX, BASE in enumerate('ACGT'):
+    BASE_CODES[ord(BASE)] = IDX
+    BASE_CODES[ord(BASE.lower())] = IDX
+
+def new_stats():
+    """Empty statistics of a file"""
+    stats = dict()
+    stats['reads'] = 0
+    #counts of the quality characters (not scores) per position
+    stats['quality'] = np.zeros((0, 128), dtype=np.int64)
+    #counts of A, C, G, T, N per position
+    stats['bases'] = np.zeros((0, 5), dtype=np.int64)
+    stats['gc'] = np.zeros(101, dtype=np.int64)
+    #counts of the mean quality character of the reads
+    stats['mean_quality'] = np.zeros(128, dtype=np.int64)
+    stats['lengths'] = np.zeros(0, dtype=np.int64)
+    stats['sequences'] = dict()
+    stats['counted_sequences'] = 0
+    #counts of the k-mers per position
+    stats['kmers'] = np.zeros((4**KMER_LENGTH, 0), dtype=np.int64)
+    return stats
+
+def add_padded(total, array):
+    """Sum of two arrays of counts, the smaller one is padded with zeros
+
+    :Parameter total: numpy array
+    :Parameter array: numpy array with the same number of dimensions
+    """
+    shape = tuple([max(total.shape[idx], array.shape[idx]) for idx in range(total.ndim)])
+    if total.shape != shape:
+        total = np.pad(total, [(0, shape[idx]-total.shape[idx]) for idx in range(total.ndim)],
+                       'constant')
+    total[tuple([slice(0, size) for size in array.shape])] += array
+    return total
+
+def get_stats(sequences, qualities, first_read):
+    """Statistics of a chunk of reads, the k-mers are stored as a tuple of
+    the k-mer codes, positions and counts until they are added to the
+    statistics of the file
+
+    :Parameter sequences: sequences of the reads
+    :Parameter qualities: quality strings of the reads
+    :Parameter first_read: number of the first read in the file
+    """
+    stats = new_stats()
+    stats['reads'] = len(sequences)
+    if len(sequences) == 0:
+        stats['kmers'] = (np.zeros(0, dtype=np.int64),)*3
+        return stats
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    max_length = max(int(lengths.max()), 1)
+    bases = np.frombuffer(''.join([sequence.ljust(max_length, '\0')
+                                   for sequence in sequences]),
+                          dtype=np.uint8).reshape(len(sequences), max_length)
+    quals = np.frombuffer(''.join([quality.ljust(max_length, '\0')
+                                   for quality in qualities]),
+                          dtype=np.uint8).reshape(len(sequences), max_length)
+    inside = np.arange(max_length) < lengths[:, None]
+    positions = np.broadcast_to(np.arange(max_length), bases.shape)
+    codes = BASE_CODES[bases]
+
+    stats['quality'] = np.bincount(positions[inside]*128+np.minimum(quals[inside], 127),
+                                   minlength=max_length*128).reshape(max_length, 128)
+    stats['bases'] = np.bincount(positions[inside]*5+codes[inside],
+                                 minlength=max_length*5).reshape(max_length, 5)
+    stats['lengths'] = np.bincount(lengths)
+
+    #GC content of the called bases and mean quality of every read
+    called = ((codes < 4) & inside).sum(axis=1)
+    gc_bases = (((codes == 1) | (codes == 2)) & inside).sum(axis=1)
+    gc_content = np.round(100.0*gc_bases/np.maximum(called, 1)).astype(np.int64)
+    stats['gc'] = np.bincount(gc_content[called > 0], minlength=101)
+    quality_sum = np.where(inside, quals, 0).sum(axis=1).astype(np.int64)
+    mean_quality = np.minimum(quality_sum//np.maximum(lengths, 1), 127)
+    stats['mean_quality'] = np.bincount(mean_quality[lengths > 0], minlength=128)
+
+    #sequences of the first reads of the file
+    counted = max(0, min(len(sequences), OVERREPRESENTED_READS-first_read))
+    for sequence in sequences[:counted]:
+        if len(sequence) > 75:
+            sequence = sequence[:OVERREPRESENTED_LENGTH]
+        stats['sequences'][sequence] = stats['sequences'].get(sequence, 0)+1
+    stats['counted_sequences'] = counted
+
+    #k-mers of a sample of the reads, a k-mer with an N is skipped
+    sample = np.arange((-first_read) % KMER_SAMPLE, len(sequences), KMER_SAMPLE)
+    stats['kmers'] = get_kmers(codes[sample], lengths[sample])
+    return stats
+
+def get_kmers(codes, lengths):
+    """Counts of the k-mers per position
+
+    :Parameter codes: base codes of the reads (0-3, 4 for N)
+    :Parameter lengths: lengths of the reads
+    :return parameter: tuple of the k-mer codes, positions and counts
+    """
+    num_positions = codes.shape[1]-KMER_LENGTH+1
+    if len(lengths) == 0 or num_positions <= 0:
+        return (np.zeros(0, dtype=np.int64),)*3
+    kmers = np.zeros((len(lengths), num_positions), dtype=np.int64)
+    valid = np.arange(num_positions)+KMER_LENGTH <= lengths[:, None]
+    for offset in range(KMER_LENGTH):
+        part = codes[:, offset:offset+num_positions]
+        valid &= part < 4
+        kmers = kmers*4+np.minimum(part, 3)
+    positions = np.broadcast_to(np.arange(num_positions), kmers.shape)
+    keys, counts = np.unique(kmers[valid]*num_positions+positions[valid],
+                             return_counts=True)
+    return keys//num_positions, keys % num_positions, counts
+
+def add_stats(total, stats):
+    """Adds the statistics of a chunk to the statistics of a file
+
+    :Parameter total: statistics of the file, see new_stats
+    :Parameter stats: statistics of a chunk, see get_stats
+    :return parameter: statistics of the file
+    """
+    total['reads'] += stats['reads']
+    for key in ['quality', 'bases', 'gc', 'mean_quality', 'lengths']:
+        total[key] = add_padded(total[key], stats[key])
+    for sequence, count in stats['sequences'].iteritems():
+        total['sequences'][sequence] = total['sequences'].get(sequence, 0)+count
+    total['counted_sequences'] += stats['counted_sequences']
+    kmers, positions, counts = stats['kmers']
+    if len(counts) > 0:
+        total['kmers'] = add_padded(total['kmers'],
+                                    np.zeros((4**KMER_LENGTH, positions.max()+1),
+                                             dtype=np.int64))
+        np.add.at(total['kmers'], (kmers, positions), counts)
+    return total
+
+def get_status(value, limits, higher_is_worse=True):
+    """PASS, WARN or FAIL
+
+    :Parameter value: value of the statistic
+    :Parameter limits: tuple of the warning and the failure limit
+    :Parameter higher_is_worse: values above the limits fail, otherwise below
+    """
+    if not higher_is_worse:
+        value, limits = -value, (-limits[0], -limits[1])
+    if value > limits[1]:
+        return 'FAIL'
+    if value > limits[0]:
+        return 'WARN'
+    return 'PASS'
+
+def get_percentile(counts, fraction):
+    """Value at a percentile of a histogram
+
+    :Parameter counts: numpy array of the counts of every value
+    :Parameter fraction: percentile between 0 and 1
+    """
+    total = counts.sum()
+    if total == 0:
+        return 0
+    return int(np.searchsorted(np.cumsum(counts), fraction*total))
+
+def get_offset(stats):
+    """Quality offset and the name of the encoding, as FastQC guesses them
+    from the lowest quality character
+
+    :Parameter stats: statistics of a file
+    """
+    used = np.nonzero(stats['quality'].sum(axis=0))[0]
+    if len(used) > 0 and used[0] < 64:
+        return 33, 'Sanger / Illumina 1.9'
+    return 64, 'Illumina 1.5'
+
+def format_number(value):
+    """Number as written by FastQC"""
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+def get_modules(stats, filename):
+    """Status and table of every module
+
+    :Parameter stats: statistics of a file
+    :Parameter filename: name of the fastq file
+    :return parameter: list of tuples with the name, status, header and rows
+    """
+    offset, encoding = get_offset(stats)
+    modules = []
+    total = max(stats['reads'], 1)
+    lengths = np.nonzero(stats['lengths'])[0]
+    if len(lengths) == 0:
+        lengths = np.zeros(1, dtype=np.int64)
+    bases = stats['bases']
+    called = bases[:, :4].sum()
+    gc_total = int(round(100.0*bases[:, 1:3].sum()/called)) if called > 0 else 0
+
+    #basic statistics
+    length_text = str(lengths[0])
+    if lengths[-1] != lengths[0]:
+        length_text += '-'+str(lengths[-1])
+    modules.append(('Basic Statistics', 'PASS', ['Measure', 'Value'],
+                    [['Filename', filename],
+                     ['File type', 'Conventional base calls'],
+                     ['Encoding', encoding],
+                     ['Total Sequences', stats['reads']],
+                     ['Filtered Sequences', 0],
+                     ['Sequence length', length_text],
+                     ['%GC', gc_total]]))
+
+    #quality per position
+    rows = []
+    lower_quartile = []
+    median = []
+    for pos in range(stats['quality'].shape[0]):
+        counts = stats['quality'][pos]
+        scores = np.arange(len(counts))-offset
+        number = max(counts.sum(), 1)
+        percentiles = [get_percentile(counts, fraction)-offset
+                       for fraction in [0.5, 0.25, 0.75, 0.1, 0.9]]
+        rows.append([pos+1, float((counts*scores).sum())/number]+percentiles)
+        median.append(percentiles[0])
+        lower_quartile.append(percentiles[1])
+    status = max_status([get_status(min(lower_quartile or [0]), QUALITY_LOWER_QUARTILE, False),
+                         get_status(min(median or [0]), QUALITY_MEDIAN, False)])
+    modules.append(('Per base sequence quality', status,
+                    ['Base', 'Mean', 'Median', 'Lower Quartile', 'Upper Quartile',
+                     '10th Percentile', '90th Percentile'], rows))
+
+    #mean quality of the reads
+    counts = stats['mean_quality']
+    scores = np.nonzero(counts)[0]
+    rows = [[score-offset, counts[score]] for score in scores]
+    mode = int(np.argmax(counts))-offset if len(scores) > 0 else 0
+    modules.append(('Per sequence quality scores',
+                    get_status(mode, QUALITY_SEQUENCE, False),
+                    ['Quality', 'Count'], rows))
+
+    #base content per position
+    rows = []
+    difference = 0.0
+    for pos in range(bases.shape[0]):
+        number = max(bases[pos, :4].sum(), 1)
+        percent = 100.0*bases[pos, :4]/number
+        rows.append([pos+1, percent[2], percent[0], percent[3], percent[1]])
+        difference = max(difference, abs(percent[0]-percent[3]), abs(percent[1]-percent[2]))
+    modules.append(('Per base sequence content', get_status(difference, BASE_CONTENT),
+                    ['Base', 'G', 'A', 'T', 'C'], rows))
+
+    #GC content of the reads compared to a normal distribution
+    counts = stats['gc'].astype(np.float64)
+    number = counts.sum()
+    deviation = 0.0
+    if number > 0:
+        values = np.arange(len(counts))
+        mean = (counts*values).sum()/number
+        stdev = max(np.sqrt((counts*(values-mean)**2).sum()/number), 1.0)
+        expected = np.exp(-(values-mean)**2/(2*stdev**2))
+        expected *= number/expected.sum()
+        deviation = 100.0*np.abs(counts-expected).sum()/number
+    modules.append(('Per sequence GC content', get_status(deviation, GC_DEVIATION),
+                    ['GC Content', 'Count'],
+                    [[idx, stats['gc'][idx]] for idx in range(len(stats['gc']))]))
+
+    #N content per position
+    rows = []
+    n_content = 0.0
+    for pos in range(bases.shape[0]):
+        percent = 100.0*bases[pos, 4]/max(bases[pos].sum(), 1)
+        rows.append([pos+1, percent])
+        n_content = max(n_content, percent)
+    modules.append(('Per base N content', get_status(n_content, N_CONTENT),
+                    ['Base', 'N-Count'], rows))
+
+    #read lengths
+    status = 'PASS'
+    if len(lengths) > 1:
+        status = 'WARN'
+    if stats['lengths'][:1].sum() > 0:
+        status = 'FAIL'
+    modules.append(('Sequence Length Distribution', status, ['Length', 'Count'],
+                    [[length, stats['lengths'][length]] for length in lengths]))
+
+    #overrepresented sequences
+    counted = max(stats['counted_sequences'], 1)
+    rows = [[sequence, count, 100.0*count/counted, 'No Hit']
+            for sequence, count in stats['sequences'].iteritems()
+            if 100.0*count/counted > OVERREPRESENTED[0]]
+    rows.sort(key=lambda row: -row[1])
+    modules.append(('Overrepresented sequences',
+                    get_status(max([row[2] for row in rows] or [0]), OVERREPRESENTED),
+                    ['Sequence', 'Count', 'Percentage', 'Possible Source'], rows))
+
+    modules.append(get_kmer_module(stats))
+    return modules
+
+def get_kmer_module(stats):
+    """K-mers that are enriched at a position
+
+    :Parameter stats: statistics of a file
+    """
+    kmers = stats['kmers']
+    rows = []
+    if kmers.size > 0:
+        position_totals = kmers.sum(axis=0).astype(np.float64)
+        kmer_totals = kmers.sum(axis=1).astype(np.float64)
+        expected = np.outer(kmer_totals/max(kmer_totals.sum(), 1), position_totals)
+        ratio = np.where(kmers >= KMER_MIN_COUNT, kmers/np.maximum(expected, 1e-9), 0)
+        max_ratio = ratio.max(axis=1)
+        for code in np.nonzero(max_ratio > KMER_WARN)[0]:
+            kmer = ''.join(['ACGT'[(code >> 2*(KMER_LENGTH-1-idx)) & 3]
+                            for idx in range(KMER_LENGTH)])
+            overall = kmer_totals[code]*len(kmer_totals)/kmer_totals.sum()
+            rows.append([kmer, int(kmer_totals[code]*KMER_SAMPLE), overall,
+                         max_ratio[code], int(np.argmax(ratio[code]))+1])
+    rows.sort(key=lambda row: -row[3])
+    status = 'PASS'
+    if len(rows) > 0:
+        status = 'FAIL' if rows[0][3] > KMER_FAIL else 'WARN'
+    return ('Kmer Content', status,
+            ['Sequence', 'Count', 'Obs/Exp Overall', 'Obs/Exp Max', 'Max Obs/Exp Position'],
+            rows)
+
+def max_status(statuses):
+    """Worst of a list of PASS, WARN and FAIL"""
+    for status in ['FAIL', 'WARN']:
+        if status in statuses:
+            return status
+    return 'PASS'
+
+def write_fastqc(stats, filename, out_dir):
+    """Writes the statistics of a file in the format of FastQC
+
+    :Parameter stats: statistics of a file
+    :Parameter filename: name of the fastq file
+    :Parameter out_dir: output directory, e.g. results/fastqc/stub/file_fastqc
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    modules = get_modules(stats, filename)
+
+    handle = open(out_dir+'/summary.txt', 'w')
+    for name, status, _, _ in modules:
+        handle.write(status+'\t'+name+'\t'+filename+'\n')
+    handle.close()
+
+    handle = open(out_dir+'/fastqc_data.txt', 'w')
+    handle.write('##FastQC\tbuiltin\n')
+    for name, status, header, rows in modules:
+        handle.write('>>'+name+'\t'+status.lower()+'\n')
+        handle.write('#'+'\t'.join(header)+'\n')
+        for row in rows:
+            handle.write('\t'.join([format_number(value) for value in row])+'\n')
+        handle.write('>>END_MODULE\n')
+    handle.close()
+
+    handle = open(out_dir+'/fastqc_report.html', 'w')
+    handle.write('<html><head><title>'+cgi.escape(filename)+
+                 ' QC report</title></head><body>\n')
+    handle.write('<h1>'+cgi.escape(filename)+'</h1>\n')
+    for idx in range(len(modules)):
+        name, status, header, rows = modules[idx]
+        handle.write('<h2 id="M'+str(idx)+'">'+name+' ('+status+')</h2>\n<table>\n')
+        handle.write('<tr>'+''.join(['<th>'+cgi.escape(column)+'</th>'
+                                     for column in header])+'</tr>\n')
+        for row in rows:
+            handle.write('<tr>'+''.join(['<td>'+cgi.escape(format_number(value))+'</td>'
+                                         for value in row])+'</tr>\n')
+        handle.write('</table>\n')
+    handle.write('</body></html>\n')
+    handle.close()
@@ -27,6 +27,26 @@ import pylab
 from hydra_pkg import helper as HELPER
 from hydra_pkg import module_helper as MODULE_HELPER
 
+#parameters the results of this module depend on, see cache.py
+CACHE_PARAMETERS = ['fastqc_exec', 'paired']
+
+#formats of the fastq files this module reads, see fastq_io.negotiate_format
+#fastqc does not read zstd files
+INPUT_FORMATS = ['gzip', 'plain']
+
+#extensions fastqc removes from the file name in this order, before adding _fastqc
+FASTQC_EXTENSIONS = ['.gz', '.bz2', '.txt', '.fastq', '.fq']
+
+def get_fastqc_name(filename):
+    """Name of the directory fastqc writes the results of a file into
+
+    :Parameter filename: fastq file
+    """
+    name = filename.split('/')[-1]
+    for extension in FASTQC_EXTENSIONS:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return name+'_fastqc'
 
 
 def remove_failed(param, input_files):
@@ -42,6 +62,25 @@ def remove_failed(param, input_files):
             if param['stub'][idx] in failed:
                 param['run_log'][-1][idx] = False
 
+def sample_failed(param):
+    """Checks the fastqc results of the working files of a single sample,
+    which applies the QC filter on every sample separately
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :return parameter: True if the sample did not pass the QC
+    """
+    fqc_dir = param['working_dir']+'results/fastqc/'
+    filenames = [param['working_file']]
+    if param['paired'] and 'working_file2' in param:
+        filenames.append(param['working_file2'])
+    param['fastqc_stub'] = [param['outstub']+'/'+get_fastqc_name(filename)
+                            for filename in filenames]
+    #a sample without fastqc results did not finish the QC
+    for fastqc_stub in param['fastqc_stub']:
+        if not os.path.exists(fqc_dir+fastqc_stub+'/summary.txt'):
+            return True
+    return len(get_faulty_samples(param, fqc_dir)) > 0
+
 def get_faulty_samples(param, fqc_dir):
     #extract the names of samples that did not pass the sequence quality check
     overview = []
@@ -61,16 +100,12 @@ def get_samples_to_copy(param, input_files):
     param['fastqc_stub'] = []
 
     for stb, filename in zip(param['stub'], param[input_files]):
-        param['fastqc_stub'].append(stb+'/'+filename.split('/')[-1])
+        param['fastqc_stub'].append(stb+'/'+get_fastqc_name(filename))
 
     if param['paired']:
         for stb, filename in zip(param['stub'], param[input_files+'2']):
-            param['fastqc_stub'].append(stb+'/'+filename.split('/')[-1])
+            param['fastqc_stub'].append(stb+'/'+get_fastqc_name(filename))
 
-    #fix the suffix
-    for idx in range(len(param['fastqc_stub'])):
-        param['fastqc_stub'][idx] = param['fastqc_stub'][idx].replace('.fastq.gz',
-                                                                      '_fastqc')
     #use only the files that exist
     fqc_dir = param['working_dir']+'results/fastqc/'
     param['fastqc_stub'] = [fn for fn in param['fastqc_stub'] if os.path.exists(fqc_dir+fn)]
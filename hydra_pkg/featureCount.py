@@ -21,9 +21,16 @@ a wrapper that calls an R script
 
 from hydra_pkg import module_helper as MODULE_HELPER
 from hydra_pkg import helper as HELPER
+from hydra_pkg import count_matrix as COUNT_MATRIX
 import os
 import re
 import subprocess
+import numpy as np
+
+#parameters the results of this module depend on, see cache.py
+CACHE_PARAMETERS = ['featureCount_exec', 'featureCount_t', 'featureCount_id',
+                    'featureCount_by_meta', 'genome_annotation_gft', 'stranded',
+                    'paired']
 
 
 
@@ -121,108 +128,67 @@ def finalize(param, input_files='count_files'):
     :Parameter input_files: flag that indicates the input files
     """
 
-    import csv
     HELPER.writeLog('Collecting featureCount raw counts ... \n', param)
 
     #check which of these files are actually available
     working_files = [iFile for iFile in param[input_files] if iFile != '']
 
     if len(working_files) > 0:
-        #get feature ID using the first column in the first file in the list of working files
-        csv_file = open(working_files[0])
-        csv_reader = csv.reader(csv_file, delimiter='\t')
-
+        samples = [param['stub'][idx] for idx in range(param['num_samples'])
+                   if param[input_files][idx] != '']
         #For featureCount output, we want to skip the first two lines as they
-         #include the featureCount call and the headers which we don't want
-        next(csv_reader, None)
-        next(csv_reader, None)
-
-        #Now start by taking the list of identifier,
-        #which is the first column in the file
-        counts = [row[0] for row in csv_reader]
-        csv_file.close()
-
-        #get all the expression values
-        header = 'ID'
-        for idx in range(param['num_samples']):
-            if param[input_files] != '':
-                header = header+'\t'+param['stub'][idx]
-                csv_file = open(param[input_files][idx])
-                csv_reader = csv.reader(csv_file, delimiter='\t')
-
-                #Here too we want to skip the first two lines, before getting the counts
-                next(csv_reader, None)
-                next(csv_reader, None)
-                #Now start getting the counts (row[6]) and add in the ID (counts[i]) before it
-                idx = 0
-                for row in csv_reader:
-                    counts[idx] = counts[idx]+'\t'+row[6]
-                    idx += 1
-                csv_file.close()
-
-        #output the file
-        out_file = param['working_dir']+'deliverables/featureCount_raw_counts.txt'
-        out_handle = open(out_file, 'w')
-        out_handle.write(header+'\n')
-
-        for i in range(len(counts)):
-            out_handle.write(counts[i]+'\n')
-        out_handle.close()
+        #include the featureCount call and the headers which we don't want,
+        #the counts are in the 7th column. Next to the text file the counts are
+        #written into a binary matrix.
+        try:
+            updated = COUNT_MATRIX.update_matrix(samples,
+                                                 working_files,
+                                                 ['ID'],
+                                                 [0],
+                                                 [6],
+                                                 param['working_dir']+
+                                                 'deliverables/featureCount_raw_counts.txt',
+                                                 param['working_dir']+
+                                                 'results/featureCount/'+
+                                                 'featureCount_raw_counts.json',
+                                                 skip_lines=2,
+                                                 incremental=param['incremental_count_matrix'],
+                                                 binary_file=(param['working_dir']+
+                                                              'deliverables/'+
+                                                              'featureCount_raw_counts.npz'),
+                                                 dtype=np.int32)
+        except ValueError as error:
+            HELPER.writeLog('ERROR: The featureCount counts could not be merged: '+
+                            str(error)+'\n', param)
+            return
+        if not updated:
+            HELPER.writeLog('The featureCount raw counts are up to date.\n', param)
 
         #output_phenotype_file
         HELPER.writeLog('Writing phenotype data ... \n', param)
         MODULE_HELPER.output_sample_info(param)
 
         #write summary stats
-        #featureCount does this on its own so we can just fetch each summary file
-        #check which of these files are actually available
-        working_files = [iFile+'.summary' for iFile in param[input_files] if iFile != '']
-
-        if len(working_files) > 0:
-            #get Status column from summary file using the first column in
-            #the first file in the list of working files
-            csv_file = open(working_files[0])
-            csv_reader = csv.reader(csv_file, delimiter='\t')
-            #Here, we want to skip the first line, as it simply points to the
-            #alignment file used when running featureCount
-            next(csv_reader, None)
-
-            #Now start by taking the list of identifier,
-            #which is the first column in the file
-            entry = [row[0] for row in csv_reader]
-            csv_file.close()
-
-            #get all the summary stats for each sample
-            header = 'Status'
-
-            for idx in range(param['num_samples']):
-                if param[input_files] != '':
-                    header = header+'\t'+param['stub'][idx]
-                    #Fetch the corresponding sample's summary file
-                    csv_file = open(param[input_files][idx]+'.summary')
-                    csv_reader = csv.reader(csv_file, delimiter='\t')
-                    #Again, we want to skip the first line, as it simply points
-                    #to the alignment file used when running featureCount
-                    next(csv_reader, None)
-
-                    #Now start getting the stats (row[1]) and add in the Status
-                    # (counts[i]) before it
-                    i = 0
-                    for row in csv_reader:
-                        entry[i] = entry[i]+'\t'+row[1]
-                        i += 1
-                    csv_file.close()
-            #output the file
-            out_handle = open(param['working_dir']+
-                              'results/featureCount/featureCount_stats.txt',
-                              'w')
-            out_handle.write(header+'\n')
-
-            for i in range(len(entry)):
-                out_handle.write(entry[i]+'\n')
-            out_handle.close()
-        else:
-            print 'featureCount was not run successfully on any of the files..\n'
+        #featureCount does this on its own so we can just fetch each summary
+        #file, skipping the first line, as it simply points to the alignment
+        #file used when running featureCount
+        try:
+            COUNT_MATRIX.update_matrix(samples,
+                                       [iFile+'.summary' for iFile in working_files],
+                                       ['Status'],
+                                       [0],
+                                       [1],
+                                       param['working_dir']+
+                                       'results/featureCount/featureCount_stats.txt',
+                                       param['working_dir']+
+                                       'results/featureCount/featureCount_stats.json',
+                                       skip_lines=1,
+                                       incremental=param['incremental_count_matrix'])
+        except ValueError as error:
+            HELPER.writeLog('ERROR: The featureCount summaries could not be merged: '+
+                            str(error)+'\n', param)
+    else:
+        print 'featureCount was not run successfully on any of the files..\n'
 
 
 
@@ -0,0 +1,454 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Gene counts module
+Built-in gene level counting that follows htseq-count, so the counts can be
+collected while the bam file is read for other purposes, e.g. the bamqc
+statistics. The annotation is turned into steps along every chromosome (and
+strand), where every step holds the genes that overlap it. A read is assigned
+to the genes of the steps its aligned blocks overlap, using the same modes
+(union, intersection-strict, intersection-nonempty) as htseq-count. The
+output has the htseq-count format with the 5 summary lines at the end.
+
+Pairs are counted once, the mates are matched by name and position, so both
+coordinate and name sorted files are supported.
+
+The steps of all chromosomes are kept in flat numpy arrays, which are built
+once per run into the annotation cache (annotation_cache, by default
+working_dir/annotation_cache/), in a directory named after the path,
+size and modification time of the gtf file and the counting parameters. The
+jobs of every sample memory map these arrays instead of parsing the gtf file
+again.
+"""
+import bisect
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+#htseq-count skips reads with a lower mapping quality by default
+MIN_QUALITY = 10
+
+#CIGAR operations that are part of the alignment or only move along the reference
+ALIGNED_OPERATIONS = [0, 7, 8]
+REFERENCE_OPERATIONS = [2, 3]
+
+#summary lines of htseq-count in the order they are written
+SPECIAL_COUNTS = ['__no_feature', '__ambiguous', '__too_low_aQual',
+                  '__not_aligned', '__alignment_not_unique']
+
+def get_attribute(attributes, name):
+    """Value of an attribute in the last column of a gtf file
+
+    :Parameter attributes: last column of the gtf line
+    :Parameter name: name of the attribute, e.g. gene_id
+    """
+    for attribute in attributes.split(';'):
+        attribute = attribute.strip()
+        if attribute.startswith(name+' '):
+            return attribute[len(name)+1:].strip().strip('"')
+    return None
+
+def read_features(gtf_file, feature_type, id_attribute):
+    """Reads all features of a type from a gtf file
+
+    :Parameter gtf_file: annotation file
+    :Parameter feature_type: feature type that is counted, e.g. exon
+    :Parameter id_attribute: attribute that names the feature, e.g. gene_id
+    :return parameter: list of (chromosome, strand, start, end, id) with 0
+                       based, half open coordinates
+    """
+    features = []
+    handle = open(gtf_file)
+    for line in handle:
+        if line.startswith('#'):
+            continue
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 9 or fields[2] != feature_type:
+            continue
+        feature_id = get_attribute(fields[8], id_attribute)
+        if feature_id is None:
+            continue
+        features.append((fields[0], fields[6], int(fields[3])-1, int(fields[4]),
+                         feature_id))
+    handle.close()
+    return features
+
+def build_steps(intervals):
+    """Steps along a chromosome with the features that overlap them
+
+    :Parameter intervals: list of (start, end, id)
+    :return parameter: tuple of the sorted step boundaries and the set of ids
+                       for every step, the last boundary closes the last step
+    """
+    positions = sorted(set([start for start, _, _ in intervals]+
+                           [end for _, end, _ in intervals]))
+    steps = [set() for _ in positions]
+    for start, end, feature_id in intervals:
+        idx = bisect.bisect_left(positions, start)
+        while positions[idx] < end:
+            steps[idx].add(feature_id)
+            idx += 1
+    return positions, steps
+
+def get_strand_key(strand, stranded):
+    """Strand under which features and reads are looked up
+
+    :Parameter strand: + or -
+    :Parameter stranded: no, yes or reverse(d)
+    """
+    if stranded == 'no':
+        return '.'
+    return strand
+
+def build_index(gtf_file, feature_type, id_attribute, stranded):
+    """Builds the steps of all chromosomes from the annotation
+
+    :Parameter gtf_file: annotation file
+    :Parameter feature_type: feature type that is counted, e.g. exon
+    :Parameter id_attribute: attribute that names the feature, e.g. gene_id
+    :Parameter stranded: no, yes or reverse(d)
+    :return parameter: dictionary with the sorted feature ids, the step
+                       boundaries of all (chromosome, strand) one after the
+                       other, and for every step the offset of its feature
+                       numbers in step_features
+    """
+    intervals = dict()
+    ids = set()
+    for chrom, strand, start, end, feature_id in read_features(gtf_file,
+                                                               feature_type,
+                                                               id_attribute):
+        ids.add(feature_id)
+        key = (chrom, get_strand_key(strand, stranded))
+        intervals.setdefault(key, []).append((start, end, feature_id))
+    ids = sorted(ids)
+    numbers = dict([(ids[idx], idx) for idx in range(len(ids))])
+
+    index = dict()
+    index['ids'] = ids
+    index['keys'] = dict()
+    positions = []
+    step_offsets = [0]
+    step_features = []
+    for key in sorted(intervals.keys()):
+        key_positions, steps = build_steps(intervals[key])
+        index['keys'][key] = (len(positions), len(positions)+len(key_positions))
+        positions += key_positions
+        for step in steps:
+            step_features += sorted([numbers[feature_id] for feature_id in step])
+            step_offsets.append(len(step_features))
+    index['positions'] = np.array(positions, dtype=np.int64)
+    index['step_offsets'] = np.array(step_offsets, dtype=np.int64)
+    index['step_features'] = np.array(step_features, dtype=np.int32)
+    return finish_index(index)
+
+def finish_index(index):
+    """Lookup tables of an index that are not stored
+
+    :Parameter index: index that was built or loaded
+    """
+    index['chromosomes'] = set([chrom for chrom, _ in index['keys']])
+    #sets of the steps that were looked up already
+    index['steps'] = dict()
+    return index
+
+ARRAYS = ['positions', 'step_offsets', 'step_features']
+
+#indices that were loaded by this process, by directory
+LOADED_INDICES = dict()
+
+def save_index(index, index_dir):
+    """Writes an index into a directory, which is created in a temporary
+    location first, so jobs never see a partial index
+
+    :Parameter index: index that was created by build_index
+    :Parameter index_dir: directory of the index
+    """
+    tmp_dir = index_dir.rstrip('/')+'.tmp.'+str(os.getpid())+'/'
+    os.makedirs(tmp_dir)
+    for name in ARRAYS:
+        np.save(tmp_dir+name+'.npy', index[name])
+    handle = open(tmp_dir+'index.json', 'w')
+    json.dump({'ids':index['ids'],
+               'keys':[[chrom, strand, start, end]
+                       for (chrom, strand), (start, end) in index['keys'].items()]},
+              handle)
+    handle.close()
+    try:
+        os.rename(tmp_dir, index_dir)
+    except OSError:
+        #another run built the same index at the same time
+        shutil.rmtree(tmp_dir)
+
+def load_index(index_dir):
+    """Memory maps an index that was written by save_index, an index is only
+    loaded once per process, e.g. for all samples of a batch
+
+    :Parameter index_dir: directory of the index
+    """
+    if index_dir in LOADED_INDICES:
+        return LOADED_INDICES[index_dir]
+    handle = open(index_dir+'index.json')
+    stored = json.load(handle)
+    handle.close()
+    index = dict()
+    index['ids'] = [str(feature_id) for feature_id in stored['ids']]
+    index['keys'] = dict([((str(chrom), str(strand)), (start, end))
+                          for chrom, strand, start, end in stored['keys']])
+    for name in ARRAYS:
+        index[name] = np.load(index_dir+name+'.npy', mmap_mode='r')
+    LOADED_INDICES[index_dir] = finish_index(index)
+    return LOADED_INDICES[index_dir]
+
+def get_index_dir(param):
+    """Directory of the index of the current annotation and counting
+    parameters in the annotation cache
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    gtf_file = os.path.abspath(param['genome_annotation_gft'])
+    stat = os.stat(gtf_file)
+    key = hashlib.sha1('\t'.join([gtf_file,
+                                  str(stat.st_size),
+                                  str(int(stat.st_mtime)),
+                                  param['HTSeq_t'],
+                                  param['HTSeq_id'],
+                                  str(param['stranded'] == 'no')])).hexdigest()
+    return param['annotation_cache']+key+'/'
+
+def init(param):
+    """Builds the index of the annotation unless it is in the annotation
+    cache already and stores its location in param['annotation_index']
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    #imported here, the bamqc script uses this module without the pipeline
+    from hydra_pkg import helper as HELPER
+    HELPER.check_parameter(param, key='annotation_cache', dtype=str, optional=True)
+    if param['annotation_cache'] == '':
+        param['annotation_cache'] = param['working_dir']+'annotation_cache/'
+    if not param['annotation_cache'].endswith('/'):
+        param['annotation_cache'] += '/'
+    index_dir = get_index_dir(param)
+    if not os.path.exists(index_dir):
+        HELPER.writeLog('Building the annotation index '+index_dir+' ... \n', param)
+        if not os.path.exists(param['annotation_cache']):
+            os.makedirs(param['annotation_cache'])
+        save_index(build_index(param['genome_annotation_gft'],
+                               param['HTSeq_t'],
+                               param['HTSeq_id'],
+                               param['stranded']),
+                   index_dir)
+    param['annotation_index'] = index_dir
+
+def get_blocks(read):
+    """Aligned blocks of a read on the reference
+
+    :Parameter read: pysam alignment
+    :return parameter: list of (start, end)
+    """
+    blocks = []
+    position = read.pos
+    for operation, length in read.cigar:
+        if operation in ALIGNED_OPERATIONS:
+            if length > 0:
+                blocks.append((position, position+length))
+            position += length
+        elif operation in REFERENCE_OPERATIONS:
+            position += length
+    return blocks
+
+def get_read_strand(read, stranded):
+    """Strand of the feature a read comes from
+
+    :Parameter read: pysam alignment
+    :Parameter stranded: no, yes or reverse(d)
+    """
+    strand = '-' if read.is_reverse else '+'
+    #the second mate comes from the opposite strand
+    if read.is_paired and read.is_read2:
+        strand = '+' if strand == '-' else '-'
+    if stranded in ['reverse', 'reversed']:
+        strand = '+' if strand == '-' else '-'
+    return strand
+
+def get_step(index, step):
+    """Feature numbers of a step
+
+    :Parameter index: index that was created by build_index or load_index
+    :Parameter step: number of the step
+    """
+    if step not in index['steps']:
+        index['steps'][step] = frozenset(
+            index['step_features'][index['step_offsets'][step]:
+                                   index['step_offsets'][step+1]].tolist())
+    return index['steps'][step]
+
+def get_overlap(index, chrom, strand, start, end):
+    """Sets of feature numbers of all steps within an interval, including the
+    empty sets of gaps between features
+
+    :Parameter index: index that was created by build_index or load_index
+    :Parameter chrom: chromosome
+    :Parameter strand: strand key, see get_strand_key
+    :Parameter start: start of the interval (0 based)
+    :Parameter end: end of the interval (exclusive)
+    """
+    if (chrom, strand) not in index['keys']:
+        return [frozenset()]
+    first, last = index['keys'][(chrom, strand)]
+    positions = index['positions']
+    idx = first+int(np.searchsorted(positions[first:last], start, side='right'))-1
+    if idx < first:
+        overlap = [frozenset()]
+        idx = first
+    else:
+        overlap = []
+    while idx < last and positions[idx] < end:
+        overlap.append(get_step(index, idx))
+        idx += 1
+    return overlap
+
+def get_features(index, reads, stranded, mode, references):
+    """Feature ids that a read or pair is assigned to
+
+    :Parameter index: index that was created by build_index or load_index
+    :Parameter reads: list of the aligned mates
+    :Parameter stranded: no, yes or reverse(d)
+    :Parameter mode: union, intersection-strict or intersection-nonempty
+    :Parameter references: names of the chromosomes of the bam file
+    :return parameter: set of feature numbers or None if the chromosome is
+                       not in the annotation
+    """
+    features = None
+    for read in reads:
+        chrom = references[read.tid]
+        if chrom not in index['chromosomes']:
+            return None
+        strand = get_strand_key(get_read_strand(read, stranded), stranded)
+        for start, end in get_blocks(read):
+            for step in get_overlap(index, chrom, strand, start, end):
+                if mode == 'union':
+                    features = step | (features or set())
+                elif mode == 'intersection-strict':
+                    features = set(step) if features is None else features & step
+                elif len(step) > 0:
+                    features = set(step) if features is None else features & step
+    return features or set()
+
+def init_counter(index, stranded, mode, references):
+    """Counter for the reads of a single bam file
+
+    :Parameter index: index that was created by build_index or load_index
+    :Parameter stranded: no, yes or reverse(d)
+    :Parameter mode: union, intersection-strict or intersection-nonempty
+    :Parameter references: names of the chromosomes of the bam file
+    """
+    counter = dict()
+    counter['index'] = index
+    counter['references'] = references
+    counter['stranded'] = stranded
+    counter['mode'] = mode
+    counter['counts'] = [0]*len(index['ids'])
+    counter['special'] = dict([(name, 0) for name in SPECIAL_COUNTS])
+    #mates that wait for their partner
+    counter['mates'] = dict()
+    return counter
+
+def count_alignment(counter, reads):
+    """Counts a single read or a pair
+
+    :Parameter counter: counter that was created by init_counter
+    :Parameter reads: list of the mates, unmapped mates included
+    """
+    special = counter['special']
+    aligned = [read for read in reads if not read.is_unmapped]
+    if len(aligned) == 0:
+        special['__not_aligned'] += 1
+        return
+    #like htseq-count the unmapped mate of a pair is checked as well
+    for read in reads:
+        if dict(read.tags).get('NH', 1) > 1:
+            special['__alignment_not_unique'] += 1
+            return
+    if min([read.mapq for read in reads]) < MIN_QUALITY:
+        special['__too_low_aQual'] += 1
+        return
+    features = get_features(counter['index'], aligned, counter['stranded'],
+                            counter['mode'], counter['references'])
+    if features is None or len(features) == 0:
+        special['__no_feature'] += 1
+    elif len(features) > 1:
+        special['__ambiguous'] += 1
+    else:
+        counter['counts'][list(features)[0]] += 1
+
+def add_read(counter, read):
+    """Adds a read of the bam file, mates are counted together once both are
+    seen
+
+    :Parameter counter: counter that was created by init_counter
+    :Parameter read: pysam alignment
+    """
+    if not read.is_paired:
+        count_alignment(counter, [read])
+        return
+    key = (read.qname, read.tid, read.pos, read.rnext, read.pnext)
+    mate_key = (read.qname, read.rnext, read.pnext, read.tid, read.pos)
+    if mate_key in counter['mates']:
+        count_alignment(counter, [counter['mates'].pop(mate_key), read])
+    else:
+        counter['mates'][key] = read
+
+def finish_counter(counter):
+    """Counts the mates whose partner was never seen on their own
+
+    :Parameter counter: counter that was created by init_counter
+    """
+    for read in counter['mates'].values():
+        count_alignment(counter, [read])
+    counter['mates'] = dict()
+
+def write_counts(counter, filename):
+    """Writes the counts in the htseq-count format
+
+    :Parameter counter: counter that was created by init_counter
+    :Parameter filename: output file
+    """
+    ids = counter['index']['ids']
+    handle = open(filename, 'w')
+    for idx in range(len(ids)):
+        handle.write(ids[idx]+'\t'+str(counter['counts'][idx])+'\n')
+    for name in SPECIAL_COUNTS:
+        handle.write(name+'\t'+str(counter['special'][name])+'\n')
+    handle.close()
+
+def count_bam(bam_file, index, stranded, mode, count_file):
+    """Counts all reads of a bam file
+
+    :Parameter bam_file: alignment file
+    :Parameter index: index that was created by build_index or load_index
+    :Parameter stranded: no, yes or reverse(d)
+    :Parameter mode: union, intersection-strict or intersection-nonempty
+    :Parameter count_file: output file in the htseq-count format
+    """
+    import pysam
+    handle = pysam.Samfile(bam_file, 'rb')
+    counter = init_counter(index, stranded, mode, handle.references)
+    for read in handle:
+        add_read(counter, read)
+    handle.close()
+    finish_counter(counter)
+    write_counts(counter, count_file)
@@ -17,13 +17,19 @@ and checking functions all related to general pipeline functionality
 """
 import json
 import os
-import random
 import re
 import shutil
 import subprocess
 import sys
 from hydra_pkg.logs import writeLog
 from hydra_pkg import qsub_module
+from hydra_pkg import slurm_module
+from hydra_pkg import dry_run_module
+from hydra_pkg import sentinel as SENTINEL
+from hydra_pkg import resources as RESOURCES
+from hydra_pkg import state as STATE
+from hydra_pkg import cache as CACHE
+from hydra_pkg import fastq_io as FASTQ_IO
 from hydra_pkg import single_cpu_module
 from hydra_pkg import RNASEQ_PIPELINE_DIR
 
@@ -85,6 +91,7 @@ def initialize_logfiles(param):
         if not os.path.exists(log_file):
             open(log_file, 'a').close()
     param['log_handle'] = param['working_dir']+'results/main.log'
+    STATE.init(param)
 
 def initialize_qsub(param):
     """Function to initialize the parallelization module parameters
@@ -102,6 +109,41 @@ def initialize_qsub(param):
     check_parameter(param, key='qsub_RUNTIME_LIMIT', dtype=str)
     check_parameter(param, key='qsub_wait_time', dtype=int)
     check_parameter(param, key='qsub_num_processors', dtype=str)
+    check_parameter(param, key='local_max_jobs', dtype=int, optional=True)
+    check_parameter(param, key='local_num_processors', dtype=int, optional=True)
+    check_parameter(param, key='batch_size', dtype=int, optional=True)
+    if param['batch_size'] == '':
+        param['batch_size'] = 1
+    check_parameter(param, key='qsub_parallel_env', dtype=str, optional=True)
+    check_parameter(param, key='job_prologue', dtype=str, optional=True)
+    check_parameter(param, key='resource_history', dtype=str, optional=True)
+    RESOURCES.init(param)
+    #older parameter files rely on the bashrc being sourced on the scc
+    if param['job_prologue'] == '' and param['qsub_MACHINE'] == 'scc':
+        param['job_prologue'] = 'source ~/.bashrc'
+    get_backend(param).init(param)
+
+# scheduler backends, every module provides init, submit_jobs, wait_for_jobs,
+# cancel_jobs and get_status
+BACKENDS = {'sge':qsub_module,
+            'slurm':slurm_module,
+            'local':single_cpu_module,
+            'dry_run':dry_run_module}
+
+def get_backend(param):
+    """Returns the module of the scheduler backend that runs the jobs
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    return BACKENDS[param['scheduler_backend']]
+
+def has_side_effects(param):
+    """False if the scheduler backend only records the jobs instead of running
+    them (dry run), see backend_helper
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    return get_backend(param).SIDE_EFFECTS
 
 def clean_up(param):
     """Remove all old results
@@ -135,28 +177,31 @@ def clean_up(param):
 
 
 def clean_failed(param):
-    """Remove log files of the samples that failed in the last step, this will
-    force them to be rerun from scratch
+    """Remove log files and the state of the samples that failed in the last
+    step, this will force them to be rerun from scratch
 
     :Parameter param: parameter object
     """
+    error_samples = []
     mainlog = param['working_dir']+'results/main.log'
-    if os.path.exists(mainlog):
+    if os.path.exists(STATE.get_database(param)):
+        error_samples = STATE.get_failed_samples(param)
+        STATE.remove_samples(param, error_samples)
+    elif os.path.exists(mainlog):
         filehandle = open(mainlog, 'r')
-        error_samples = ''
         for line in filehandle:
             line = line.strip()
             if 'error in samples' in line:
-                error_samples = line
-        if error_samples is not '':
-            error_samples = re.sub('error in samples ','',error_samples)
-            error_samples = error_samples.split(';')
-            #delete all log files
-            for sample in error_samples:
-                logfile = param['working_dir']+'results/log/'+sample+'.log'
-                if os.path.exists(logfile):
-                    os.remove(logfile)
-            #and finally delete the mainlog
+                error_samples = re.sub('error in samples ', '', line).split(';')
+        filehandle.close()
+    if len(error_samples) > 0:
+        #delete all log files
+        for sample in error_samples:
+            logfile = param['working_dir']+'results/log/'+sample+'.log'
+            if os.path.exists(logfile):
+                os.remove(logfile)
+        #and finally delete the mainlog
+        if os.path.exists(mainlog):
             os.remove(mainlog)
 
 
@@ -181,9 +226,38 @@ def initialize_standard(param):
     check_parameter(param, key='run_featureCount', dtype=bool)
     check_parameter(param, key='zipped_fastq', dtype=bool)
     check_parameter(param, key='skip_trimming', dtype=bool)
-
-
-    qsub_module.initialize_qsub(param)
+    check_parameter(param, key='run_per_sample', dtype=bool, optional=True)
+    check_parameter(param, key='fused_qc_trimming', dtype=bool, optional=True)
+    check_parameter(param, key='stream_trimmed_fastq', dtype=bool, optional=True)
+    check_parameter(param, key='fused_post_alignment', dtype=bool, optional=True)
+    check_parameter(param, key='incremental_count_matrix', dtype=bool, optional=True)
+    check_parameter(param, key='scheduler_backend', dtype=str, optional=True)
+    #run_single_cpu always runs the jobs on the current node
+    if param['run_single_cpu']:
+        param['scheduler_backend'] = 'local'
+    elif param['scheduler_backend'] == '':
+        param['scheduler_backend'] = 'sge'
+    if param['scheduler_backend'] not in BACKENDS:
+        print ('Parameter scheduler_backend can only be one of the following: '+
+               ', '.join(sorted(BACKENDS.keys())))
+        sys.exit(0)
+    #format of the intermediate fastq files, see fastq_io
+    check_parameter(param, key='intermediate_format', dtype=str, optional=True)
+    if param['intermediate_format'] == '':
+        param['intermediate_format'] = 'gzip'
+    if param['intermediate_format'] not in FASTQ_IO.FORMATS:
+        print ('Parameter intermediate_format can only be one of the following: '+
+               ', '.join(FASTQ_IO.FORMATS))
+        sys.exit(0)
+    check_parameter(param, key='intermediate_compression_level', dtype=int, optional=True)
+    if (param['intermediate_compression_level'] != '' and
+            param['intermediate_format'] in FASTQ_IO.MAX_LEVELS and
+            not (1 <= param['intermediate_compression_level'] <=
+                 FASTQ_IO.MAX_LEVELS[param['intermediate_format']])):
+        print ('Parameter intermediate_compression_level has to be between 1 and '+
+               str(FASTQ_IO.MAX_LEVELS[param['intermediate_format']])+' for '+
+               param['intermediate_format'])
+        sys.exit(0)
 
     #checking working directory and going there
     check_parameter(param, key='working_dir', dtype=str, checkfile=True)
@@ -191,11 +265,12 @@ def initialize_standard(param):
         param['working_dir'] = param['working_dir']+'/'
 
     #if directory exists and the pipeline
-    #should be run from scratch delete the directory
-    if param['clean_run']:
+    #should be run from scratch delete the directory, a dry run leaves the
+    #results of earlier runs alone
+    if param['clean_run'] and has_side_effects(param):
         clean_up(param)
 
-    if param['run_failed_from_scratch']:
+    if param['run_failed_from_scratch'] and has_side_effects(param):
         clean_failed(param)
 
     #if results or report directory do not exist create them
@@ -336,30 +411,44 @@ def add_input_output_files(param, input_files, output_files):
     if not param.has_key(param['output_files']) and param['output_files'] != '':
         param[param['output_files']] = ['']*param['num_samples']
 
+    #remember which step produces the input files, so a job that was submitted
+    #before that step finished can look its input up in the sentinel files
+    if not param.has_key('output_flags'):
+        param['output_flags'] = dict()
+    if not param.has_key('cache_keys'):
+        param['cache_keys'] = dict()
+    param['input_flag'] = param['output_flags'].get(input_files, '')
+
+def set_output_files(param, index, outputs):
+    """Stores the output files of a sample in the parameter object
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter index: index of the sample
+    :Parameter outputs: ';' separated output files as written by wrapup_module.
+                        Most modules return one file, cutadapt returns two on
+                        paired data.
+    """
+    if param['output_files'] == '':
+        return
+    outputs = outputs.split(';')
+    param[param['output_files']][index] = outputs[0]
+    if len(outputs) > 1:
+        param[param['output_files']+'2'][index] = outputs[1]
+
 def check_queue_success(param):
     """Check how many jobs ran successful and prints that into the main log
 
     :Parameter param: dictionary that contains all general RNASeq pipeline parameters
     :return parameter: failed number of samples
     """
+    finished = STATE.get_finished_outputs(param, param['current_flag'])
     s_noend = []
     for idx in range(param['num_samples']):
-        logfile = open(param['working_dir']+'results/log/'+param['stub'][idx]+'.log')
-        lines_end = [line for line in logfile.readlines() \
-                      if 'ENDING %s |' %(param['current_flag']) in line.rstrip()]
         #check if the job was successfully finished
-        if len(lines_end) == 1:
-            #check if there is suppose to be a output file and if that is
-            #the case store the location of the output file
-            if  param['output_files'] != '':
-                retval = lines_end[0].split('|')[1].strip()
-                if len(retval.split(';')) == 1:
-                    param[param['output_files']][idx] = retval
-                else:
-                    param[param['output_files']][idx] = retval.split(';')[0]
-                    param[param['output_files']+'2'][idx] = retval.split(';')[1]
-            #add an entry into the run log that shows that the
-            #current job has been finished successfully
+        if param['stub'][idx] in finished:
+            #store the location of the output files and add an entry into
+            #the run log that shows that the current job has been finished
+            set_output_files(param, idx, finished[param['stub'][idx]])
             param['run_log'][-1][idx] = True
         else:
             if param['output_files'] != '':
@@ -371,15 +460,23 @@ def check_queue_success(param):
         writeLog('error in samples %s' %(';'.join([s for s in s_noend])), param)
         writeLog('\n', param)
     else:
+        STATE.set_step_finished(param, param['current_flag'])
         writeLog(param['current_flag']+' successful!\n\n', param)
     return len(s_noend)
 
 def dump_parameters(param):
     """dumps the parameter object into a JSON object
 
+    Every step gets its own file, since several steps can be queued at the
+    same time and each job has to see the parameters of its own step.
+
     :Parameter param: dictionary that contains all general RNASeq pipeline parameters
     """
-    with open(param['working_dir']+'results/parameters.json', 'w') as filehandle:
+    param_dir = param['working_dir']+'results/parameters/'
+    if not os.path.exists(param_dir):
+        os.makedirs(param_dir)
+    param['parameter_json'] = param_dir+param['current_flag']+'.json'
+    with open(param['parameter_json'], 'w') as filehandle:
         json.dump(param, filehandle)
 
 
@@ -389,42 +486,45 @@ def is_module_finished(param):
     :Parameter param: dictionary that contains all general RNASeq pipeline parameters
     """
     if param['clean_run']:
-        finished = False
-    else:
-        handle = open(param['log_handle'])
-        success = [line for line in handle.readlines() \
-                    if '%s successful!' %(param['current_flag']) in line.rstrip()]
-        handle.close()
-        finished = len(success) == 1
-    return finished
+        return False
+    return STATE.is_step_finished(param, param['current_flag'])
 
 def check_job_finished(param, index):
     """Function that checks if the current job is already finished
 
     :Parameter param: dictionary that contains all general RNASeq pipeline parameters
     :Parameter index: index of the current file we are working on
-    """   
-    #check if it is not a clean run and if module already completed
-    finished = False
-    if not param['clean_run']:
-        log_file = (param['working_dir']+'results/log/'+
-                    param['stub'][index]+'.log')        
-        file_handle = open(log_file)
-        for line in file_handle.readlines():
-            if 'ENDING %s |' %(param['current_flag']) in line.rstrip():
-                finished = True
-        file_handle.close()
-    return finished
+    """
+    if param['clean_run']:
+        return False
+    return param['stub'][index] in STATE.get_finished_outputs(param,
+                                                              param['current_flag'])
 
 
-def submit_job(param, py_file, input_files, output_files='', cores='1-8', mem_free='standard'):
-    """submit a job, which runs the same wrapper on every single file
+# keys of the parameter object that describe the step that is currently run.
+# They are stored with every started step so the step can be finished later
+STEP_KEYS = ['input_files', 'output_files', 'input_flag', 'current_dir',
+             'current_flag', 'module_dir', 'parameter_json']
+
+def start_job(param, py_file, input_files, output_files='', cores='1-8',
+              mem_free='standard', hold_jobs=None, qc_gate=False,
+              cache_parameters=None):
+    """start a job, which runs the same wrapper on every single file, without
+    waiting for the jobs to finish
 
     :Parameter param: dictionary that contains all general RNASeq pipeline parameters
     :Parameter py_file: name of the python wrapper
     :Parameter input_files: input filenames
     :Parameter output_files: output filenames
     :Parameter cores: number of cores that should be used if available
+    :Parameter mem_free: memory that should be reserved for each job
+    :Parameter hold_jobs: list with the scheduler job ids for every sample
+                          that have to finish before the sample can start
+    :Parameter qc_gate: indicates that every job checks the fastqc results of
+                        its input files and stops if the sample failed the QC
+    :Parameter cache_parameters: names of the parameters the results of the
+                                 step depend on, see cache.get_cache_keys
+    :return parameter: step dictionary that is passed on to finish_job
     """
 
     #store information on which files to use as input and which ones as output
@@ -435,73 +535,144 @@ def submit_job(param, py_file, input_files, output_files='', cores='1-8', mem_fr
     # 'run_current_dir' and we want to drop the 'run_' to get 'current_dir'
     param['current_dir'] = py_file[4:]
     param['current_flag'] = param['current_dir'] + '_' + input_files
-
-    if is_module_finished(param):
+    param['module_dir'] = (param['working_dir']+
+                           'results/'+
+                           param['current_dir']+'/')
+    param['qc_gate'] = qc_gate
+
+    #the output files are only known once the step finished on a sample, until
+    #then subsequent steps fetch them from the sentinel files of the jobs
+    if param['output_files'] != '':
+        param[param['output_files']] = ['']*param['num_samples']
+        if param.has_key(param['output_files']+'2'):
+            param[param['output_files']+'2'] = ['']*param['num_samples']
+        param['output_flags'][param['output_files']] = param['current_flag']
+
+    #the cache key of a sample changes if its input files, the parameters of
+    #the step or the tool changed
+    keys = CACHE.get_cache_keys(param, cache_parameters)
+    param['cache_keys'][param['current_flag']] = keys
+
+    #samples that already finished the step with the same key in an earlier
+    #run, results of older versions without a key are kept as well
+    jobs = dict()
+    if not param['clean_run']:
+        jobs = STATE.get_jobs(param, param['current_flag'])
+    cached = [False]*param['num_samples']
+    for idx in range(param['num_samples']):
+        job = jobs.get(param['stub'][idx], ('', '', None))
+        if job[0] == 'done' and job[2] in [None, keys[idx]]:
+            cached[idx] = True
+            set_output_files(param, idx, job[1])
+
+    step = dict()
+    step['skipped'] = (is_module_finished(param) and
+                       all([cached[idx] for idx in range(param['num_samples'])
+                            if param['run_log'][-1][idx]]))
+    step['job_id'] = ''
+    step['scheduler_ids'] = ['']*param['num_samples']
+    step['submitted'] = False
+
+    if step['skipped']:
         #add coment into main log file
         writeLog('Skipping '+
                  param['current_flag']+
                  ' since it was already successfully finished.\n',
                  param)
-        #and fetch the current working files
-        for idx in range(param['num_samples']):
-            logfile = open(param['working_dir']+
-                           'results/log/'+
-                           param['stub'][idx]+
-                           '.log')            
-            #check if the current module actually produces output files that are
-            #used subsequently. (i.e. tophat or the trimmer as opposed to fastqc or bamqc)
-            if  param['output_files'] != '':
-                #if there are output files fetch the values and add them to the
-                #proper list of files (bam_files, fastq_files, ... )
-                lines_end = [line for line in logfile.readlines() \
-                             if 'ENDING %s | ' %(param['current_flag']) in line.rstrip()]
-                retval = lines_end[0].split('|')[1].strip()
-                #check if there are one or 2 working files returned.
-                #e.g. cutadapt will return 2 values, while most modules return only 1
-                if len(retval.split(';')) == 1:
-                    param[param['output_files']][idx] = retval
-                else:
-                    param[param['output_files']][idx] = retval.split(';')[0]
-                    param[param['output_files']+'2'][idx] = retval.split(';')[1]
-                logfile.close()
-        #add in the run log that all samples finished successfully
-        param['run_log'].append([True]*param['num_samples'])
-        param['run_log_headers'].append(param['current_flag'])
-
     else:
         writeLog('Starting '+param['current_flag']+'\n', param)
         #create current working directory
-        param['module_dir'] = (param['working_dir']+
-                               'results/'+
-                               param['current_dir']+'/')
         if not os.path.exists(param['module_dir']):
             os.makedirs(param['module_dir'])
-        #write all parameters to file so the single subnodes can use them
-        dump_parameters(param)
-
-        #generate a job id
-        job_id = 'HyDrA_'+str(random.randint(1, 10000))
+        #samples that were started before but did not finish, e.g. tophat
+        #can resume these
+        param['started_samples'] = [param['stub'][idx]
+                                    for idx in range(param['num_samples'])
+                                    if param['stub'][idx] in jobs and
+                                    jobs[param['stub'][idx]][0] != 'done' and
+                                    jobs[param['stub'][idx]][2] == keys[idx]]
+        #name the job after the current step, the jobs are tracked by the
+        #job id the scheduler returns
+        step['job_id'] = 'HyDrA_'+param['current_flag']
+
+        #reserve what the step needs according to the parameter file or
+        #previous runs
+        cores, mem_free = RESOURCES.get_profile(param, cores, mem_free)
+        if mem_free == 'standard':
+            param['mem_free'] = param['qsub_memory']
+        else:
+            param['mem_free'] = mem_free
+        writeLog('Reserving '+cores+' cores and '+param['mem_free']+' per job\n', param)
+
+        #write all parameters to file so the single subnodes can use them,
+        #including the memory that was reserved for them, a dry run only
+        #records the calls and leaves the files of earlier runs alone
+        side_effects = has_side_effects(param)
+        if side_effects:
+            dump_parameters(param)
+
+        #first check if the job was already finished and skip if the pipeline is in resume mode
+        #and also check if the step before was run sucessfully
+        indices = [index for index in range(param['num_samples'])
+                   if not cached[index] and param['run_log'][-1][index]]
+        if hold_jobs is None:
+            hold_jobs = [[] for _ in range(param['num_samples'])]
 
         #submit all jobs
-        submitted = False
-        for index in range(param['num_samples']):
-            #first check if the job was already finished and skip if the pipeline is in resume mode
-            #and also check if the step before was run sucessfully
-            if not check_job_finished(param, index) and param['run_log'][-1][index]:
-                if param['run_single_cpu']:
-                    single_cpu_module.run_single_job(index, py_file)
-                else:
-                    qsub_module.submit_jobs(index,
-                                            param,
-                                            py_file,
-                                            job_id,
-                                            cores,
-                                            mem_free)
-                    submitted = True
-
-        #wait for qsub scripts to finish if there were actually submitted jobs
-        if submitted:
-            qsub_module.wait_for_qsub(param, job_id)
+        if len(indices) > 0:
+            #the jobs report back through sentinel files, old ones are removed
+            if side_effects:
+                SENTINEL.clear_sentinels(param, indices)
+            step['scheduler_ids'] = get_backend(param).submit_jobs(param,
+                                                                   indices,
+                                                                   py_file,
+                                                                   step['job_id'],
+                                                                   cores,
+                                                                   mem_free,
+                                                                   hold_jobs)
+            if side_effects:
+                STATE.set_submitted(param,
+                                    param['current_flag'],
+                                    [param['stub'][idx] for idx in indices],
+                                    [keys[idx] for idx in indices])
+            step['submitted'] = True
+
+    step['param'] = dict([(key, param.get(key, '')) for key in STEP_KEYS])
+    return step
+
+def finish_job(param, step):
+    """wait for a job that was started with start_job, fetch its output files
+    and write the results into the run log
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter step: step dictionary returned by start_job
+    """
+    #switch back to the step that should be finished
+    param.update(step['param'])
+
+    if step['skipped']:
+        #and fetch the current working files
+        finished = STATE.get_finished_outputs(param, param['current_flag'])
+        for idx in range(param['num_samples']):
+            set_output_files(param, idx, finished.get(param['stub'][idx], ''))
+        #add in the run log that all samples finished successfully
+        param['run_log'].append([True]*param['num_samples'])
+        param['run_log_headers'].append(param['current_flag'])
+
+    else:
+        #wait for the jobs to finish if there were actually submitted jobs
+        if step['submitted']:
+            get_backend(param).wait_for_jobs(param, step['scheduler_ids'])
+        #a dry run does not run any job, every sample that got this far passes
+        if not has_side_effects(param):
+            param['run_log'].append([flag for flag in param['run_log'][-1]])
+            param['run_log_headers'].append(param['current_flag'])
+            writeLog(param['current_flag']+' dry run\n\n', param)
+            return
+        #the jobs reported their results in their sentinel files
+        if step['submitted']:
+            STATE.import_sentinels(param, step['scheduler_ids'])
+            RESOURCES.record_usage(param, step['scheduler_ids'])
         #start a new log column for the current batch of jobs
         param['run_log'].append([False]*param['num_samples'])
         param['run_log_headers'].append(param['current_flag'])
@@ -511,6 +682,23 @@ def submit_job(param, py_file, input_files, output_files='', cores='1-8', mem_fr
             sys.exit(0)
         writeLog('++++++++++++++++++++++++++++\n\n', param)
 
+def submit_job(param, py_file, input_files, output_files='', cores='1-8', mem_free='standard',
+               cache_parameters=None):
+    """submit a job, which runs the same wrapper on every single file and
+    wait for all of them to finish
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter py_file: name of the python wrapper
+    :Parameter input_files: input filenames
+    :Parameter output_files: output filenames
+    :Parameter cores: number of cores that should be used if available
+    :Parameter cache_parameters: names of the parameters the results of the
+                                 step depend on
+    """
+    step = start_job(param, py_file, input_files, output_files, cores, mem_free,
+                     cache_parameters=cache_parameters)
+    finish_job(param, step)
+
 
 
 ###############################################################################
@@ -20,9 +20,17 @@ a wrapper that calls an R script
 """
 from hydra_pkg import module_helper as MODULE_HELPER
 from hydra_pkg import helper as HELPER
+from hydra_pkg import gene_counts as GENE_COUNTS
+from hydra_pkg import count_matrix as COUNT_MATRIX
 import os
 import re
 import subprocess
+import sys
+import numpy as np
+
+#parameters the results of this module depend on, see cache.py
+CACHE_PARAMETERS = ['HTSeq_exec', 'sam_exec', 'HTSeq_counter', 'HTSeq_t', 'HTSeq_m',
+                    'HTSeq_id', 'HTSeq_r', 'genome_annotation_gft', 'stranded']
 
 def init(param):
     """Initialization function that checks the all relevant tophat parameters
@@ -45,6 +53,17 @@ def init(param):
                                            'intersection-nonempty'])
     MODULE_HELPER.check_parameter(param, key='HTSeq_id', dtype=str)
     MODULE_HELPER.check_parameter(param, key='Rscript_exec', dtype=str)
+    MODULE_HELPER.check_parameter(param, key='HTSeq_counter', dtype=str, optional=True)
+    if param['HTSeq_counter'] == '':
+        param['HTSeq_counter'] = 'htseq-count'
+    if param['HTSeq_counter'] not in ['htseq-count', 'builtin']:
+        print 'Parameter HTSeq_counter can only be one of the following: htseq-count, builtin'
+        sys.exit(0)
+
+    #the built-in counter uses an index of the annotation, which is built once
+    if param['run_htseq'] and (param['HTSeq_counter'] == 'builtin' or
+                               param['fused_post_alignment']):
+        GENE_COUNTS.init(param)
 
 
 def process_stat_files(param):
@@ -125,54 +144,43 @@ def finalize(param, input_files='count_files'):
     :Parameter input_files: flag that indicates the input files
     """
     HELPER.writeLog('Collecting HTSeq raw counts ... \n', param)
-    #extracts the counts from the htseq output
-    import csv
-
     #check which of these files are actually available
     working_files = [iFile for iFile in param[input_files] if iFile != '']
 
     if len(working_files) > 0:
-        #get gene annotation
-        csv_file = open(working_files[0])
-        csv_reader = csv.reader(csv_file, delimiter='\t')
-        counts = [row[0] for row in csv_reader]
-        csv_file.close()
-
-        #get all the expression values
-        header = 'ID'
-        for idx in range(param['num_samples']):
-            if param[input_files] != '':
-                header = header+'\t'+param['stub'][idx]
-                csv_file = open(param[input_files][idx])
-                csv_reader = csv.reader(csv_file, delimiter='\t')
-                i = 0
-                for row in csv_reader:
-                    counts[i] = counts[i]+'\t'+row[1]
-                    i += 1
-                csv_file.close()
-
-        #output the file
-        out_file = param['working_dir']+'deliverables/htseq_raw_counts.txt'
-        out_handle = open(out_file, 'w')
-        out_handle.write(header+'\n')
-        #drop the last 5 lines since these provide only a summary statistic
-        for i in range(len(counts)-5):
-            out_handle.write(counts[i]+'\n')
-        out_handle.close()
+        samples = [param['stub'][idx] for idx in range(param['num_samples'])
+                   if param[input_files][idx] != '']
+
+        #output the file and a binary matrix, the last 5 lines provide only a
+        #summary statistic and go into the stats file
+        try:
+            updated = COUNT_MATRIX.update_matrix(samples,
+                                                 working_files,
+                                                 ['ID'],
+                                                 [0],
+                                                 [1],
+                                                 param['working_dir']+
+                                                 'deliverables/htseq_raw_counts.txt',
+                                                 param['working_dir']+
+                                                 'results/htseq/htseq_raw_counts.json',
+                                                 incremental=param['incremental_count_matrix'],
+                                                 tail_file=(param['working_dir']+
+                                                            'results/htseq/htseq_stats.txt'),
+                                                 tail_lines=5,
+                                                 binary_file=(param['working_dir']+
+                                                              'deliverables/htseq_raw_counts.npz'),
+                                                 dtype=np.int32)
+        except ValueError as error:
+            HELPER.writeLog('ERROR: The HTSeq counts could not be merged: '+
+                            str(error)+'\n', param)
+            return
+        if not updated:
+            HELPER.writeLog('The HTSeq raw counts are up to date.\n', param)
 
         #output_phenotype_file
         HELPER.writeLog('Writing phenotype data ... \n', param)
         MODULE_HELPER.output_sample_info(param)
 
-        #write summary stats
-        out_handle = open(param['working_dir']+
-                          'results/htseq/htseq_stats.txt',
-                          'w')
-        out_handle.write(header+'\n')
-        for i in range(len(counts)-5, len(counts)):
-            out_handle.write(counts[i]+'\n')
-        out_handle.close()
-
     else:
         print 'HTseq was not run successfully on any of the files..\n'
 
@@ -182,8 +190,22 @@ def main():
     """Main function that is run on each samples, which in turn calls runs
     htseq on a sample.
     """
-    import sys
     param = MODULE_HELPER.initialize_module()
+    outfile = (param['module_dir']+
+               param['outstub']+
+               '.txt')
+
+    #count with the annotation index instead of calling htseq-count
+    if param['HTSeq_counter'] == 'builtin':
+        param['file_handle'].write('Counting with the annotation index '+
+                                   param['annotation_index']+'\n')
+        GENE_COUNTS.count_bam(param['working_file'],
+                              GENE_COUNTS.load_index(param['annotation_index']),
+                              param['stranded'],
+                              param['HTSeq_m'],
+                              outfile)
+        MODULE_HELPER.wrapup_module(param, [outfile])
+        return
 
     #build htseq-count call:
     call1 = [param['sam_exec'], 'view', param['working_file']]
@@ -210,9 +232,6 @@ def main():
         sys.exit(0)
 
     #write output
-    outfile = (param['module_dir']+
-               param['outstub']+
-               '.txt')
     handle = open(outfile, 'w')
     handle.write(output)
     handle.close()
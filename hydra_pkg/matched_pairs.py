@@ -15,6 +15,7 @@
 """Wrapper to run the matched pairs script on all samples
 """
 from hydra_pkg import module_helper as MODULE_HELPER
+from hydra_pkg import fastq_io as FASTQ_IO
 import os
 import sys
 import subprocess
@@ -44,6 +45,8 @@ def run_match_pairs(param, infile, infile2, outfile, outfile2):
     call.append(param[infile2])
     call.append(outfile)
     call.append(outfile2)
+    if param['intermediate_compression_level'] != '':
+        call.append(str(param['intermediate_compression_level']))
 
     param['file_handle'].write(' '.join(call))
     output, error = subprocess.Popen(call,
@@ -62,11 +65,8 @@ def run_match_pairs(param, infile, infile2, outfile, outfile2):
         sys.exit(0)
     else:
         #check if the file integrity is alright
-        call = ['gzip', '-t', outfile2] 
-        output, error = subprocess.Popen(call,
-                                         stdout=subprocess.PIPE,
-                                         stderr=subprocess.PIPE).communicate()
-        if 'unexpected end of file' in error:
+        if not FASTQ_IO.test_file(outfile2,
+                                  FASTQ_IO.get_threads(param['num_processors'])):
             param['file_handle'].write('ERROR: File integrity corrupted, please rerun')
             sys.exit(0)
             
@@ -76,13 +76,14 @@ def main():
     """
     param = MODULE_HELPER.initialize_module()
 
-    #run match pairs
+    #run match pairs, the script writes the format of the file extension
+    extension = FASTQ_IO.EXTENSIONS[param['trimmed_format']]
     outfile = (param['module_dir']+
                param['outstub']+
-               '.clipped.matched.fastq.gz')
+               '.clipped.matched'+extension)
     outfile2 = (param['module_dir']+
                 param['outstub']+
-                '.clipped.matched.2.fastq.gz')
+                '.clipped.matched.2'+extension)
 
     run_match_pairs(param,
                     'working_file',
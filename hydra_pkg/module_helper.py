@@ -18,13 +18,16 @@ an external tool on each samples.
 """
 
 import hydra_pkg.helper as HELPER
+import hydra_pkg.sentinel as SENTINEL
 from hydra_pkg.r_scripts import get_script_path
+import atexit
 import getopt
 import json
 import matplotlib.pyplot as plt
 import os
 import subprocess
 import sys
+import time
 
 
 def check_parameter(param, key, dtype, allowed=[], checkfile=False, optional=False):
@@ -92,7 +95,9 @@ def initialize_module():
     if len(sys.argv) < 5:
         print 'ERROR: Specify the index of the file the parameter should be run on.'
         sys.exit(0)
-    optlist, _ = getopt.getopt(sys.argv[1:], 'i:n:d:')
+    parameter_file = ''
+    in_batch = False
+    optlist, _ = getopt.getopt(sys.argv[1:], 'i:n:d:p:b')
     for opt in optlist:
         if opt[0] == '-i':
             file_index = opt[1]
@@ -100,6 +105,11 @@ def initialize_module():
             num_processors = opt[1]
         if opt[0] == '-d':
             working_dir = opt[1]
+        if opt[0] == '-p':
+            parameter_file = opt[1]
+        #the sample is run in a batch, which is finished by batch.py
+        if opt[0] == '-b':
+            in_batch = True
     print '\n'
     print '###########################'
     print sys.argv
@@ -107,11 +117,22 @@ def initialize_module():
 
 
     #Read and initialize parameters
-    with open(working_dir+'results/parameters.json') as filehandle:
+    if parameter_file == '':
+        parameter_file = working_dir+'results/parameters.json'
+    with open(parameter_file) as filehandle:
         param = json.load(filehandle)
     param['file_index'] = int(file_index)
     param['num_processors'] = num_processors
     param['outstub'] = param['stub'][param['file_index']]
+    param['in_batch'] = in_batch
+
+    #let the pipeline know when the job is over, a job that stops before
+    #wrapup_module is reported as failed
+    param['sentinel_written'] = False
+    param['start_time'] = time.time()
+    param['start_cpu_time'] = SENTINEL.get_cpu_time()
+    SENTINEL.watch_memory()
+    atexit.register(SENTINEL.write_sentinel, param, 'failed')
 
     #use the input files that were specified in the pipeline call
     param['working_file'] = param[param['input_files']][param['file_index']]
@@ -124,34 +145,64 @@ def initialize_module():
                 param['stub'][param['file_index']]+
                 '.log')
 
-    #check if it is not a clean run and if module already completed
-    param['resume_module'] = False
-    if not param['clean_run']:
-        param['file_handle'] = open(log_file)
-        #check if the module already finished
-        lines_end = False
-        for line in param['file_handle'].readlines():
-            if 'ENDING %s |' %(param['current_flag']) in line.rstrip():
-                lines_end = True
-        if lines_end:
-            param['file_handle'].close()
-            #open file for writing
-            param['file_handle'] = open(log_file, 'a')
-            param['file_handle'].write(param['current_flag']+
-                                       ' module already run on this file .. SKIPPING\n')
-            param['file_handle'].close()
-            sys.exit(0)
-        #check if the module was started, but not finished the enable resuming
+    #check if the job already finished, e.g. if the scheduler ran it twice
+    if SENTINEL.get_status(param, param['file_index']) == 'done':
+        param['sentinel_written'] = True
+        handle = open(log_file, 'a')
+        handle.write(param['current_flag']+
+                     ' module already run on this file .. SKIPPING\n')
+        handle.close()
+        sys.exit(0)
 
-        for line in param['file_handle'].readlines():
-            if 'STARTING %s |' %(param['current_flag']) in line.rstrip():
-                param['resume_module'] = True
+    #check if the module was started before, but not finished to enable resuming
+    param['resume_module'] = (not param['clean_run'] and
+                              param['outstub'] in param.get('started_samples', []))
+
+    #the step that creates the input files might not have been finished when
+    #this job was submitted, in that case the files are fetched from its job
+    if param['working_file'] == '':
+        fetch_input_files(param, log_file)
+
+    #if samples are run independently the QC filter is applied on each sample
+    if param.get('qc_gate', False):
+        from hydra_pkg import fastqc
+        if fastqc.sample_failed(param):
+            handle = open(log_file, 'a')
+            handle.write(param['current_flag']+
+                         ' sample did not pass the QC filter .. SKIPPING\n')
+            handle.close()
+            sys.exit(0)
 
     #start process log
     param['file_handle'] = open(log_file, 'a')
     param['file_handle'].write('STARTING '+param['current_flag']+'\n')
     return param
 
+def fetch_input_files(param, log_file):
+    """Looks up the output files of the step that creates the input files of
+    the current step in the sentinel file of its job. If the step did not
+    finish on this sample the job stops without writing an ending flag.
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter log_file: log file of the current sample
+    """
+    retval = ''
+    if param.get('input_flag', '') != '':
+        sentinel = SENTINEL.read_sentinel(param, param['file_index'], param['input_flag'])
+        if sentinel is not None and sentinel['status'] == 'done':
+            retval = sentinel['outputs']
+
+    if retval == '':
+        handle = open(log_file, 'a')
+        handle.write(param['current_flag']+
+                     ' input files are not available .. SKIPPING\n')
+        handle.close()
+        sys.exit(0)
+
+    param['working_file'] = retval.split(';')[0]
+    if len(retval.split(';')) > 1:
+        param['working_file2'] = retval.split(';')[1]
+
 def output_phenotype(param, pheno_file):
     """Writes out a phenotype file
     :Parameter param: dictionary that contains all general RNASeq pipeline parameters
@@ -161,21 +212,31 @@ def output_phenotype(param, pheno_file):
     #write sample info only for the files that successfully completed
     header = param['raw_file_header']
     index = 0
-    out = open(pheno_file, "w")
+    lines = []
     filehandle = open(param['raw_filenames'], 'r')
     for line in filehandle:
         #take header into account
         if header:
-            out.write(line)
+            lines.append(line)
             header = False
         else:
             #write only samples that successfully finished
             if param['run_log'][-1][index]:
-                out.write(line)
+                lines.append(line)
             index += 1
-    out.close()
     filehandle.close()
 
+    #an unchanged file is not written again, so the ESet is not created again
+    if os.path.exists(pheno_file):
+        filehandle = open(pheno_file, 'r')
+        unchanged = filehandle.read() == ''.join(lines)
+        filehandle.close()
+        if unchanged:
+            return
+    out = open(pheno_file, "w")
+    out.write(''.join(lines))
+    out.close()
+
 def output_sample_info(param):
     """Writes a phenotype file of the samples that actually made it through HTSeq
     into the report directory
@@ -197,8 +258,9 @@ def is_in_raw_files(raw_files, current_file):
     return is_in_raw
     
 def wrapup_module(param, new_working_file=[], remove_intermediate=False):
-    """Function to wrap up a module run. Writes the ending flag which is used to
-    identify if the module was completed correctly. Also closes the log file handle.
+    """Function to wrap up a module run. Writes the ending flag into the log and
+    the sentinel file, which tells the pipeline that the module was completed
+    correctly and which output files it created. Also closes the log file handle.
     And finally also sets the working file pointer to the output of the module
     if the module has output files that are used in the next step.
     :Parameter param: dictionary that contains all general RNASeq pipeline parameters
@@ -228,8 +290,29 @@ def wrapup_module(param, new_working_file=[], remove_intermediate=False):
         param['file_handle'].write(';'.join([w for w in new_working_file]))
     param['file_handle'].write('\n\n')
     param['file_handle'].close()
+    SENTINEL.write_sentinel(param, 'done', new_working_file)
     
     
+def index_bam(param, bam_file):
+    """Indexes a coordinate sorted bam file with samtools, so the steps after
+    the alignment can read it by regions in parallel (see run_bamqc.py). A
+    file that cannot be indexed is still used, it is read as a single stream.
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter bam_file: coordinate sorted bam file
+    """
+    call = [param['sam_exec'], 'index', bam_file]
+    param['file_handle'].write('CALL: '+' '.join(call)+'\n')
+    try:
+        output, error = subprocess.Popen(call,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE).communicate()
+    except OSError as error:
+        param['file_handle'].write('Could not index '+bam_file+': '+str(error)+'\n')
+        return
+    param['file_handle'].write(error)
+    param['file_handle'].write(output)
+
 def plot_count_overview(param, stub, table):
     """Function that plot the overview boxplots for featureCounts and HTSeq
     :Parameter param: dictionary that contains all general RNASeq pipeline parameters
@@ -272,13 +355,33 @@ def plot_count_overview(param, stub, table):
 
 
 
+def is_up_to_date(outputs, inputs):
+    """Checks if all output files exist and are newer than the input files
+    :Parameter outputs: files that are created from the inputs
+    :Parameter inputs: files the outputs are created from
+    """
+    if not all([os.path.exists(filename) for filename in outputs+inputs]):
+        return False
+    return (min([os.path.getmtime(filename) for filename in outputs]) >=
+            max([os.path.getmtime(filename) for filename in inputs]))
+
 def create_eset(count_file, pheno_file, param, stub):
-    """Wrapper that calls an R script which creates a Bioconductor ExpressionSet
+    """Wrapper that calls an R script which creates a Bioconductor ExpressionSet,
+    unless the ESet, PCA and boxplot are newer than the count and phenotype files
     :Parameter count_file: location of the count file
     :Parameter pheno_file: location of the phenotype file
     :Parameter param: dictionary that contains all general RNASeq pipeline parameters
-    :Parameter stub: stub indicating the module we are working with    
+    :Parameter stub: stub indicating the module we are working with
     """
+    outputs = [param['working_dir']+'deliverables/'+stub+'_raw_counts.RDS',
+               param['working_dir']+'deliverables/'+stub+'_normalized_counts.RDS',
+               param['working_dir']+'report/'+stub+'/'+stub+'_pca.html',
+               param['working_dir']+'report/'+stub+'/'+stub+'_boxplot.png']
+    if is_up_to_date(outputs, [count_file, pheno_file]):
+        HELPER.writeLog('ESet is up to date ... \n', param)
+        write_eset_report(param, stub)
+        return
+
     HELPER.writeLog('Creating ESet ... \n', param)
     #create a Bioconductor ExpresionSet
     call = [param['Rscript_exec']]
@@ -297,6 +400,13 @@ def create_eset(count_file, pheno_file, param, stub):
                                      stderr=subprocess.PIPE).communicate()
     HELPER.writeLog(output, param)
     HELPER.writeLog(error, param)
+    write_eset_report(param, stub)
+
+def write_eset_report(param, stub):
+    """Links the PCA and the boxplot of the ESet in the report
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter stub: stub indicating the module we are working with
+    """
     param['module_report'].write('<br><a href="' + stub + '_pca.html">PCA on normalized samples</a>')
     param['module_report'].write('<br><center><h3>Boxplot of counts in CPM space</h3>')
     param['module_report'].write('<img src="' + stub + '_boxplot.png"' +
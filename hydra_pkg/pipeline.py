@@ -26,6 +26,8 @@ are executed as well.
 """
 import hydra_pkg.helper
 HELPER = hydra_pkg.helper
+import hydra_pkg.scheduler
+SCHEDULER = hydra_pkg.scheduler
 import hydra_pkg.fastqc
 import hydra_pkg.tophat
 import hydra_pkg.bamqc
@@ -36,9 +38,19 @@ import hydra_pkg.htseq
 import hydra_pkg.featureCount
 import hydra_pkg.star
 import hydra_pkg.bowtie2
+import hydra_pkg.postalign
+import hydra_pkg.qc_trim
+import hydra_pkg.trim_align
+import hydra_pkg.fastq_io
+FASTQ_IO = hydra_pkg.fastq_io
 
 import sys
 
+#modules of the aligners
+ALIGNERS = {'tophat':hydra_pkg.tophat,
+            'star':hydra_pkg.star,
+            'bowtie2':hydra_pkg.bowtie2}
+
 
 def initialize_all(param):
     """this function calls the initialize functions of every module
@@ -59,93 +71,238 @@ def initialize_all(param):
     elif param['aligner'] == 'bowtie2':
         hydra_pkg.bowtie2.init(param)
 
-def run_all(param):
-    """this function defines the workflow of the pipeline
+def get_trimmed_format(param):
+    """Format of the trimmed fastq files, the intermediate_format if every
+    step that reads them supports it and gzip otherwise
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    readers = []
+    if not param['fused_qc_trimming']:
+        readers.append(hydra_pkg.fastqc.INPUT_FORMATS)
+    if not param['QC_and_trim_only'] and param['aligner'] in ALIGNERS:
+        readers.append(ALIGNERS[param['aligner']].INPUT_FORMATS)
+    trimmed_format = FASTQ_IO.negotiate_format(param['intermediate_format'], readers)
+    if trimmed_format != param['intermediate_format']:
+        HELPER.writeLog('The trimmed fastq files are written as '+trimmed_format+
+                        ', not all steps that read them support '+
+                        param['intermediate_format']+'\n', param)
+    return trimmed_format
+
+def is_streamed(param):
+    """Checks if the trimmed reads are streamed into the aligner in the same
+    job (see trim_align), which skips the fastqc run on the trimmed files.
+    The QC filter needs that run before the alignment, so samples are only
+    streamed if remove_failed is not set.
 
     :Parameter param: dictionary that contains all general RNASeq pipeline parameters
     """
+    return (param['stream_trimmed_fastq'] and not param['skip_trimming'] and
+            not param['QC_and_trim_only'] and not param['remove_failed'] and
+            param['aligner'] in ALIGNERS)
+
+def get_stages(param):
+    """this function defines the workflow of the pipeline as a list of steps
+    and the steps each of them depends on. The cores and memory of a step are
+    defaults, which are replaced by the settings in the parameter file or
+    what the step used in previous runs (see resources)
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    stages = []
+    aligned = ''
     if param['aligner'] == 'skip':
         param['bam_files'] = param['raw_files'][:]
     else:
-        #preprocessing fastq file
-        HELPER.submit_job(param, 'run_fastqc', input_files='raw_files')
         param['fastq_files'] = param['raw_files'][:]
         if param['paired']:
             param['fastq_files2'] = param['raw_files2'][:]
+        param['trimmed_format'] = get_trimmed_format(param)
 
-        if not param['skip_trimming']:
-            HELPER.submit_job(param,
-                              'run_cutadapt',
-                              input_files='raw_files',
-                              output_files='fastq_files')
-            HELPER.submit_job(param,
-                              'run_fastqc',
-                              input_files='fastq_files')
+        trimmed = ''
+        qc_gate = False
+        streamed = is_streamed(param)
+        if param['stream_trimmed_fastq'] and not streamed and param['remove_failed']:
+            HELPER.writeLog('The trimmed reads are not streamed into the aligner, '+
+                            'the QC filter needs the fastqc results of the trimmed files\n',
+                            param)
+        if streamed:
+            if not param['fused_qc_trimming']:
+                SCHEDULER.add_stage(stages,
+                                    'run_fastqc',
+                                    input_files='raw_files',
+                                    cores='1',
+                                    cache_parameters=hydra_pkg.fastqc.CACHE_PARAMETERS)
+            #trimming and alignment in a single job, the trimmed reads are
+            #handed to the aligner without writing them to the disk
+            aligned = SCHEDULER.add_stage(stages,
+                                          'run_trim_align',
+                                          input_files='raw_files',
+                                          output_files='bam_files',
+                                          cores=param['qsub_num_processors'],
+                                          mem_free=('standard' if param['aligner'] == 'tophat'
+                                                    else '32G'),
+                                          cache_parameters=(
+                                              hydra_pkg.trim_align.CACHE_PARAMETERS+
+                                              ALIGNERS[param['aligner']].CACHE_PARAMETERS))
+        elif param['fused_qc_trimming'] and not param['skip_trimming']:
+            #QC of the raw and the trimmed files while they are trimmed, in a
+            #single pass over the fastq files
+            trimmed = SCHEDULER.add_stage(stages,
+                                          'run_qc_trim',
+                                          input_files='raw_files',
+                                          output_files='fastq_files',
+                                          cores=param['qsub_num_processors'],
+                                          after=remove_failed,
+                                          barrier=(param['remove_failed'] and
+                                                   not param['run_per_sample']),
+                                          cache_parameters=hydra_pkg.qc_trim.CACHE_PARAMETERS)
+            qc_gate = param['remove_failed'] and param['run_per_sample']
+        else:
+            #preprocessing fastq file
+            SCHEDULER.add_stage(stages,
+                                'run_fastqc',
+                                input_files='raw_files',
+                                cores='1',
+                                cache_parameters=hydra_pkg.fastqc.CACHE_PARAMETERS)
 
-            #if indicated remove samples that failed the QC
+        if (not param['skip_trimming'] and not param['fused_qc_trimming'] and
+                not streamed):
+            trimmed = SCHEDULER.add_stage(stages,
+                                          'run_cutadapt',
+                                          input_files='raw_files',
+                                          output_files='fastq_files',
+                                          cores=(param['qsub_num_processors']
+                                                 if param['cutadapt_trimmer'] == 'builtin'
+                                                 else '1'),
+                                          cache_parameters=hydra_pkg.cutadapt.CACHE_PARAMETERS)
+            #if indicated remove samples that failed the QC, which means the
+            #alignment has to wait for the QC of all samples unless every
+            #sample checks its own QC
+            trimmed_qc = SCHEDULER.add_stage(stages,
+                                             'run_fastqc',
+                                             input_files='fastq_files',
+                                             requires=[trimmed],
+                                             cores='1',
+                                             after=remove_failed,
+                                             barrier=(param['remove_failed'] and
+                                                      not param['run_per_sample']),
+                                             cache_parameters=hydra_pkg.fastqc.CACHE_PARAMETERS)
             if param['remove_failed']:
-                hydra_pkg.fastqc.remove_failed(param, 
-                                               input_files='fastq_files')
+                trimmed = trimmed_qc
+                qc_gate = param['run_per_sample']
 
         #do alignment if it's not just a fastqc run
-        if not param['QC_and_trim_only']:
+        if not param['QC_and_trim_only'] and not streamed:
             if param['aligner'] == 'tophat':
                 #running the aligner
-                HELPER.submit_job(param,
-                                  'run_tophat',
-                                  input_files='fastq_files',
-                                  output_files='bam_files',
-                                  cores=param['qsub_num_processors'])
+                aligned = SCHEDULER.add_stage(stages,
+                                              'run_tophat',
+                                              input_files='fastq_files',
+                                              output_files='bam_files',
+                                              requires=[trimmed],
+                                              qc_gate=qc_gate,
+                                              cores=param['qsub_num_processors'],
+                                              cache_parameters=hydra_pkg.tophat.CACHE_PARAMETERS)
             elif param['aligner'] == 'star':
                 #running the aligner
-                HELPER.submit_job(param,
-                                  'run_star',
-                                  input_files='fastq_files',
-                                  output_files='bam_files',
-                                  cores=param['qsub_num_processors'],
-                                  mem_free='32G')
+                aligned = SCHEDULER.add_stage(stages,
+                                              'run_star',
+                                              input_files='fastq_files',
+                                              output_files='bam_files',
+                                              requires=[trimmed],
+                                              qc_gate=qc_gate,
+                                              cores=param['qsub_num_processors'],
+                                              mem_free='32G',
+                                              cache_parameters=hydra_pkg.star.CACHE_PARAMETERS)
             elif param['aligner'] == 'bowtie2':
                 #running the aligner
-                HELPER.submit_job(param,
-                                  'run_bowtie2',
-                                  input_files='fastq_files',
-                                  output_files='bam_files',
-                                  cores=param['qsub_num_processors'],
-                                  mem_free='32G')
+                aligned = SCHEDULER.add_stage(stages,
+                                              'run_bowtie2',
+                                              input_files='fastq_files',
+                                              output_files='bam_files',
+                                              requires=[trimmed],
+                                              qc_gate=qc_gate,
+                                              cores=param['qsub_num_processors'],
+                                              mem_free='32G',
+                                              cache_parameters=hydra_pkg.bowtie2.CACHE_PARAMETERS)
             else:
                 HELPER.writeLog('The selected aligner does not exist.', param)
                 sys.exit(0)
 
     if not param['QC_and_trim_only']:
-        #Bamqc
-        HELPER.submit_job(param,
-                          'run_bamqc',
-                          input_files='bam_files')
+        #Bamqc, either on its own or together with the htseq counts in a
+        #single pass over the bam files
+        fused = param['fused_post_alignment'] and param['run_htseq']
+        if fused:
+            SCHEDULER.add_stage(stages,
+                                'run_postalign',
+                                input_files='bam_files',
+                                output_files='count_files',
+                                requires=[aligned],
+                                cores='1',
+                                after=hydra_pkg.htseq.finalize,
+                                cache_parameters=hydra_pkg.postalign.CACHE_PARAMETERS)
+        else:
+            #the aligners index their sorted bam files, which bamqc reads by
+            #regions in parallel, unsorted files are read as a single stream
+            bamqc_cores = '1-8'
+            if (param['aligner'] == 'star' and
+                    param['outputSAMtype'] != 'BAM_SortedByCoordinate'):
+                bamqc_cores = '1'
+            SCHEDULER.add_stage(stages,
+                                'run_bamqc',
+                                input_files='bam_files',
+                                requires=[aligned],
+                                cores=bamqc_cores,
+                                cache_parameters=hydra_pkg.bamqc.CACHE_PARAMETERS)
 
-        #Getting the counts:
+        #Getting the counts, all of them only depend on the bam files:
         if param['run_cufflinks']:
-            HELPER.submit_job(param,
-                              'run_cufflinks',
-                              input_files='bam_files',
-                              output_files='count_files')
-            hydra_pkg.cufflinks.finalize(param,
-                                         input_files='count_files')
-
-        if param['run_htseq']:
-            HELPER.submit_job(param,
-                              'run_htseq',
-                              input_files='bam_files',
-                              output_files='count_files')
-            hydra_pkg.htseq.finalize(param,
-                                     input_files='count_files')
+            SCHEDULER.add_stage(stages,
+                                'run_cufflinks',
+                                input_files='bam_files',
+                                output_files='count_files',
+                                requires=[aligned],
+                                after=hydra_pkg.cufflinks.finalize,
+                                cache_parameters=hydra_pkg.cufflinks.CACHE_PARAMETERS)
+
+        if param['run_htseq'] and not fused:
+            SCHEDULER.add_stage(stages,
+                                'run_htseq',
+                                input_files='bam_files',
+                                output_files='count_files',
+                                requires=[aligned],
+                                cores='1',
+                                after=hydra_pkg.htseq.finalize,
+                                cache_parameters=hydra_pkg.htseq.CACHE_PARAMETERS)
 
         if param['run_featureCount']:
-            HELPER.submit_job(param,
-                              'run_featureCount',
-                              input_files='bam_files',
-                              output_files='count_files')
-            hydra_pkg.featureCount.finalize(param,
-                                            input_files='count_files')
+            SCHEDULER.add_stage(stages,
+                                'run_featureCount',
+                                input_files='bam_files',
+                                output_files='count_files',
+                                requires=[aligned],
+                                cores='1',
+                                after=hydra_pkg.featureCount.finalize,
+                                cache_parameters=hydra_pkg.featureCount.CACHE_PARAMETERS)
+    return stages
+
+def remove_failed(param):
+    """removes the samples that failed the QC after trimming if indicated
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    if param['remove_failed']:
+        hydra_pkg.fastqc.remove_failed(param,
+                                       input_files='fastq_files')
+
+def run_all(param):
+    """this function runs the workflow of the pipeline
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    SCHEDULER.run_stages(param, get_stages(param))
 
 def report_all(param):
     """this function calls the reporting functions of every module
@@ -156,7 +313,7 @@ def report_all(param):
         hydra_pkg.fastqc.report(param,
                                 input_files='raw_files',
                                 header='FastQC results on the raw data')
-        if not param['skip_trimming']:
+        if not param['skip_trimming'] and not is_streamed(param):
             hydra_pkg.fastqc.report(param,
                                     input_files='fastq_files',
                                     header='FastQC results after preprocessing')
@@ -0,0 +1,69 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Postalign module
+Runs the bamqc statistics and the gene counts of a sample in a single pass
+over its bam file (fused_post_alignment = TRUE), instead of reading the bam
+file once for bamqc and once for htseq-count. The counts are created by the
+built-in counter (see gene_counts) with the HTSeq_* parameters and the
+annotation index that was built when the pipeline started. The results
+are written where the bamqc and the htseq steps write them, so the reports
+and htseq.finalize are the same for both ways of running the pipeline.
+"""
+import os
+import subprocess
+from hydra_pkg import module_helper as MODULE_HELPER
+
+#parameters the results of this module depend on, see cache.py
+CACHE_PARAMETERS = ['bamqc_script', 'HTSeq_t', 'HTSeq_m', 'HTSeq_id',
+                    'genome_annotation_gft', 'stranded']
+
+def main():
+    """Main function that is run on each samples, which calls the bamqc
+    script with the gene counting switched on
+    """
+    import sys
+    param = MODULE_HELPER.initialize_module()
+
+    #output directories of the bamqc and htseq steps
+    bamqc_dir = param['working_dir']+'results/bamqc/'+param['outstub']+'/'
+    htseq_dir = param['working_dir']+'results/htseq/'
+    for directory in [bamqc_dir, htseq_dir]:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+    count_file = htseq_dir+param['outstub']+'.txt'
+
+    call = [param['bamqc_script'],
+            '-i', param['working_file'],
+            '-o', bamqc_dir,
+            '-x', param['annotation_index'],
+            '-c', count_file,
+            '-s', param['stranded'],
+            '-t', param['HTSeq_t'],
+            '-a', param['HTSeq_id'],
+            '-m', param['HTSeq_m']]
+
+    param['file_handle'].write('CALL: '+' '.join(call)+'\n')
+    output, error = subprocess.Popen(call,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE).communicate()
+    param['file_handle'].write(error)
+    param['file_handle'].write(output)
+
+    #if outputfile doesn't exits?
+    if not os.path.exists(bamqc_dir+'stats.json') or not os.path.exists(count_file):
+        param['file_handle'].write('QC and counting did not finish correctly..')
+        sys.exit()
+
+    MODULE_HELPER.wrapup_module(param, [count_file])
@@ -0,0 +1,85 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""QC trim module
+Trims the fastq files of a sample with the built-in trimmer and collects
+the QC statistics of the raw and the trimmed reads in the same pass
+(fused_qc_trimming = TRUE), instead of running fastqc on the raw files,
+cutadapt and fastqc on the trimmed files one after another. The results
+are written where the fastqc and cutadapt steps write them, so the fastqc
+reports and the QC filter are the same for both ways of running the
+pipeline.
+"""
+import os
+import sys
+from hydra_pkg import module_helper as MODULE_HELPER
+from hydra_pkg import trimmer as TRIMMER
+from hydra_pkg import fastq_stats as FASTQ_STATS
+from hydra_pkg import fastq_io as FASTQ_IO
+from hydra_pkg import fastqc as FASTQC
+
+#parameters the results of this module depend on, see cache.py
+CACHE_PARAMETERS = ['cutadapt_first_adapter', 'cutadapt_second_adapter',
+                    'cutadapt_m', 'cutadapt_q_end', 'cutadapt_q_start',
+                    'cutadapt_u', 'paired', 'trimmed_format',
+                    'intermediate_compression_level']
+
+def get_fastqc_dir(param, filename):
+    """Directory of the fastqc results of a file
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter filename: fastq file
+    """
+    return (param['working_dir']+'results/fastqc/'+param['outstub']+'/'+
+            FASTQC.get_fastqc_name(filename))
+
+def main():
+    """Main function that is run on each samples, which trims the fastq
+    files and writes the fastqc results of the raw and the trimmed files
+    """
+    param = MODULE_HELPER.initialize_module()
+
+    #output of the cutadapt step
+    trim_dir = param['working_dir']+'results/cutadapt/'
+    if not os.path.exists(trim_dir):
+        os.makedirs(trim_dir)
+    input_files = [param['working_file']]
+    extension = FASTQ_IO.EXTENSIONS[param['trimmed_format']]
+    output_files = [trim_dir+param['outstub']+'.clipped'+extension]
+    if param['paired']:
+        input_files.append(param['working_file2'])
+        output_files.append(trim_dir+param['outstub']+'.clipped.2'+extension)
+
+    param['file_handle'].write('Trimming and QC of '+' '.join(input_files)+'\n')
+    try:
+        stats = TRIMMER.trim_files(input_files,
+                                   output_files,
+                                   output_files[0]+'.txt',
+                                   TRIMMER.get_options(param),
+                                   int(param['num_processors']),
+                                   qc=True)
+    except (IOError, OSError, ValueError) as error:
+        param['file_handle'].write('ERROR: '+str(error)+'\n')
+        sys.exit(0)
+    with open(output_files[0]+'.txt') as filehandle:
+        param['file_handle'].write(filehandle.read())
+
+    for idx in range(len(input_files)):
+        FASTQ_STATS.write_fastqc(stats['raw_qc'][idx],
+                                 input_files[idx].split('/')[-1],
+                                 get_fastqc_dir(param, input_files[idx]))
+        FASTQ_STATS.write_fastqc(stats['trimmed_qc'][idx],
+                                 output_files[idx].split('/')[-1],
+                                 get_fastqc_dir(param, output_files[idx]))
+    MODULE_HELPER.wrapup_module(param, output_files)
@@ -12,87 +12,110 @@
 #See the License for the specific language governing permissions and
 #limitations under the License.
 
-""" qsub module that handles all interaction with the qsub system, which includes
-writing a qsub file, submitting to the qsub system and waiting for the jobs to
-finish.
+""" qsub module that handles all interaction with the SGE qsub system, which
+includes writing a qsub file, submitting to the qsub system and waiting for the
+jobs to finish. Every step is submitted as a single array job with one task per
+sample and is tracked by the sentinel files its tasks write and the job id qsub
+returns, so pipelines of the same user do not wait on each other's jobs.
 """
 
 import os
-import time
+import re
 import subprocess
 from hydra_pkg.logs import writeLog
+from hydra_pkg import backend_helper as BACKEND_HELPER
 
-def initialize_qsub(param):
+#the jobs run and write their results, see backend_helper
+SIDE_EFFECTS = True
+
+def init(param):
     """ Init function that initializes all qsub parameters
 
     :Parameter param: dictionary that contains all general RNASeq pipeline parameters
     """
+    if param['qsub_parallel_env'] == '':
+        param['qsub_parallel_env'] = 'single_node'
+
+def is_queued(scheduler_id):
+    """Checks if a job is still known to the qsub system
 
+    :Parameter scheduler_id: job id that was returned by qsub
+    """
+    process = subprocess.Popen(['qstat', '-j', scheduler_id],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    output, error = process.communicate()
+    if 'do not exist' in output + error:
+        return False
+    return process.returncode == 0
 
-def wait_for_qsub(param, job_id):
-    """This function checks the qsub system and determines whether the job has finished
+def get_status(param, scheduler_id):
+    """Status of a job in the qsub system
 
     :Parameter param: dictionary that contains all general RNASeq pipeline parameters
-    :Parameter job_id: random integer representing the job id for the current batch
+    :Parameter scheduler_id: job id that was returned by qsub
+    :return parameter: 'queued' or 'finished'
     """
+    if is_queued(scheduler_id):
+        return 'queued'
+    return 'finished'
 
-    user, _ = subprocess.Popen(args=['whoami'],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE).communicate()
-    user = user.rstrip()
-
-    #wait until there are no jobs with the current job name in the queue anymore
-    qjobs = param['num_samples']
-    writeLog('Waiting for single '+
-             param['current_flag']+
-             ' jobs to finish.... \n',
-             param)
-    while qjobs > 0:
-        qjobs = 0
-        time.sleep(param['qsub_wait_time'])
-        # check the number of jobs
-        call = ['qstat', '-u', '$USER']
-        output, _ = subprocess.Popen(call,
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE).communicate()
+def wait_for_jobs(param, scheduler_ids):
+    """Waits until the jobs of the current step are finished
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter scheduler_ids: job ids returned by qsub for the current batch
+    """
+    BACKEND_HELPER.wait_for_sentinels(param, scheduler_ids, is_queued)
 
-        #add grabbing the job IDs
-        if len(output) == 0:
-            qjobs = 0
-        else:
-            for current_line in output.split('\n'):
-                if user in current_line and job_id in current_line:
-                    qjobs += 1
     #change writing permissions in qsub directory so that group has access to
     #the qlog files. Otherwise other people cannot rerun the pipeline
     for filename in os.listdir(param['qsub_dir']):
         os.chmod(param['qsub_dir'] + filename, 0770)
 
+def cancel_jobs(param, scheduler_ids):
+    """Removes the jobs of the current step from the qsub system
 
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter scheduler_ids: job ids returned by qsub for the current batch
+    """
+    for scheduler_id in BACKEND_HELPER.get_array_ids(scheduler_ids):
+        subprocess.Popen(['qdel', scheduler_id],
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE).communicate()
+        writeLog('Cancelled job '+scheduler_id+'\n', param)
 
-def submit_jobs(index, param, py_file, job_id, cores, mem_free):
-    """Function that submits a single job into the qsub system
+def submit_jobs(param, indices, py_file, job_id, cores, mem_free, hold_jobs):
+    """Function that submits the jobs of all samples as a single array job
+    into the qsub system.
 
-    :Parameter index: index of the current file we are working on
     :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter indices: indices of the files that should be run
     :Parameter py_file: wrapper that needs to be called to run the current step
+    :Parameter job_id: name of the job
     :Parameter cores: number of cores that should be used
+    :Parameter mem_free: memory that should be reserved for each job
+    :Parameter hold_jobs: list with the job ids for every sample that have to
+                          finish before the sample can start
+    :return parameter: scheduler job id for every sample
     """
-    cmd = (py_file +
-           ' -i ' + str(index) +
-           ' -n $NSLOTS' +
-           ' -d ' +  param['working_dir'])
+    cmd = BACKEND_HELPER.get_task_commands(param,
+                                           indices,
+                                           py_file,
+                                           '$((SGE_TASK_ID-1))',
+                                           '$NSLOTS')
 
     #make a directory for all the qsub commands
     param['qsub_dir'] = param['working_dir']+'results/qsub/'
     if not os.path.exists(param['qsub_dir']):
         os.makedirs(param['qsub_dir'])
     qsub_dir = param['working_dir']+'results/qsub/'
-    qsub_filename = qsub_dir+(param['stub'])[index]+'.qsub'
+    qsub_filename = qsub_dir+param['current_flag']+'.qsub'
 
     outhandle = QsubClass(qsub_filename)
     outhandle.qsub_dir = qsub_dir
     outhandle.job_id = job_id
+    outhandle.num_tasks = BACKEND_HELPER.get_num_tasks(param)
     outhandle.email = param['qsub_email']
     outhandle.send_email = param['qsub_send_email']
     if mem_free == 'standard':
@@ -100,19 +123,44 @@ def submit_jobs(index, param, py_file, job_id, cores, mem_free):
     else:
         outhandle.memory = mem_free
     outhandle.project = param['qsub_PROJECT']
-    outhandle.machine = param['qsub_MACHINE']
     outhandle.runtime_limit = param['qsub_RUNTIME_LIMIT']
-    outhandle.output_file([cmd])
+    outhandle.output_file(cmd)
 
     #call qsub script
     call = ['qsub']
-    call.append('-pe')
-    call.append('single_node')
-    call.append(cores)
+    if param['qsub_parallel_env'] != 'none':
+        call.append('-pe')
+        call.append(param['qsub_parallel_env'])
+        call.append(cores)
+    #let the scheduler start the task of a sample as soon as the tasks of
+    #the same sample it depends on are done
+    hold = BACKEND_HELPER.get_array_ids([jid for jids in hold_jobs for jid in jids])
+    if len(hold) > 0:
+        call.append('-hold_jid_ad')
+        call.append(','.join(hold))
     call.append(qsub_filename)
-    _, _ = subprocess.Popen(call,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE).communicate()
+    output, error = subprocess.Popen(call,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE).communicate()
+    scheduler_id = get_scheduler_id(output)
+    if scheduler_id == '':
+        writeLog('Submitting '+param['current_flag']+' failed: '+error+'\n', param)
+    else:
+        writeLog('Submitted '+param['current_flag']+' as job '+scheduler_id+'\n', param)
+    return [scheduler_id if idx in indices else ''
+            for idx in range(param['num_samples'])]
+
+def get_scheduler_id(output):
+    """Extracts the job id from the qsub output, which looks like
+    'Your job 123456 ("HyDrA_42") has been submitted'
+
+    :Parameter output: standard output of the qsub call
+    :return parameter: job id as string, empty if the submission failed
+    """
+    match = re.search(r'Your job(?:-array)? (\d+)', output)
+    if match is None:
+        return ''
+    return match.group(1)
 
 class QsubClass():
     """Class to output a qsub file
@@ -126,8 +174,8 @@ class QsubClass():
         self.filename = name
         self.qsub_dir = './'
         self.job_id = -1
+        self.num_tasks = 0
         self.email = ''
-        self.machine = ''
         self.memory = ''
         self.runtime_limit = ''
         self.project = ''
@@ -152,15 +200,9 @@ class QsubClass():
         """
         self.output_handle_gen()
 
-        if self.machine == "scc":
-            self.handle.write("source ~/.bashrc\n")
-            #self.handle.write("#!bin/bash\n")
-            self.handle.write("\n")
-
-        else:
-            self.handle.write("#!bin/bash\n")
-            self.handle.write("#\n")
-            self.handle.write("\n")
+        self.handle.write("#!/bin/bash\n")
+        self.handle.write("#\n")
+        self.handle.write("\n")
 
         if self.runtime_limit != '':
             self.handle.write("#$ -l h_rt="+self.runtime_limit+'\n')
@@ -188,9 +230,17 @@ class QsubClass():
             filename_info = filename_info_list[-1]
         else:
             filename_info = self.filename
-        self.handle.write("#$ -o "+ self.qsub_dir + filename_info +".qlog\n")
+        if self.num_tasks > 0:
+            self.handle.write("#$ -o "+ self.qsub_dir + filename_info +".$TASK_ID.qlog\n")
+        else:
+            self.handle.write("#$ -o "+ self.qsub_dir + filename_info +".qlog\n")
         self.handle.write("\n")
 
+        if self.num_tasks > 0:
+            self.handle.write("# Run one task per sample\n")
+            self.handle.write("#$ -t 1-"+str(self.num_tasks)+"\n")
+            self.handle.write("\n")
+
         if self.project != "":
             self.handle.write("# Project this job belongs to \n")
             self.handle.write("#$ -P " + self.project+ " \n")
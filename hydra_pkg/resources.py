@@ -0,0 +1,178 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Resources module
+Decides how many cores and how much memory the jobs of a step reserve. The
+resources of a step are taken from, in this order:
+
+1. the parameter file, e.g. star_cores = 8 and star_mem_free = 40G
+2. previous runs of the step, based on the peak memory and the CPU time
+   every job recorded in its sentinel file. The peak memory is summed over
+   the processes of the job that ran at the same time, so it can raise or
+   lower the memory of the step. A step whose jobs kept all their cores busy
+   may grow up to the largest number of cores it is allowed to use
+3. the defaults of the step in pipeline.get_stages
+
+The usage of every job is appended to the resource history file, which is
+kept outside of the results directory, so it survives a clean run and can be
+shared by several projects.
+"""
+import math
+import os
+from hydra_pkg import backend_helper as BACKEND_HELPER
+from hydra_pkg import sentinel as SENTINEL
+
+#number of finished jobs of a step before their usage is trusted
+MIN_HISTORY = 3
+#only the latest jobs of a step are taken into account
+MAX_HISTORY = 50
+#extra memory on top of the largest peak memory that was seen
+MEMORY_HEADROOM = 1.2
+#part of its cores a job has to keep busy to count as limited by its cores
+BUSY_FRACTION = 0.8
+#part of the memory of a job that samtools sort may use, the rest is left
+#for the aligner that writes into it
+SORT_MEMORY_FRACTION = 0.5
+#samtools sort needs at least a few megabytes per thread
+MIN_SORT_MEMORY = 64
+
+HISTORY_HEADER = ['step', 'sample', 'max_rss_kb', 'cpu_seconds',
+                  'wall_seconds', 'cores']
+
+def init(param):
+    """Init function that initializes the resource history file
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    if param['resource_history'] == '':
+        param['resource_history'] = param['working_dir']+'resource_history.txt'
+
+def read_history(param, step_name):
+    """Reads the latest recorded jobs of a step
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter step_name: name of the module, e.g. star
+    :return parameter: list of (max_rss_kb, cpu_seconds, wall_seconds, cores)
+    """
+    history = []
+    if not os.path.exists(param['resource_history']):
+        return history
+    handle = open(param['resource_history'])
+    for line in handle:
+        values = line.rstrip('\n').split('\t')
+        if values[0] == step_name and len(values) == len(HISTORY_HEADER):
+            history.append((int(values[2]), float(values[3]),
+                            float(values[4]), int(values[5])))
+    handle.close()
+    return history[-MAX_HISTORY:]
+
+def format_memory(max_rss_kb):
+    """Memory in whole gigabytes with some headroom, e.g. 3G
+
+    :Parameter max_rss_kb: peak memory in kB
+    """
+    gigabytes = int(math.ceil(max_rss_kb*MEMORY_HEADROOM/(1024.0*1024.0)))
+    return str(max(1, gigabytes))+'G'
+
+def parse_memory(mem_free):
+    """Memory in megabytes, e.g. 4096 for 4g or 4G
+
+    :Parameter mem_free: memory with an optional unit (k, m, g or t), bytes
+                         without a unit
+    """
+    units = {'k':1.0/1024, 'm':1, 'g':1024, 't':1024*1024}
+    value = mem_free.strip().lower()
+    if value[-1] in units:
+        return int(float(value[:-1])*units[value[-1]])
+    return int(float(value)/(1024*1024))
+
+def get_sort_memory(param, threads, fraction=SORT_MEMORY_FRACTION):
+    """Memory per thread for samtools sort -m, a part of the memory that was
+    reserved for the job is shared by all sort threads
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter threads: number of sort threads
+    :Parameter fraction: part of the memory of the job that is used for sorting
+    """
+    mem_free = param.get('mem_free', '')
+    if mem_free in ['', 'standard']:
+        mem_free = param['qsub_memory']
+    memory = int(parse_memory(mem_free)*fraction/max(1, int(threads)))
+    return str(max(MIN_SORT_MEMORY, memory))+'M'
+
+def get_profile(param, cores, mem_free):
+    """Cores and memory the jobs of the current step should reserve
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter cores: default number of cores of the step, e.g. '1-8'
+    :Parameter mem_free: default memory of the step or 'standard'
+    :return parameter: tuple of cores and memory
+    """
+    step_name = param['current_dir']
+    history = read_history(param, step_name)
+    if len(history) >= MIN_HISTORY:
+        #use as many cores as the jobs kept busy, jobs that kept all their
+        #cores busy might have used more, so they may grow up to the
+        #number of cores the step is allowed to use
+        max_cores = BACKEND_HELPER.get_max_cores(cores)
+        needed = 1
+        for _, cpu, wall, used in history:
+            busy = cpu/max(wall, 1.0)
+            if busy >= BUSY_FRACTION*max(1, used):
+                needed = max_cores
+            else:
+                needed = max(needed, int(math.ceil(busy)))
+        if needed < max_cores:
+            min_cores = min(needed, int(str(cores).split('-')[0]))
+            if min_cores < needed:
+                cores = str(min_cores)+'-'+str(needed)
+            else:
+                cores = str(needed)
+        mem_free = format_memory(max([rss for rss, _, _, _ in history]))
+
+    #settings in the parameter file win over everything else
+    if param.get(step_name+'_cores', '') != '':
+        cores = str(param[step_name+'_cores'])
+    if param.get(step_name+'_mem_free', '') != '':
+        mem_free = str(param[step_name+'_mem_free'])
+    return cores, mem_free
+
+def record_usage(param, scheduler_ids):
+    """Appends the usage of all jobs of the current step that finished
+    successfully to the resource history file
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter scheduler_ids: job id for every sample, empty if not submitted
+    """
+    lines = []
+    for idx in range(len(scheduler_ids)):
+        if scheduler_ids[idx] == '':
+            continue
+        sentinel = SENTINEL.read_sentinel(param, idx)
+        if sentinel is None or sentinel['status'] != 'done':
+            continue
+        lines.append('\t'.join([param['current_dir'],
+                                param['stub'][idx],
+                                str(sentinel['max_rss']),
+                                '%.1f' %(sentinel['cpu_time']),
+                                '%.1f' %(sentinel['wall_time']),
+                                sentinel['cores']]))
+    if len(lines) == 0:
+        return
+    new_file = not os.path.exists(param['resource_history'])
+    handle = open(param['resource_history'], 'a')
+    if new_file:
+        handle.write('\t'.join(HISTORY_HEADER)+'\n')
+    handle.write('\n'.join(lines)+'\n')
+    handle.close()
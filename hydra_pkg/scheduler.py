@@ -0,0 +1,143 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Scheduler module
+Runs the steps of the pipeline as a dependency graph instead of a fixed
+sequence. Every step is submitted as soon as the steps it requires are
+submitted, while the job of a single sample is held by the scheduler until
+the jobs of the same sample it depends on are done. This way independent
+steps run side by side and a sample does not have to wait for the slowest
+sample of the previous step.
+
+Steps that are marked as barrier have to be finished on all samples before
+any step that requires them is submitted, e.g. if failed samples are
+removed after the QC. When the pipeline runs every sample on its own
+(run_per_sample) the QC filter is instead checked by the jobs of the next
+step, so every sample moves through the whole chain of jobs without waiting
+for the rest of the cohort.
+"""
+from hydra_pkg import helper as HELPER
+
+
+def add_stage(stages, py_file, input_files, output_files='', requires=[],
+              cores='1-8', mem_free='standard', after=None, barrier=False,
+              qc_gate=False, cache_parameters=None):
+    """Adds a step to the list of steps
+
+    :Parameter stages: list of steps the new step is appended to
+    :Parameter py_file: name of the python wrapper
+    :Parameter input_files: input filenames
+    :Parameter output_files: output filenames
+    :Parameter requires: names of the steps that have to run before this step
+    :Parameter cores: number of cores that should be used if available
+    :Parameter mem_free: memory that should be reserved for each job
+    :Parameter after: function that is called with the parameter object once
+                      the step finished on all samples
+    :Parameter barrier: indicates that dependent steps can only be started once
+                        this step finished on all samples
+    :Parameter qc_gate: indicates that the jobs of this step check the fastqc
+                        results of their sample before running, which replaces
+                        the QC barrier when samples are run independently
+    :Parameter cache_parameters: names of the parameters the results of the step
+                                 depend on, usually CACHE_PARAMETERS of the module
+    :return parameter: name of the step, which is the same as its log flag
+    """
+    stage = dict()
+    stage['name'] = py_file[4:] + '_' + input_files
+    stage['py_file'] = py_file
+    stage['input_files'] = input_files
+    stage['output_files'] = output_files
+    stage['requires'] = [name for name in requires if name != '']
+    stage['cores'] = cores
+    stage['mem_free'] = mem_free
+    stage['after'] = after
+    stage['barrier'] = barrier
+    stage['qc_gate'] = qc_gate
+    stage['cache_parameters'] = cache_parameters
+    stages.append(stage)
+    return stage['name']
+
+def finish_stage(param, stage, step):
+    """Waits for a step to finish on all samples and runs its follow up function
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter stage: step as created by add_stage
+    :Parameter step: step dictionary returned by HELPER.start_job
+    """
+    HELPER.finish_job(param, step)
+    #a dry run has no results the follow up function could work on
+    if stage['after'] is not None and HELPER.has_side_effects(param):
+        stage['after'](param)
+
+def cancel_stages(param, running):
+    """Cancels the jobs of all steps that are not finished yet
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter running: list of (stage, step) tuples of the unfinished steps
+    """
+    for _, step in running:
+        if step['submitted']:
+            param.update(step['param'])
+            HELPER.get_backend(param).cancel_jobs(param, step['scheduler_ids'])
+
+def run_stages(param, stages):
+    """Runs all steps, the list has to be ordered so that every step comes
+    after the steps it requires.
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter stages: list of steps created with add_stage
+    """
+    barriers = [stage['name'] for stage in stages if stage['barrier']]
+    #steps that are started but not finished yet, in the order of submission
+    running = []
+    finished = []
+    scheduler_ids = dict()
+
+    try:
+        for stage in stages:
+            #a barrier and all steps submitted before it have to be finished first
+            while len([name for name in stage['requires']
+                       if name in barriers and name not in finished]) > 0:
+                cur_stage, cur_step = running.pop(0)
+                finish_stage(param, cur_stage, cur_step)
+                finished.append(cur_stage['name'])
+
+            #hold every sample until the same sample is done in the required steps
+            hold_jobs = [[] for _ in range(param['num_samples'])]
+            for name in stage['requires']:
+                if name not in finished:
+                    for idx in range(param['num_samples']):
+                        hold_jobs[idx].append(scheduler_ids[name][idx])
+
+            step = HELPER.start_job(param,
+                                    stage['py_file'],
+                                    input_files=stage['input_files'],
+                                    output_files=stage['output_files'],
+                                    cores=stage['cores'],
+                                    mem_free=stage['mem_free'],
+                                    hold_jobs=hold_jobs,
+                                    qc_gate=stage['qc_gate'],
+                                    cache_parameters=stage['cache_parameters'])
+            scheduler_ids[stage['name']] = step['scheduler_ids']
+            running.append((stage, step))
+
+        #collect the results in the order the steps were submitted
+        while len(running) > 0:
+            cur_stage, cur_step = running.pop(0)
+            finish_stage(param, cur_stage, cur_step)
+            finished.append(cur_stage['name'])
+    except (KeyboardInterrupt, SystemExit):
+        #jobs of later steps are already queued and would run for nothing
+        cancel_stages(param, running)
+        raise
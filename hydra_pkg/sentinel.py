@@ -0,0 +1,250 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Sentinel files
+Every job writes a small file once it is over, <stub>.done if the module
+finished and <stub>.failed otherwise. The pipeline waits for these files
+instead of only asking the queue, using inotify where it is available and
+polling otherwise. Besides the status the file holds the peak memory (kB), the
+CPU time and the wall time (seconds) and the number of cores of the job. The
+peak memory is the memory of the job and all its child processes added up,
+which is sampled while the job runs (see watch_memory), so tools that run at
+the same time, e.g. an aligner and samtools sort, are counted together.
+"""
+import ctypes
+import ctypes.util
+import os
+import resource
+import select
+import threading
+import time
+
+#inotify events for files that are created or moved into a directory
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+#seconds between two samples of the memory of the job
+MEMORY_INTERVAL = 1.0
+#largest memory (kB) of the job and its child processes since the current
+#sample started, see watch_memory
+MEMORY_PEAK = {'rss_kb':0, 'thread':None}
+
+def get_sentinel_dir(param, flag=''):
+    """Directory of the sentinel files of a step
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter flag: flag of the step, the current step if not given
+    """
+    if flag == '':
+        flag = param['current_flag']
+    return param['working_dir']+'results/sentinel/'+flag+'/'
+
+def get_cpu_time():
+    """CPU time (seconds) of this process and the child processes it waited for"""
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (usage_self.ru_utime + usage_self.ru_stime +
+            usage_children.ru_utime + usage_children.ru_stime)
+
+def get_tree_memory(pid):
+    """Resident memory of a process and all processes it started
+
+    :Parameter pid: process id
+    :return parameter: memory in kB, 0 if /proc is not available
+    """
+    children = dict()
+    memory = dict()
+    page_kb = resource.getpagesize()/1024
+    try:
+        proc_ids = [int(name) for name in os.listdir('/proc') if name.isdigit()]
+    except OSError:
+        return 0
+    for proc_id in proc_ids:
+        try:
+            handle = open('/proc/'+str(proc_id)+'/stat')
+            stat = handle.read()
+            handle.close()
+            handle = open('/proc/'+str(proc_id)+'/statm')
+            statm = handle.read()
+            handle.close()
+        except IOError:
+            #the process ended in the meantime
+            continue
+        #the command name in brackets may contain spaces
+        parent = int(stat[stat.rfind(')')+2:].split()[1])
+        children.setdefault(parent, []).append(proc_id)
+        memory[proc_id] = int(statm.split()[1])*page_kb
+    total = 0
+    pending = [pid]
+    while len(pending) > 0:
+        proc_id = pending.pop()
+        total += memory.get(proc_id, 0)
+        pending += children.get(proc_id, [])
+    return total
+
+def sample_memory():
+    """Samples the memory of the job until the job ends"""
+    while True:
+        MEMORY_PEAK['rss_kb'] = max(MEMORY_PEAK['rss_kb'], get_tree_memory(os.getpid()))
+        time.sleep(MEMORY_INTERVAL)
+
+def watch_memory():
+    """Starts to record the peak memory of the current sample, the samples
+    of a batch share the thread that samples the memory
+    """
+    MEMORY_PEAK['rss_kb'] = 0
+    if MEMORY_PEAK['thread'] is None:
+        MEMORY_PEAK['thread'] = threading.Thread(target=sample_memory)
+        MEMORY_PEAK['thread'].daemon = True
+        MEMORY_PEAK['thread'].start()
+
+def write_sentinel(param, status, outputs=[]):
+    """Writes the sentinel file of the current sample. The file is written
+    under a temporary name and renamed, so the pipeline never sees a half
+    written file. Only the first call of a job writes a file. Besides the
+    status the file holds the resources the job used and its output files.
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter status: 'done' or 'failed'
+    :Parameter outputs: output files of the job
+    """
+    if param.get('sentinel_written', False):
+        return
+    param['sentinel_written'] = True
+    sentinel_dir = get_sentinel_dir(param)
+    if not os.path.exists(sentinel_dir):
+        try:
+            os.makedirs(sentinel_dir)
+        except OSError:
+            #another job created it at the same time
+            pass
+    filename = sentinel_dir+param['outstub']+'.'+status
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    #the sampled memory of all processes, the largest single process covers
+    #peaks between two samples
+    max_rss = max(usage_self.ru_maxrss, usage_children.ru_maxrss,
+                  MEMORY_PEAK['rss_kb'])
+    #the samples of a batch share the process, only the time of this sample counts
+    cpu_time = get_cpu_time() - param.get('start_cpu_time', 0.0)
+    wall_time = time.time() - param.get('start_time', time.time())
+    handle = open(filename+'.tmp'+str(os.getpid()), 'w')
+    handle.write('%s\t%d\t%.1f\t%.1f\t%s\t%s\n' %(status, max_rss, cpu_time,
+                                                wall_time,
+                                                param.get('num_processors', '1'),
+                                                ';'.join(outputs)))
+    handle.close()
+    os.rename(filename+'.tmp'+str(os.getpid()), filename)
+
+def clear_sentinels(param, indices):
+    """Removes the sentinel files of samples that are about to be submitted
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter indices: indices of the samples
+    """
+    sentinel_dir = get_sentinel_dir(param)
+    if not os.path.exists(sentinel_dir):
+        os.makedirs(sentinel_dir)
+    for idx in indices:
+        for status in ['done', 'failed']:
+            filename = sentinel_dir+param['stub'][idx]+'.'+status
+            if os.path.exists(filename):
+                os.remove(filename)
+
+def get_status(param, index, flag=''):
+    """Status of a sample in a step
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter index: index of the sample
+    :Parameter flag: flag of the step, the current step if not given
+    :return parameter: 'done', 'failed' or '' if the job is not over yet
+    """
+    sentinel_dir = get_sentinel_dir(param, flag)
+    for status in ['done', 'failed']:
+        if os.path.exists(sentinel_dir+param['stub'][index]+'.'+status):
+            return status
+    return ''
+
+def read_sentinel(param, index, flag=''):
+    """Reads the sentinel file of a sample in a step
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter index: index of the sample
+    :Parameter flag: flag of the step, the current step if not given
+    :return parameter: dictionary with status, max_rss (kB), cpu_time, wall_time,
+                       cores, outputs and ended or None if there is no
+                       sentinel file
+    """
+    status = get_status(param, index, flag)
+    if status == '':
+        return None
+    filename = get_sentinel_dir(param, flag)+param['stub'][index]+'.'+status
+    handle = open(filename)
+    values = handle.readline().rstrip('\n').split('\t')
+    handle.close()
+    if len(values) < 6:
+        return None
+    sentinel = dict()
+    sentinel['status'] = values[0]
+    sentinel['max_rss'] = int(values[1])
+    sentinel['cpu_time'] = float(values[2])
+    sentinel['wall_time'] = float(values[3])
+    sentinel['cores'] = values[4]
+    sentinel['outputs'] = values[5]
+    sentinel['ended'] = os.path.getmtime(filename)
+    return sentinel
+
+def watch_directory(directory):
+    """Starts watching a directory with inotify
+
+    :Parameter directory: directory that is watched
+    :return parameter: inotify file descriptor, -1 if inotify is not available
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fdesc = libc.inotify_init()
+    except (OSError, AttributeError):
+        return -1
+    if fdesc < 0:
+        return -1
+    if libc.inotify_add_watch(fdesc, directory,
+                              IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+        os.close(fdesc)
+        return -1
+    return fdesc
+
+def wait_for_event(fdesc, timeout):
+    """Waits until a file changed in the watched directory or the timeout passed
+
+    :Parameter fdesc: inotify file descriptor returned by watch_directory
+    :Parameter timeout: maximum time to wait in seconds
+    :return parameter: True if there was an event
+    """
+    if fdesc < 0:
+        time.sleep(timeout)
+        return False
+    ready, _, _ = select.select([fdesc], [], [], timeout)
+    if len(ready) > 0:
+        os.read(fdesc, 65536)
+        return True
+    return False
+
+def stop_watching(fdesc):
+    """Closes the inotify file descriptor
+
+    :Parameter fdesc: inotify file descriptor returned by watch_directory
+    """
+    if fdesc >= 0:
+        os.close(fdesc)
@@ -12,28 +12,202 @@
 #See the License for the specific language governing permissions and
 #limitations under the License.
 
-"""This module runs other modules such as tophat or cutadapt in serial instead of
-parallelizing them.
+"""This module runs other modules such as tophat or cutadapt on the current
+node instead of submitting them to the qsub system. The jobs are run in a
+pool of local processes, at most local_max_jobs at the same time with
+local_num_processors threads each, and are collected in the order they finish.
 """
-import shlex
+import multiprocessing
+import os
 import subprocess
+import time
+from hydra_pkg.logs import writeLog
+from hydra_pkg import backend_helper as BACKEND_HELPER
 
-def run_single_job(index, py_file):
-    """Runs jobs sequentially on the current node
+#the jobs run and write their results, see backend_helper
+SIDE_EFFECTS = True
+#all jobs that were started on this node, by job id
+JOBS = dict()
+#job ids in the order they were submitted
+JOB_ORDER = []
 
-    :Parameter index: index of the current file
-    :Parameter job_id: not used
+def init(param):
+    """ Init function that initializes the local process pool parameters
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    if param['local_num_processors'] == '':
+        param['local_num_processors'] = 1
+    if param['local_max_jobs'] == '':
+        param['local_max_jobs'] = max(1, multiprocessing.cpu_count()/
+                                      param['local_num_processors'])
+
+def get_num_processors(param, cores):
+    """Number of threads a local job can use, which is the configured number
+    of threads per job but never more than the step asked for
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter cores: number of cores as specified for qsub, e.g. '1-8' or '4'
     """
+    return min(param['local_num_processors'], BACKEND_HELPER.get_max_cores(cores))
+
+def run_single_job(index, param, py_file, cores='1', hold=[], batch=None):
+    """Adds a job to the local process pool, it starts once a slot is free and
+    all jobs it depends on are done
 
-    #right now I'm using only one core in single cpu mode
-    call = [py_file]
-    call.append('-i')
-    call.append(str(index))
+    :Parameter index: index of the current file
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter py_file: wrapper that needs to be called to run the current step
+    :Parameter cores: number of cores that should be used
+    :Parameter hold: local job ids that have to finish before this job starts
+    :Parameter batch: indices of all files the job runs with run_batch, the
+                      first of them is index
+    :return parameter: local job id
+    """
+    if batch is None:
+        call = [py_file]
+        call.append('-i')
+        call.append(str(index))
+    else:
+        call = ['run_batch']
+        call.append('-s')
+        call.append(py_file)
+        call.append('-i')
+        call.append(','.join([str(idx) for idx in batch]))
     call.append('-n')
-    call.append('1')
-    
-    args = shlex.split(' '.join(call))
-    _, _ = subprocess.Popen(args,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE).communicate()
+    call.append(str(get_num_processors(param, cores)))
+    call.append('-d')
+    call.append(param['working_dir'])
+    call.append('-p')
+    call.append(param['parameter_json'])
+
+    #the output of every job is kept next to the other job logs
+    log_dir = param['working_dir']+'results/local/'
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    job_id = 'local_'+str(len(JOB_ORDER)+1)
+    job = dict()
+    job['args'] = call
+    job['hold'] = [jid for jid in hold if jid != '']
+    job['log'] = log_dir+param['stub'][index]+'.'+param['current_flag']+'.log'
+    job['process'] = None
+    job['done'] = False
+    JOBS[job_id] = job
+    JOB_ORDER.append(job_id)
+    update_jobs(param)
+    return job_id
+
+def submit_jobs(param, indices, py_file, job_id, cores, mem_free, hold_jobs):
+    """Adds the jobs of all given samples to the local process pool
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter indices: indices of the files that should be run
+    :Parameter py_file: wrapper that needs to be called to run the current step
+    :Parameter job_id: name of the job, not used for local jobs
+    :Parameter cores: number of cores that should be used
+    :Parameter mem_free: memory that should be reserved, not used for local jobs
+    :Parameter hold_jobs: list with the job ids for every sample that have to
+                          finish before the sample can start
+    :return parameter: local job id for every sample
+    """
+    scheduler_ids = ['']*param['num_samples']
+    if param['batch_size'] == 1:
+        for index in indices:
+            scheduler_ids[index] = run_single_job(index,
+                                                  param,
+                                                  py_file,
+                                                  cores,
+                                                  hold_jobs[index])
+        return scheduler_ids
+
+    #every batch waits for the jobs of all its samples
+    for batch in BACKEND_HELPER.get_batches(param, indices):
+        job_id = run_single_job(batch[0],
+                                param,
+                                py_file,
+                                cores,
+                                sorted(set([jid for idx in batch for jid in hold_jobs[idx]])),
+                                batch)
+        for index in batch:
+            scheduler_ids[index] = job_id
+    return scheduler_ids
+
+def is_done(job_id):
+    """Checks if a job finished, job ids that are unknown to the local pool
+    are treated as finished
 
+    :Parameter job_id: local job id
+    """
+    return job_id not in JOBS or JOBS[job_id]['done']
+
+def update_jobs(param):
+    """Collects all jobs that finished and starts waiting jobs in the order
+    they were submitted as long as there are free slots
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    running = 0
+    for job_id in JOB_ORDER:
+        job = JOBS[job_id]
+        if job['process'] is not None and not job['done']:
+            if job['process'].poll() is None:
+                running += 1
+            else:
+                job['done'] = True
+                job['handle'].close()
+
+    for job_id in JOB_ORDER:
+        if running >= param['local_max_jobs']:
+            break
+        job = JOBS[job_id]
+        if job['process'] is None and all([is_done(jid) for jid in job['hold']]):
+            job['handle'] = open(job['log'], 'w')
+            job['process'] = subprocess.Popen(job['args'],
+                                              stdout=job['handle'],
+                                              stderr=subprocess.STDOUT)
+            running += 1
+
+def wait_for_jobs(param, job_ids):
+    """Waits until all given jobs finished, while the pool keeps starting
+    and collecting the other jobs as well
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter job_ids: local job ids of the current batch
+    """
+    writeLog('Waiting for single '+
+             param['current_flag']+
+             ' jobs to finish.... \n',
+             param)
+    update_jobs(param)
+    while not all([is_done(jid) for jid in job_ids if jid != '']):
+        time.sleep(1)
+        update_jobs(param)
+
+def get_status(param, scheduler_id):
+    """Status of a local job
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter scheduler_id: local job id
+    :return parameter: 'queued' or 'finished'
+    """
+    update_jobs(param)
+    if is_done(scheduler_id):
+        return 'finished'
+    return 'queued'
+
+def cancel_jobs(param, scheduler_ids):
+    """Stops running jobs and removes waiting jobs from the local pool
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter scheduler_ids: local job ids of the current batch
+    """
+    for job_id in scheduler_ids:
+        if job_id == '' or is_done(job_id):
+            continue
+        job = JOBS[job_id]
+        if job['process'] is not None:
+            job['process'].terminate()
+            job['process'].wait()
+            job['handle'].close()
+        job['done'] = True
@@ -0,0 +1,157 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""SLURM module that handles all interaction with a SLURM cluster. Every step
+is submitted with sbatch as a single array job with one task per sample, the
+task of a sample waits for the task of the same sample in the steps it
+depends on (aftercorr). The same qsub_* parameters as for SGE are used for
+memory, runtime, project and email.
+"""
+
+import os
+import re
+import subprocess
+from hydra_pkg.logs import writeLog
+from hydra_pkg import backend_helper as BACKEND_HELPER
+
+#the jobs run and write their results, see backend_helper
+SIDE_EFFECTS = True
+
+def init(param):
+    """ Init function that initializes all SLURM parameters
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+
+def is_queued(scheduler_id):
+    """Checks if a job is still known to SLURM
+
+    :Parameter scheduler_id: job id that was returned by sbatch
+    """
+    process = subprocess.Popen(['squeue', '-h', '-j', scheduler_id],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    output, _ = process.communicate()
+    return process.returncode == 0 and output.strip() != ''
+
+def get_status(param, scheduler_id):
+    """Status of a job in SLURM
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter scheduler_id: job id that was returned by sbatch
+    :return parameter: 'queued' or 'finished'
+    """
+    if is_queued(scheduler_id):
+        return 'queued'
+    return 'finished'
+
+def wait_for_jobs(param, scheduler_ids):
+    """Waits until the jobs of the current step are finished
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter scheduler_ids: job ids returned by sbatch for the current batch
+    """
+    BACKEND_HELPER.wait_for_sentinels(param, scheduler_ids, is_queued)
+
+def cancel_jobs(param, scheduler_ids):
+    """Removes the jobs of the current step from SLURM
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter scheduler_ids: job ids returned by sbatch for the current batch
+    """
+    for scheduler_id in BACKEND_HELPER.get_array_ids(scheduler_ids):
+        subprocess.Popen(['scancel', scheduler_id],
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE).communicate()
+        writeLog('Cancelled job '+scheduler_id+'\n', param)
+
+def get_memory(memory):
+    """Converts a qsub memory value like 4g into the SLURM format 4G
+
+    :Parameter memory: memory as specified for qsub
+    """
+    return memory.upper().rstrip('B')
+
+def submit_jobs(param, indices, py_file, job_id, cores, mem_free, hold_jobs):
+    """Function that submits the jobs of all samples as a single array job
+    with sbatch. SLURM array tasks are numbered from 0 like the samples,
+    or like the batches of samples if batch_size is above 1.
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter indices: indices of the files that should be run
+    :Parameter py_file: wrapper that needs to be called to run the current step
+    :Parameter job_id: name of the job
+    :Parameter cores: number of cores that should be used
+    :Parameter mem_free: memory that should be reserved for each job
+    :Parameter hold_jobs: list with the job ids for every sample that have to
+                          finish before the sample can start
+    :return parameter: scheduler job id for every sample
+    """
+    cmd = BACKEND_HELPER.get_task_commands(param,
+                                           indices,
+                                           py_file,
+                                           '$SLURM_ARRAY_TASK_ID',
+                                           '$SLURM_CPUS_PER_TASK')
+    #aftercorr only starts a task if the task it depends on succeeded, the
+    #wrappers report failures through the sample log and sentinel files
+    cmd.append('exit 0')
+
+    slurm_dir = param['working_dir']+'results/slurm/'
+    if not os.path.exists(slurm_dir):
+        os.makedirs(slurm_dir)
+    slurm_filename = slurm_dir+param['current_flag']+'.sbatch'
+    if mem_free == 'standard':
+        memory = param['qsub_memory']
+    else:
+        memory = mem_free
+
+    handle = open(slurm_filename, 'w')
+    handle.write('#!/bin/bash\n')
+    handle.write('#SBATCH --job-name='+job_id+'\n')
+    handle.write('#SBATCH --array=0-'+str(BACKEND_HELPER.get_num_tasks(param)-1)+'\n')
+    handle.write('#SBATCH --cpus-per-task='+
+                 str(BACKEND_HELPER.get_max_cores(cores))+'\n')
+    handle.write('#SBATCH --output='+slurm_filename+'.%a.log\n')
+    handle.write('#SBATCH --chdir='+param['working_dir']+'\n')
+    if memory != '':
+        handle.write('#SBATCH --mem='+get_memory(memory)+'\n')
+    if param['qsub_RUNTIME_LIMIT'] != '':
+        handle.write('#SBATCH --time='+param['qsub_RUNTIME_LIMIT']+'\n')
+    if param['qsub_PROJECT'] != '':
+        handle.write('#SBATCH --account='+param['qsub_PROJECT']+'\n')
+    if param['qsub_email'] != '' and param['qsub_send_email']:
+        handle.write('#SBATCH --mail-type=BEGIN,END\n')
+        handle.write('#SBATCH --mail-user='+param['qsub_email']+'\n')
+    handle.write('\n')
+    handle.write('\n'.join(cmd)+'\n')
+    handle.close()
+
+    call = ['sbatch']
+    hold = BACKEND_HELPER.get_array_ids([jid for jids in hold_jobs for jid in jids])
+    if len(hold) > 0:
+        call.append('--dependency=aftercorr:'+':'.join(hold))
+        call.append('--kill-on-invalid-dep=yes')
+    call.append(slurm_filename)
+    output, error = subprocess.Popen(call,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE).communicate()
+    match = re.search(r'Submitted batch job (\d+)', output)
+    if match is None:
+        writeLog('Submitting '+param['current_flag']+' failed: '+error+'\n', param)
+        scheduler_id = ''
+    else:
+        scheduler_id = match.group(1)
+        writeLog('Submitted '+param['current_flag']+' as job '+scheduler_id+'\n', param)
+    return [scheduler_id if idx in indices else ''
+            for idx in range(param['num_samples'])]
@@ -15,11 +15,51 @@
 """Star module
 This module contains functions for initializing all tophat specific variables and
 a wrapper that that runs tophat using those parameters on a single sample.
+
+With star_shared_genome = TRUE the jobs on the same node share one copy of
+the genome in shared memory (--genomeLoad LoadAndKeep), so only the first
+job loads the index. The jobs that use the genome are registered in a file
+in a node wide directory (star_shared_dir, /dev/shm by default), which is
+locked while it is changed, and the last job that finishes removes the
+genome from memory (--genomeLoad Remove). The directory must not depend on
+the job, e.g. TMPDIR, or the jobs would not find each other. Jobs that were
+killed are dropped from the file the next time it is changed, if the last
+job that used the genome was killed the genome stays in memory until a
+later job on the node uses it and finishes. The genome also stays loaded
+between the samples of a batch (batch_size) and is released by finish_batch
+once the batch is over.
 """
 import subprocess
+import fcntl
+import hashlib
+import json
 import os
 import sys
 from hydra_pkg import module_helper as MODULE_HELPER
+from hydra_pkg import fastq_io as FASTQ_IO
+from hydra_pkg import resources as RESOURCES
+
+#parameters the results of this module depend on, see cache.py
+CACHE_PARAMETERS = ['star_exec', 'star_index', 'outFilterType',
+                    'outFilterMultimapNmax', 'alignSJoverhangMin',
+                    'alignSJDBoverhangMin', 'outFilterMismatchNmax',
+                    'outFilterMismatchNoverLmax', 'alignIntronMin',
+                    'alignIntronMax', 'alignMatesGapMax', 'outputSAMtype',
+                    'paired']
+
+#formats of the fastq files this module reads, see fastq_io.negotiate_format
+INPUT_FORMATS = ['gzip', 'zstd', 'plain']
+
+#node wide directories of the users of the shared genome, the first one that
+#exists is used if star_shared_dir is not set
+SHARED_DIRS = ['/dev/shm/', '/tmp/']
+
+#star reads the fastq files once, so they can be named pipes (see trim_align)
+STREAMING = True
+
+#set once the job used the shared genome, so a batch only releases the
+#genome if one of its samples was aligned
+GENOME_ATTACHED = False
 
 def init(param):
     """Initialization function that checks the all relevant tophat parameters
@@ -42,13 +82,125 @@ def init(param):
                                   allowed=['BAM_SortedByCoordinate',
                                            'BAM_unsorted'],
                                   dtype=str)
+    MODULE_HELPER.check_parameter(param, key='star_shared_genome', dtype=bool, optional=True)
+    MODULE_HELPER.check_parameter(param, key='star_shared_dir', dtype=str, optional=True)
+    if param['star_shared_dir'] == '':
+        param['star_shared_dir'] = [shared_dir for shared_dir in SHARED_DIRS
+                                    if os.path.isdir(shared_dir)][0]
+    if not param['star_shared_dir'].endswith('/'):
+        param['star_shared_dir'] += '/'
 
-def main():
-    """Main function that is run on each samples, which in turn calls runs
-    star on a sample.
+def get_shared_dir(param):
+    """Node wide directory with the lock and the users of the shared genome,
+    which is the same for all jobs of a user that use the same index
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
     """
+    index_hash = hashlib.sha1(os.path.abspath(param['star_index'])).hexdigest()[:12]
+    shared_dir = (param['star_shared_dir']+'hydra_star_'+str(os.getuid())+'_'+
+                  index_hash+'/')
+    if not os.path.exists(shared_dir):
+        try:
+            os.makedirs(shared_dir)
+        except OSError:
+            #another job on the node created it at the same time
+            pass
+    return shared_dir
 
-    param = MODULE_HELPER.initialize_module()
+def is_running(pid):
+    """Checks if a process is still running on this node
+
+    :Parameter pid: process id
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def change_users(shared_dir, pid, add):
+    """Adds or removes a job from the users of the shared genome, the file
+    has to be locked by the caller
+
+    :Parameter shared_dir: directory from get_shared_dir
+    :Parameter pid: process id of the job
+    :Parameter add: True to add the job, False to remove it
+    :return parameter: process ids of the jobs that still use the genome
+    """
+    users_file = shared_dir+'users.json'
+    users = []
+    if os.path.exists(users_file):
+        handle = open(users_file)
+        users = json.load(handle)
+        handle.close()
+    users = [user for user in users if user != pid and is_running(user)]
+    if add:
+        users.append(pid)
+    handle = open(users_file+'.tmp', 'w')
+    json.dump(users, handle)
+    handle.close()
+    os.rename(users_file+'.tmp', users_file)
+    return users
+
+def attach_genome(param):
+    """Registers the job as a user of the shared genome
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    global GENOME_ATTACHED
+    GENOME_ATTACHED = True
+    shared_dir = get_shared_dir(param)
+    lock = open(shared_dir+'lock', 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    users = change_users(shared_dir, os.getpid(), True)
+    fcntl.flock(lock, fcntl.LOCK_UN)
+    lock.close()
+    param['file_handle'].write('Shared genome is used by '+str(len(users))+
+                               ' jobs on this node\n')
+
+def release_genome(param):
+    """Removes the job from the users of the shared genome and removes the
+    genome from memory if no other job on this node uses it and the job does
+    not run a batch, which releases it in finish_batch. The lock is
+    kept until the genome is removed, so no job attaches to it meanwhile.
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    shared_dir = get_shared_dir(param)
+    lock = open(shared_dir+'lock', 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    users = change_users(shared_dir, os.getpid(), False)
+    #the next sample of a batch uses the genome again
+    if len(users) == 0 and not param['in_batch']:
+        call = [param['star_exec'],
+                '--genomeDir', param['star_index'],
+                '--genomeLoad', 'Remove',
+                '--outFileNamePrefix', shared_dir]
+        param['file_handle'].write('CALL: '+' '.join(call)+'\n')
+        output, error = subprocess.Popen(call,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE).communicate()
+        param['file_handle'].write(error)
+        param['file_handle'].write(output)
+    fcntl.flock(lock, fcntl.LOCK_UN)
+    lock.close()
+
+def finish_batch(param):
+    """Releases the shared genome after the last sample of a batch, also if
+    that sample was skipped or failed before it was aligned (see batch.py)
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    if param['star_shared_genome'] and GENOME_ATTACHED:
+        release_genome(param)
+
+def align(param):
+    """Runs star on the working files of a sample, the job stops if star
+    fails
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :return parameter: alignment file
+    """
     #run create output directory
     outdir = param['module_dir']+param['outstub']+'/'
     if not os.path.exists(outdir):
@@ -62,7 +214,7 @@ def main():
     call.append(param['star_index'])
 
     #add the number of processors to use
-    call.append('runThreadN')
+    call.append('--runThreadN')
     call.append(param['num_processors'])
 
     #add all the optional parameters
@@ -100,11 +252,25 @@ def main():
     call.append('--outFileNamePrefix')
     call.append(outdir)
 
-    #specify whether the fastq files are zipped
-    if param['zipped_fastq']:
+    #keep the genome in shared memory, sorting then needs an explicit limit
+    if param['star_shared_genome']:
+        call.append('--genomeLoad')
+        call.append('LoadAndKeep')
+        if param['outputSAMtype'] == 'BAM_SortedByCoordinate':
+            mem_free = param.get('mem_free', param['qsub_memory'])
+            call.append('--limitBAMsortRAM')
+            call.append(str(int(RESOURCES.parse_memory(mem_free)*
+                                RESOURCES.SORT_MEMORY_FRACTION)*1024*1024))
+
+    #specify whether the fastq files are compressed, which is found by their
+    #magic number since trimmed files can be written in any format (see
+    #fastq_io), STAR runs the command on every file at the same time
+    if FASTQ_IO.get_codec(param['working_file']) != 'plain':
+        num_files = 2 if param['paired'] else 1
         call.append('--readFilesCommand')
-        call.append('gunzip')
-        call.append('-c')
+        call += FASTQ_IO.get_decompress_command(param['working_file'],
+                                                FASTQ_IO.get_threads(param['num_processors'],
+                                                                     num_files))
 
     #adding the files we want to work on
     call.append('--readFilesIn')
@@ -114,10 +280,16 @@ def main():
     if param['paired']:
         call.append(param['working_file2'])
 
+    if param['star_shared_genome']:
+        attach_genome(param)
     param['file_handle'].write('CALL: '+' '.join(call)+'\n')
-    output, error = subprocess.Popen(call,
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE).communicate()
+    try:
+        output, error = subprocess.Popen(call,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE).communicate()
+    finally:
+        if param['star_shared_genome']:
+            release_genome(param)
     param['file_handle'].write(error)
     param['file_handle'].write(output)
 
@@ -125,11 +297,20 @@ def main():
     if not os.path.exists(outdir+'SJ.out.tab'):
         param['file_handle'].write('Star did not run successfully...')
         sys.exit(0)
+    if param['outputSAMtype'] == 'BAM_SortedByCoordinate':
+        MODULE_HELPER.index_bam(param, outdir+outfile)
+    return outdir+outfile
 
+def main():
+    """Main function that is run on each samples, which in turn calls runs
+    star on a sample.
+    """
+    param = MODULE_HELPER.initialize_module()
+    alignment_file = align(param)
 
     #wrap up and return the current workingfile
     MODULE_HELPER.wrapup_module(param,
-                                [outdir+outfile],
+                                [alignment_file],
                                 remove_intermediate=True)
 
 
@@ -0,0 +1,226 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""State module
+Keeps the state of a pipeline run in a SQLite database (results/state.db),
+with one entry for every sample and step holding the status, the output
+files, timestamps, the exit code and the cache key, and one entry for every step that
+finished on all samples. Resume decisions and output lookups are queries on
+this database, the log files are only written for the user.
+
+Only the pipeline itself writes to the database. The jobs report back
+through their sentinel files, which are imported once a step is done, so
+the database is never accessed from several nodes at the same time.
+"""
+import os
+import sqlite3
+import time
+from hydra_pkg import sentinel as SENTINEL
+
+SCHEMA = ['CREATE TABLE IF NOT EXISTS jobs (sample TEXT, step TEXT, '+
+          'status TEXT, outputs TEXT, started REAL, ended REAL, '+
+          'exit_code INTEGER, cache_key TEXT, PRIMARY KEY (sample, step))',
+          'CREATE TABLE IF NOT EXISTS steps (step TEXT PRIMARY KEY, '+
+          'status TEXT, ended REAL)']
+
+def get_database(param):
+    """Filename of the state database
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    return param['working_dir']+'results/state.db'
+
+def connect(param):
+    """Opens the state database
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    return sqlite3.connect(get_database(param), timeout=60)
+
+def init(param):
+    """Creates the state database. Results of runs that were made before the
+    database existed are imported from the log files once.
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    new_database = not os.path.exists(get_database(param))
+    connection = connect(param)
+    for statement in SCHEMA:
+        connection.execute(statement)
+    connection.commit()
+    connection.close()
+    if new_database and not param['clean_run']:
+        import_logs(param)
+
+def import_logs(param):
+    """Imports the ending flags of the sample logs and the finished steps of
+    the main log of an older run
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    connection = connect(param)
+    for stub in param['stub']:
+        log_file = param['working_dir']+'results/log/'+stub+'.log'
+        if not os.path.exists(log_file):
+            continue
+        handle = open(log_file)
+        for line in handle:
+            if line.startswith('ENDING ') and '|' in line:
+                step = line.split('|')[0][len('ENDING '):].strip()
+                connection.execute('INSERT OR REPLACE INTO jobs VALUES (?,?,?,?,?,?,?,?)',
+                                   (stub, step, 'done', line.split('|')[1].strip(),
+                                    None, None, 0, None))
+        handle.close()
+    if os.path.exists(param['log_handle']):
+        handle = open(param['log_handle'])
+        for line in handle:
+            if line.rstrip().endswith(' successful!'):
+                connection.execute('INSERT OR REPLACE INTO steps VALUES (?,?,?)',
+                                   (line.rstrip()[:-len(' successful!')], 'done', None))
+        handle.close()
+    connection.commit()
+    connection.close()
+
+def set_jobs(param, step, jobs):
+    """Stores the state of several samples in a step
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter step: flag of the step
+    :Parameter jobs: list of (sample, status, outputs, started, ended, exit_code,
+                     cache_key)
+    """
+    connection = connect(param)
+    connection.executemany('INSERT OR REPLACE INTO jobs VALUES (?,?,?,?,?,?,?,?)',
+                           [(job[0], step)+tuple(job[1:]) for job in jobs])
+    connection.commit()
+    connection.close()
+
+def set_submitted(param, step, samples, cache_keys):
+    """Marks samples as submitted in a step
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter step: flag of the step
+    :Parameter samples: names of the samples
+    :Parameter cache_keys: cache keys of the samples
+    """
+    set_jobs(param, step, [(samples[idx], 'submitted', '', time.time(), None, None,
+                            cache_keys[idx])
+                           for idx in range(len(samples))])
+
+def get_jobs(param, step):
+    """State of all samples in a step
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter step: flag of the step
+    :return parameter: dictionary with (status, outputs, cache_key) for every
+                       sample that has an entry, the cache key is None for
+                       results of older versions
+    """
+    connection = connect(param)
+    rows = connection.execute('SELECT sample, status, outputs, cache_key '+
+                              'FROM jobs WHERE step = ?', (step,)).fetchall()
+    connection.close()
+    return dict([(str(row[0]), (str(row[1]), str(row[2]), row[3])) for row in rows])
+
+def get_finished_outputs(param, step):
+    """Output files of all samples that finished a step
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter step: flag of the step
+    :return parameter: dictionary with the ';' separated output files of
+                       every finished sample
+    """
+    jobs = get_jobs(param, step)
+    return dict([(sample, jobs[sample][1]) for sample in jobs
+                 if jobs[sample][0] == 'done'])
+
+def import_sentinels(param, scheduler_ids):
+    """Stores the results the jobs of the current step wrote into their
+    sentinel files. Jobs without a sentinel file are stored as failed.
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter scheduler_ids: job id for every sample, empty if not submitted
+    """
+    jobs = []
+    for idx in range(len(scheduler_ids)):
+        if scheduler_ids[idx] == '':
+            continue
+        sentinel = SENTINEL.read_sentinel(param, idx)
+        if sentinel is None:
+            jobs.append(('failed', '', None, time.time(), None, param['stub'][idx]))
+        else:
+            jobs.append((sentinel['status'],
+                         sentinel['outputs'],
+                         sentinel['ended'] - sentinel['wall_time'],
+                         sentinel['ended'],
+                         int(sentinel['status'] != 'done'),
+                         param['stub'][idx]))
+    #the entries were created on submission and keep their cache key
+    connection = connect(param)
+    connection.executemany('UPDATE jobs SET status = ?, outputs = ?, started = ?, '+
+                           'ended = ?, exit_code = ? WHERE sample = ? AND step = ?',
+                           [job+(param['current_flag'],) for job in jobs])
+    connection.commit()
+    connection.close()
+
+def get_failed_samples(param):
+    """Samples that did not finish one of the steps they were submitted to
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    connection = connect(param)
+    rows = connection.execute('SELECT DISTINCT sample FROM jobs '+
+                              'WHERE status != ?', ('done',)).fetchall()
+    connection.close()
+    return [str(row[0]) for row in rows]
+
+def remove_samples(param, samples):
+    """Removes all entries of samples, so they are run from scratch
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter samples: names of the samples
+    """
+    if len(samples) == 0:
+        return
+    connection = connect(param)
+    connection.executemany('DELETE FROM jobs WHERE sample = ?',
+                           [(sample,) for sample in samples])
+    #the steps have to run again on these samples
+    connection.execute('DELETE FROM steps')
+    connection.commit()
+    connection.close()
+
+def set_step_finished(param, step):
+    """Marks a step as finished on all samples
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter step: flag of the step
+    """
+    connection = connect(param)
+    connection.execute('INSERT OR REPLACE INTO steps VALUES (?,?,?)',
+                       (step, 'done', time.time()))
+    connection.commit()
+    connection.close()
+
+def is_step_finished(param, step):
+    """Checks if a step finished on all samples
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter step: flag of the step
+    """
+    connection = connect(param)
+    row = connection.execute('SELECT status FROM steps WHERE step = ?',
+                             (step,)).fetchone()
+    connection.close()
+    return row is not None and row[0] == 'done'
@@ -19,6 +19,18 @@ a wrapper that that runs tophat using those parameters on a single sample.
 
 from hydra_pkg import module_helper as MODULE_HELPER
 
+#parameters the results of this module depend on, see cache.py
+CACHE_PARAMETERS = ['tophat_exec', 'tophat_index', 'tophat_qual', 'tophat_N',
+                    'tophat_gap_length', 'tophat_edit_dist', 'mate_inner_dist',
+                    'mate_std_dev', 'paired']
+
+#formats of the fastq files this module reads, see fastq_io.negotiate_format
+#tophat does not read zstd files
+INPUT_FORMATS = ['gzip', 'plain']
+
+#tophat reads the fastq files more than once, so they cannot be named pipes
+STREAMING = False
+
 def init(param):
     """Initialization function that checks the all relevant tophat parameters
 
@@ -33,14 +45,16 @@ def init(param):
     MODULE_HELPER.check_parameter(param, key='mate_inner_dist', dtype=str)
     MODULE_HELPER.check_parameter(param, key='mate_std_dev', dtype=str)
 
-def main():
-    """Main function that is run on each samples, which in turn calls runs
-    tophat on a sample.
+def align(param):
+    """Runs tophat on the working files of a sample, the job stops if tophat
+    fails
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :return parameter: bam file
     """
     import subprocess
     import sys
     import os
-    param = MODULE_HELPER.initialize_module()
     #run create output directory
     outdir = param['module_dir']+param['outstub']+'/'
     if not os.path.exists(outdir):
@@ -106,10 +120,19 @@ def main():
         log.close()
         if len(lines_end) == 0:
             sys.exit(0)
+    MODULE_HELPER.index_bam(param, outdir+'accepted_hits.bam')
+    return outdir+'accepted_hits.bam'
+
+def main():
+    """Main function that is run on each samples, which in turn calls runs
+    tophat on a sample.
+    """
+    param = MODULE_HELPER.initialize_module()
+    bam_file = align(param)
 
     #wrap up and return the current workingfile
     MODULE_HELPER.wrapup_module(param, 
-                                [outdir+'accepted_hits.bam'],
+                                [bam_file],
                                 remove_intermediate=True)
 
 
@@ -0,0 +1,167 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Trim align module
+Trims and aligns a sample in a single job (stream_trimmed_fastq = TRUE),
+so the trimmed fastq files are never written to the shared disk and there
+is no fastqc run on them. The built-in trimmer (see trimmer.py) writes the
+trimmed reads into named pipes in the directory of this step, which the
+aligner reads while they are trimmed. Tophat reads its fastq files more
+than once, its trimmed files are written into a temporary directory on the
+node (TMPDIR) instead and removed after the alignment.
+
+The step only finishes if both the trimmer and the aligner finished, a
+sample that failed in either of them is run again from the start. With
+fused_qc_trimming = TRUE the fastqc results of the raw files are computed
+while trimming, as in qc_trim.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import traceback
+from hydra_pkg import module_helper as MODULE_HELPER
+from hydra_pkg import fastq_io as FASTQ_IO
+from hydra_pkg import fastq_stats as FASTQ_STATS
+from hydra_pkg import trimmer as TRIMMER
+from hydra_pkg import qc_trim as QC_TRIM
+from hydra_pkg import tophat as TOPHAT
+from hydra_pkg import star as STAR
+from hydra_pkg import bowtie2 as BOWTIE2
+
+#parameters the results of this module depend on, see cache.py, the
+#parameters of the aligner are added by the pipeline
+CACHE_PARAMETERS = ['cutadapt_first_adapter', 'cutadapt_second_adapter',
+                    'cutadapt_m', 'cutadapt_q_end', 'cutadapt_q_start',
+                    'cutadapt_u', 'paired', 'aligner', 'fused_qc_trimming']
+
+#modules of the aligners
+ALIGNERS = {'tophat':TOPHAT,
+            'star':STAR,
+            'bowtie2':BOWTIE2}
+
+def run_trimmer(input_files, output_files, summary_file, param, result):
+    """Trims the files, which is run in a thread while the aligner reads
+    the output
+
+    :Parameter input_files: fastq files of the sample
+    :Parameter output_files: named pipes or files the trimmed reads are written to
+    :Parameter summary_file: file with the cutadapt like summary
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    :Parameter result: dictionary the statistics or the error are stored in
+    """
+    try:
+        result['stats'] = TRIMMER.trim_files(input_files,
+                                             output_files,
+                                             summary_file,
+                                             TRIMMER.get_options(param),
+                                             int(param['num_processors']),
+                                             qc=param['fused_qc_trimming'])
+    except (IOError, OSError, ValueError) as error:
+        result['error'] = str(error)
+    except:
+        result['error'] = traceback.format_exc()
+    if 'stats' not in result:
+        #the aligner waits for the named pipes that were never opened,
+        #stop_trimmer releases them if the aligner stopped as well
+        FASTQ_IO.end_fifos([filename for filename in output_files
+                            if FASTQ_IO.is_fifo(filename)])
+
+def stop_trimmer(trimming, fifos):
+    """Waits for the trimmer, if the aligner stopped before reading all
+    reads the trimmer stops with a broken pipe
+
+    :Parameter trimming: thread of the trimmer
+    :Parameter fifos: named pipes the trimmer writes to
+    """
+    trimming.join(1)
+    while trimming.is_alive():
+        FASTQ_IO.release_fifos(fifos)
+        trimming.join(1)
+
+def main():
+    """Main function that is run on each samples, which trims the fastq files
+    and aligns the trimmed reads in the same job
+    """
+    param = MODULE_HELPER.initialize_module()
+    aligner = ALIGNERS[param['aligner']]
+
+    input_files = [param['working_file']]
+    if param['paired']:
+        input_files.append(param['working_file2'])
+    trim_dir = param['working_dir']+'results/cutadapt/'
+    if not os.path.exists(trim_dir):
+        os.makedirs(trim_dir)
+    summary_file = trim_dir+param['outstub']+'.clipped.txt'
+    tmp_dir = ''
+    fifos = []
+    if aligner.STREAMING:
+        fifo_dir = param['module_dir']+param['outstub']+'/'
+        if not os.path.exists(fifo_dir):
+            os.makedirs(fifo_dir)
+        fifos = FASTQ_IO.make_fifos(fifo_dir, len(input_files))
+        output_files = fifos
+    else:
+        tmp_dir = tempfile.mkdtemp(prefix='hydra_'+param['outstub']+'_')
+        output_files = [tmp_dir+'/reads_'+str(idx+1)+FASTQ_IO.EXTENSIONS['plain']
+                        for idx in range(len(input_files))]
+
+    param['file_handle'].write('Trimming '+' '.join(input_files)+' into '+
+                               ' '.join(output_files)+'\n')
+    result = dict()
+    trimming = threading.Thread(target=run_trimmer,
+                                args=(input_files, output_files, summary_file,
+                                      param, result))
+    trimming.daemon = True
+    trimming.start()
+    if not aligner.STREAMING:
+        trimming.join()
+
+    #the aligner reads the trimmed reads and writes its results where the
+    #aligner step writes them, an earlier run cannot be resumed since its
+    #trimmed reads are gone
+    param['working_file'] = output_files[0]
+    if param['paired']:
+        param['working_file2'] = output_files[1]
+    param['module_dir'] = param['working_dir']+'results/'+param['aligner']+'/'
+    param['resume_module'] = False
+    alignment_file = ''
+    try:
+        if 'stats' in result or aligner.STREAMING:
+            alignment_file = aligner.align(param)
+    finally:
+        stop_trimmer(trimming, fifos)
+        for fifo in fifos:
+            os.remove(fifo)
+        if tmp_dir != '':
+            shutil.rmtree(tmp_dir)
+        if 'stats' not in result:
+            param['file_handle'].write('ERROR: '+result.get('error', 'the trimmer failed')+
+                                       '\n')
+
+    #an aligner that got only part of the reads might still have finished
+    if 'stats' not in result:
+        for filename in [alignment_file, alignment_file+'.bai']:
+            if alignment_file != '' and os.path.exists(filename):
+                os.remove(filename)
+        sys.exit(0)
+    with open(summary_file) as filehandle:
+        param['file_handle'].write(filehandle.read())
+    if param['fused_qc_trimming']:
+        for idx in range(len(input_files)):
+            FASTQ_STATS.write_fastqc(result['stats']['raw_qc'][idx],
+                                     input_files[idx].split('/')[-1],
+                                     QC_TRIM.get_fastqc_dir(param, input_files[idx]))
+    MODULE_HELPER.wrapup_module(param, [alignment_file])
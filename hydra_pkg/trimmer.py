@@ -0,0 +1,409 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""Trimmer module
+Built-in adapter and quality trimming (cutadapt_trimmer = builtin) that
+follows the cutadapt call of the cutadapt module, in the same order as
+cutadapt:
+
+1. -u: the first (or with a negative value the last) bases of the first
+   mate are removed
+2. -q start,end: both ends are quality trimmed with the algorithm of BWA
+3. -a/-A: the 3' adapter and everything after it is removed. The adapter may
+   be found anywhere in the read or partially at its end, with at least
+   MIN_OVERLAP bases and at most ERROR_RATE mismatches per base of the
+   overlap. Unlike cutadapt, insertions and deletions are not allowed.
+4. -m: reads (or pairs with one mate) shorter than the minimum are removed
+
+The mates are read in lockstep in chunks, which are trimmed by a pool of
+worker processes. For gzipped output every worker compresses its chunk into
+BGZF blocks (see fastq_io) with their own checksums, and the blocks are
+written in order, so the output does not need a separate integrity check
+and the next step can decompress it in parallel. zstd output is compressed
+by the writer, plain output is not compressed (see fastq_io.FORMATS). At
+most MAX_PENDING_CHUNKS chunks per worker are read ahead. The output files
+are written under a temporary name and renamed once they are complete,
+named pipes are written directly (see trim_align). The summary is written
+in the format of cutadapt.
+The workers can also collect the QC statistics of the reads before and
+after trimming (see fastq_stats and qc_trim).
+"""
+import collections
+import multiprocessing
+import numpy as np
+from hydra_pkg import fastq_io as FASTQ_IO
+from hydra_pkg import fastq_stats as FASTQ_STATS
+
+#cutadapt defaults that the cutadapt call does not change
+ERROR_RATE = 0.1
+MIN_OVERLAP = 3
+#the cutadapt call does not pass cutadapt_quality either
+QUALITY_BASE = 33
+
+#number of reads that are trimmed by a worker at once
+CHUNK_SIZE = 20000
+
+#chunks per worker that are read before their output is written
+MAX_PENDING_CHUNKS = 2
+
+def read_chunks(handles, filenames, chunk_size=CHUNK_SIZE):
+    """Chunks of reads of one or two files in lockstep
+
+    :Parameter handles: file handles
+    :Parameter filenames: names of the files, for error messages
+    :Parameter chunk_size: number of reads per chunk
+    :return parameter: lists with the reads of every file, a read is a tuple
+                       of the title, sequence and quality line
+    """
+    while True:
+        chunks = []
+        for handle in handles:
+            chunk = []
+            for _ in xrange(chunk_size):
+                title = handle.readline()
+                if title == '':
+                    break
+                sequence = handle.readline().rstrip('\r\n')
+                handle.readline()
+                quality = handle.readline().rstrip('\r\n')
+                chunk.append((title, sequence, quality))
+            chunks.append(chunk)
+        if any([len(chunk) != len(chunks[0]) for chunk in chunks]):
+            raise ValueError(filenames[1]+' does not have as many reads as '+filenames[0])
+        if len(chunks[0]) == 0:
+            return
+        yield chunks
+
+def quality_trim_index(quality, cutoff_front, cutoff_back):
+    """Start and end of the part of a read that is kept by the quality
+    trimming, as in cutadapt (and BWA)
+
+    :Parameter quality: quality string
+    :Parameter cutoff_front: quality cutoff of the 5' end
+    :Parameter cutoff_back: quality cutoff of the 3' end
+    """
+    start = 0
+    stop = len(quality)
+    score = 0
+    max_score = 0
+    for idx in xrange(stop):
+        score += cutoff_front-(ord(quality[idx])-QUALITY_BASE)
+        if score < 0:
+            break
+        if score > max_score:
+            max_score = score
+            start = idx+1
+    score = 0
+    max_score = 0
+    for idx in reversed(xrange(stop)):
+        score += cutoff_back-(ord(quality[idx])-QUALITY_BASE)
+        if score < 0:
+            break
+        if score > max_score:
+            max_score = score
+            stop = idx
+    if start >= stop:
+        return 0, 0
+    return start, stop
+
+def find_adapters(sequences, adapter):
+    """Position of the 3' adapter in every read. All reads are compared to
+    the adapter at the same position at once, the alignment with the most
+    matching bases wins, and the leftmost one if there is a tie.
+
+    :Parameter sequences: sequences of the reads
+    :Parameter adapter: adapter sequence, N matches every base
+    :return parameter: numpy array with the position where the adapter starts,
+                       the length of the read if it has no adapter
+    """
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    cuts = lengths.copy()
+    if len(sequences) == 0 or adapter == '' or lengths.max() < MIN_OVERLAP:
+        return cuts
+    max_length = int(lengths.max())
+    adapter_length = len(adapter)
+
+    #reads padded with zeros, which never match a base of the adapter
+    bases = np.zeros((len(sequences), max_length+adapter_length), dtype=np.uint8)
+    bases[:, :max_length] = np.frombuffer(''.join([sequence.ljust(max_length, '\0')
+                                                   for sequence in sequences]),
+                                          dtype=np.uint8).reshape(len(sequences),
+                                                                  max_length)
+    codes = np.frombuffer(adapter.upper(), dtype=np.uint8)
+    wildcards = codes == ord('N')
+    rows = np.arange(len(sequences))
+    best = np.zeros(len(sequences), dtype=np.int64)
+    for pos in xrange(max_length-MIN_OVERLAP+1):
+        overlap = np.clip(lengths-pos, 0, adapter_length)
+        matches = np.cumsum((bases[:, pos:pos+adapter_length] == codes) | wildcards,
+                            axis=1, dtype=np.int16)
+        score = matches[rows, np.maximum(overlap-1, 0)]
+        found = ((overlap >= MIN_OVERLAP) &
+                 (overlap-score <= (overlap*ERROR_RATE).astype(np.int64)) &
+                 (score > best))
+        best[found] = score[found]
+        cuts[found] = pos
+    return cuts
+
+def trim_reads(reads, adapter, cut, cutoff_front, cutoff_back, stats, mate):
+    """Trims the reads of one file
+
+    :Parameter reads: list of (title, sequence, quality)
+    :Parameter adapter: 3' adapter
+    :Parameter cut: number of bases that are removed at the start (or end if
+                    negative) before anything else
+    :Parameter cutoff_front: quality cutoff of the 5' end
+    :Parameter cutoff_back: quality cutoff of the 3' end
+    :Parameter stats: dictionary with the statistics, which are updated
+    :Parameter mate: name of the mate in the statistics, e.g. read1
+    :return parameter: list of trimmed (title, sequence, quality)
+    """
+    trimmed = []
+    for title, sequence, quality in reads:
+        stats[mate+'_bp'] += len(sequence)
+        if cut > 0:
+            sequence, quality = sequence[cut:], quality[cut:]
+        elif cut < 0:
+            sequence, quality = sequence[:cut], quality[:cut]
+        start, stop = quality_trim_index(quality, cutoff_front, cutoff_back)
+        stats[mate+'_quality_trimmed'] += len(sequence)-(stop-start)
+        trimmed.append((title, sequence[start:stop], quality[start:stop]))
+
+    cuts = find_adapters([sequence for _, sequence, _ in trimmed], adapter)
+    for idx in xrange(len(trimmed)):
+        title, sequence, quality = trimmed[idx]
+        if cuts[idx] < len(sequence):
+            stats[mate+'_with_adapter'] += 1
+            trimmed[idx] = (title, sequence[:cuts[idx]], quality[:cuts[idx]])
+    return trimmed
+
+def trim_chunk(job):
+    """Trims a chunk of reads of all files, which is run by the workers
+
+    :Parameter job: tuple of the chunks of all files, the options and the
+                    number of the first read of the chunk
+    :return parameter: tuple of the output of every file, the
+                       statistics of the chunk and with options['qc'] the
+                       QC statistics of every file before and after trimming
+                       (see fastq_stats), None otherwise
+    """
+    chunks, options, first_read = job
+    stats = dict([(key, 0) for key in get_stat_keys(len(chunks))])
+    qc_stats = None
+    if options.get('qc', False):
+        qc_stats = {'raw': [FASTQ_STATS.get_stats([read[1] for read in chunk],
+                                                  [read[2] for read in chunk],
+                                                  first_read)
+                            for chunk in chunks],
+                    'trimmed': []}
+    trimmed = []
+    for idx in range(len(chunks)):
+        trimmed.append(trim_reads(chunks[idx],
+                                  options['adapters'][idx],
+                                  options['cut'] if idx == 0 else 0,
+                                  options['cutoff_front'],
+                                  options['cutoff_back'],
+                                  stats,
+                                  'read'+str(idx+1)))
+    stats['reads'] = len(chunks[0])
+
+    #a pair is removed if one of the mates is too short
+    keep = [all([len(mate[idx][1]) >= options['min_length'] for mate in trimmed])
+            for idx in xrange(len(chunks[0]))]
+    stats['too_short'] = len(keep)-sum(keep)
+    stats['written'] = sum(keep)
+    output = []
+    for idx in range(len(trimmed)):
+        lines = []
+        for pos in xrange(len(keep)):
+            if keep[pos]:
+                title, sequence, quality = trimmed[idx][pos]
+                lines.append(title+sequence+'\n+\n'+quality+'\n')
+                stats['read'+str(idx+1)+'_written_bp'] += len(sequence)
+        if options['format'] == 'gzip':
+            output.append(FASTQ_IO.compress_bgzf(''.join(lines), options['level']))
+        else:
+            output.append(''.join(lines))
+        if qc_stats is not None:
+            kept = [trimmed[idx][pos] for pos in xrange(len(keep)) if keep[pos]]
+            qc_stats['trimmed'].append(FASTQ_STATS.get_stats([read[1] for read in kept],
+                                                             [read[2] for read in kept],
+                                                             first_read))
+    return output, stats, qc_stats
+
+def get_stat_keys(num_files):
+    """Names of the statistics of one or two files
+
+    :Parameter num_files: number of files
+    """
+    keys = ['reads', 'too_short', 'written']
+    for idx in range(num_files):
+        mate = 'read'+str(idx+1)
+        keys += [mate+'_bp', mate+'_quality_trimmed', mate+'_with_adapter',
+                 mate+'_written_bp']
+    return keys
+
+def write_summary(filename, stats, num_files):
+    """Writes the statistics in the format of the cutadapt summary
+
+    :Parameter filename: output file
+    :Parameter stats: statistics of all chunks
+    :Parameter num_files: number of files
+    """
+    def line(label, value, total=None, unit=''):
+        """A line of the summary with an optional percentage"""
+        text = label.ljust(36)+'{:,}'.format(value)+unit
+        if total is not None:
+            text += ' ({:.1%})'.format(float(value)/total if total > 0 else 0.0)
+        return text+'\n'
+
+    unit = 'reads' if num_files == 1 else 'read pairs'
+    reads = 'Reads' if num_files == 1 else 'Pairs'
+    mates = ['read'+str(idx+1) for idx in range(num_files)]
+    total_bp = sum([stats[mate+'_bp'] for mate in mates])
+    handle = open(filename, 'w')
+    handle.write('This is the built-in trimmer of Hydra, which follows cutadapt.\n\n')
+    handle.write('=== Summary ===\n\n')
+    handle.write(line('Total '+unit+' processed:', stats['reads']))
+    if num_files == 1:
+        handle.write(line('Reads with adapters:', stats['read1_with_adapter'], stats['reads']))
+    else:
+        for idx in range(num_files):
+            handle.write(line('  Read '+str(idx+1)+' with adapter:',
+                              stats[mates[idx]+'_with_adapter'], stats['reads']))
+    handle.write(line(reads+' that were too short:', stats['too_short'], stats['reads']))
+    handle.write(line(reads+' written (passing filters):', stats['written'], stats['reads']))
+    handle.write('\n')
+    for label, key in [('Total basepairs processed:', '_bp'),
+                       ('Quality-trimmed:', '_quality_trimmed'),
+                       ('Total written (filtered):', '_written_bp')]:
+        value = sum([stats[mate+key] for mate in mates])
+        handle.write(line(label, value, None if key == '_bp' else total_bp, ' bp'))
+        if num_files > 1:
+            for idx in range(num_files):
+                handle.write(line('  Read '+str(idx+1)+':', stats[mates[idx]+key],
+                                  unit=' bp'))
+    handle.close()
+
+def get_options(param):
+    """Trimming options from the cutadapt parameters
+
+    :Parameter param: dictionary that contains all general RNASeq pipeline parameters
+    """
+    options = dict()
+    options['adapters'] = [param['cutadapt_first_adapter']]
+    if param['paired']:
+        options['adapters'].append(param['cutadapt_second_adapter'])
+    options['cut'] = int(param['cutadapt_u'])
+    options['cutoff_front'] = int(param['cutadapt_q_start'])
+    options['cutoff_back'] = int(param['cutadapt_q_end'])
+    options['min_length'] = int(param['cutadapt_m'])
+    options['level'] = param['intermediate_compression_level']
+    return options
+
+def get_jobs(handles, filenames, options):
+    """Jobs of the workers, see trim_chunk
+
+    :Parameter handles: handles of the input files
+    :Parameter filenames: names of the input files
+    :Parameter options: trimming options
+    """
+    first_read = 0
+    for chunks in read_chunks(handles, filenames):
+        yield chunks, options, first_read
+        first_read += len(chunks[0])
+
+def add_chunk(result, outputs, stats, raw_qc, trimmed_qc):
+    """Writes the output of a chunk and adds up its statistics
+
+    :Parameter result: result of trim_chunk
+    :Parameter outputs: output file handles
+    :Parameter stats: statistics of the files
+    :Parameter raw_qc: QC statistics of the input files
+    :Parameter trimmed_qc: QC statistics of the output files
+    """
+    output, chunk_stats, qc_stats = result
+    for idx in range(len(outputs)):
+        if outputs[idx].format == 'gzip':
+            outputs[idx].write_blocks(output[idx])
+        else:
+            outputs[idx].write(output[idx])
+    for key in chunk_stats:
+        stats[key] += chunk_stats[key]
+    if qc_stats is not None:
+        for idx in range(len(outputs)):
+            raw_qc[idx] = FASTQ_STATS.add_stats(raw_qc[idx], qc_stats['raw'][idx])
+            trimmed_qc[idx] = FASTQ_STATS.add_stats(trimmed_qc[idx], qc_stats['trimmed'][idx])
+
+def trim_files(input_files, output_files, summary_file, options, num_processes=1,
+               qc=False):
+    """Trims one or two (paired) fastq files
+
+    :Parameter input_files: fastq files of the first and second mates
+    :Parameter output_files: output files, their extension sets the format,
+                             or named pipes
+    :Parameter summary_file: file with the cutadapt like summary
+    :Parameter options: trimming options, see get_options
+    :Parameter num_processes: number of worker processes
+    :Parameter qc: also collect the QC statistics of every file before and
+                   after trimming, which are added to the statistics as
+                   raw_qc and trimmed_qc
+    :return parameter: statistics
+    """
+    #the writers are opened first, so a reader of the named pipes gets their
+    #end even if the input files cannot be opened
+    num_processes = max(1, num_processes)
+    threads = FASTQ_IO.get_threads(num_processes, len(input_files))
+    outputs = [FASTQ_IO.get_writer(filename, threads, options['level'])
+               for filename in output_files]
+    stats = dict([(key, 0) for key in get_stat_keys(len(input_files))])
+    raw_qc = [FASTQ_STATS.new_stats() for _ in input_files]
+    trimmed_qc = [FASTQ_STATS.new_stats() for _ in input_files]
+    options = dict(options, qc=qc, format=outputs[0].format, level=outputs[0].level)
+    pending = collections.deque()
+    pool = None
+    inputs = []
+    try:
+        #the workers inherit the open named pipes, they are joined before
+        #the writers are closed
+        pool = multiprocessing.Pool(num_processes)
+        for filename in input_files:
+            inputs.append(FASTQ_IO.Reader(filename, threads))
+        for job in get_jobs(inputs, input_files, options):
+            pending.append(pool.apply_async(trim_chunk, (job,)))
+            #the chunks are written in order as soon as they are done
+            while (len(pending) >= num_processes*MAX_PENDING_CHUNKS or
+                   (len(pending) > 0 and pending[0].ready())):
+                add_chunk(pending.popleft().get(), outputs, stats, raw_qc, trimmed_qc)
+        while len(pending) > 0:
+            add_chunk(pending.popleft().get(), outputs, stats, raw_qc, trimmed_qc)
+    except:
+        if pool is not None:
+            pool.terminate()
+        for writer in outputs:
+            writer.close(abort=True)
+        for reader in inputs:
+            reader.close(abort=True)
+        raise
+    pool.close()
+    pool.join()
+    for reader in inputs:
+        reader.close()
+    for writer in outputs:
+        writer.close()
+    write_summary(summary_file, stats, len(input_files))
+    if qc:
+        stats['raw_qc'] = raw_qc
+        stats['trimmed_qc'] = trimmed_qc
+    return stats
@@ -0,0 +1,245 @@
+#Copyright 2015 Daniel Gusenleitner, Stefano Monti
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+"""
+Benchmark of the bamqc statistics on a synthetic bam file. Compares the
+batched engine of run_bamqc.py to the earlier read by read implementation,
+checks that both produce the same output.txt and reports the runtimes.
+
+Usage: python2.7 benchmark_bamqc.py -n 1000000 -o tmp_dir
+-h help
+-n number of reads in the synthetic bam file	*[default 1000000]
+-o directory for the bam file and the outputs	*[default ./]
+-s random seed					*[default 0]
+"""
+import os
+import random
+import time
+import pysam
+import run_bamqc
+
+#CIGAR strings of the synthetic reads: plain, spliced, insert, deletion
+CIGARS = [[(0, 50)],
+          [(0, 20), (3, 500), (0, 30)],
+          [(0, 25), (1, 2), (0, 23)],
+          [(0, 20), (2, 3), (0, 30)],
+          [(4, 5), (0, 20), (3, 200), (0, 20), (2, 1), (0, 5)]]
+
+
+def write_bam(filename, num_reads, seed):
+    rand = random.Random(seed)
+    header = {'HD': {'VN': '1.0', 'SO': 'unsorted'},
+              'SQ': [{'LN': 10000000, 'SN': 'chr'+str(i+1)} for i in range(3)]}
+    bam_file = pysam.Samfile(filename, 'wb', header=header)
+    for idx in range(num_reads):
+        read = pysam.AlignedRead()
+        read.qname = 'read'+str(idx)
+        read.seq = 'A'*50
+        read.qual = 'I'*50
+        flag = rand.choice([0, 16, 0x1 | 0x2 | 0x40, 0x1 | 0x40, 0x1 | 0x2 | 0x80])
+        if rand.random() < 0.02:
+            #unmapped reads have no CIGAR and no tags
+            read.flag = flag | 0x4
+            read.tid = -1
+            read.pos = -1
+        else:
+            read.flag = flag
+            read.tid = rand.randint(0, 2)
+            read.pos = rand.randint(0, 9000000)
+            read.mapq = 50
+            read.cigar = rand.choice(CIGARS)
+            num_hits = 1 if rand.random() < 0.8 else rand.randint(2, 30)
+            tags = [('NH', num_hits), ('NM', rand.randint(0, 6))]
+            #some aligners leave out tags, which keeps the value of the read before
+            if rand.random() < 0.01:
+                tags = tags[1:]
+            read.tags = tags
+        bam_file.write(read)
+    bam_file.close()
+
+
+def extract_stats_per_read(input_file):
+    #read by read implementation of run_bamqc.py before the batched engine
+    #open bam file
+    bam_file = pysam.Samfile(input_file, "rb")
+    #counters
+    total_aligned_reads = 0
+    unique_aligned_reads = 0
+    is_singleton = 0
+    is_paired = 0
+    is_proper_pair = 0
+    is_unmapped = 0
+    num_unique_mismatches = [0]*5
+    num_multiple_mismatches = [0.0]*5
+    num_multiread = [0.0]*20
+    delet = False
+    insert = False
+    spliced = False
+    reads_with_deletions = 0
+    spliced_reads = 0
+    reads_with_inserts = 0
+    non_spliced_reads = 0
+    unique_reads_with_deletions = 0
+    unique_spliced_reads = 0
+    unique_reads_with_inserts = 0
+    unique_non_spliced_reads = 0
+
+    #tag variables
+    NH = 0
+    NM = 0
+    XS = 0
+    idx = 0
+    for read in bam_file:
+        if read.cigarstring != None:
+            #get all the relevant tags
+            for tag in read.tags:
+                if tag[0] == 'NH':
+                    NH = tag[1]
+                if tag[0] == 'NM':
+                    NM = tag[1]
+            
+            if NH == 0:
+                NH = 1
+
+            #number of aligned reads
+            total_aligned_reads += 1
+            unique_aligned_reads += 1/NH
+
+            #number of mismatches
+            if NH == 1:
+                if NM >= 4:
+                    num_unique_mismatches[4] = num_unique_mismatches[4]+1
+                else:
+                    num_unique_mismatches[NM] = num_unique_mismatches[NM]+1
+            else:
+                if NM >= 4:
+                    num_multiple_mismatches[4] = num_multiple_mismatches[4]+(1.0/float(NH))
+                else:
+                    num_multiple_mismatches[NM] = num_multiple_mismatches[NM]+(1.0/float(NH))
+
+            #number of multiple reads
+            if NH >= 20:
+                num_multiread[19] = num_multiread[19]+(1.0/float(NH))
+            else:
+                num_multiread[NH-1] = num_multiread[NH-1]+(1.0/float(NH))
+
+            #singletons, paired, proper paired, unmapped
+            is_singleton += int(not read.is_paired)
+            is_paired += int(read.is_paired)
+            is_proper_pair += int(read.is_proper_pair)
+            is_unmapped += int(read.is_unmapped)
+
+            #splicing, deletions, inserts
+            spliced = 'N' in read.cigarstring
+            insert = 'I' in read.cigarstring
+            delet = 'D' in read.cigarstring
+
+            #actual count
+            spliced_reads += int(spliced)
+            spliced_reads += int(spliced)
+            non_spliced_reads += int(not spliced)
+            reads_with_deletions += int(insert)
+            reads_with_inserts += int(delet)
+
+            #counting reads that are aligned multiple times only once
+            unique_spliced_reads += int(spliced)/NH
+            unique_non_spliced_reads += int(not spliced)/NH
+            unique_reads_with_deletions += int(insert)/NH
+            unique_reads_with_inserts += int(delet)/NH
+        if idx % 1000000 == 0:
+            print str(idx)+' reads done'
+        idx += 1
+    bam_file.close()
+
+    statistics = dict()
+    statistics['total_aligned_reads'] = total_aligned_reads
+    statistics['unique_aligned_reads'] = unique_aligned_reads
+    statistics['is_singleton'] = is_singleton
+    statistics['is_paired'] = is_paired
+    statistics['is_proper_pair'] = is_proper_pair
+    statistics['is_unmapped'] = is_unmapped
+    statistics['num_unique_mismatches'] = num_unique_mismatches
+    statistics['num_multiple_mismatches'] = num_multiple_mismatches
+    statistics['num_multiread'] = num_multiread
+    statistics['spliced_reads'] = spliced_reads
+    statistics['non_spliced_reads'] = non_spliced_reads
+    statistics['reads_with_inserts'] = reads_with_inserts
+    statistics['reads_with_deletions'] = reads_with_deletions
+    statistics['unique_spliced_reads'] = unique_spliced_reads
+    statistics['unique_non_spliced_reads'] = unique_non_spliced_reads
+    statistics['unique_reads_with_inserts'] = unique_reads_with_inserts
+    statistics['unique_reads_with_deletions'] = unique_reads_with_deletions
+    return statistics
+
+
+def compare_outputs(output_dir1, output_dir2):
+    differences = []
+    lines1 = open(output_dir1+'output.txt').read().splitlines()
+    lines2 = open(output_dir2+'output.txt').read().splitlines()
+    for line1, line2 in zip(lines1, lines2):
+        key, val1 = line1.split('\t')
+        val2 = line2.split('\t')[1]
+        #weighted counts may differ in the last digits, since they are
+        #added up in a different order
+        if abs(float(val1)-float(val2)) > 1e-6*max(1.0, abs(float(val1))):
+            differences.append(key.strip()+': '+val1+' != '+val2)
+    if len(lines1) != len(lines2):
+        differences.append('different number of lines')
+    return differences
+
+
+def benchmark(input_file, output_dir):
+    runtimes = dict()
+    for name, function in [('per_read', extract_stats_per_read),
+                           ('batched', run_bamqc.extract_stats)]:
+        directory = output_dir+name+'/'
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        start = time.time()
+        stats = function(input_file)
+        runtimes[name] = time.time()-start
+        run_bamqc.output_stats(stats, directory)
+    return runtimes
+
+
+if __name__ == "__main__":
+    import sys
+    import getopt
+
+    num_reads = 1000000
+    output_directory = './'
+    random_seed = 0
+    optlist, cmdlist = getopt.getopt(sys.argv[1:], 'hn:o:s:')
+    for opt in optlist:
+        if opt[0] == '-h':
+            print __doc__; sys.exit(0)
+        if opt[0] == '-n':
+            num_reads = int(opt[1])
+        if opt[0] == '-o':
+            output_directory = opt[1].rstrip('/')+'/'
+        if opt[0] == '-s':
+            random_seed = int(opt[1])
+
+    bam_filename = output_directory+'synthetic.bam'
+    print 'Writing '+str(num_reads)+' reads to '+bam_filename
+    write_bam(bam_filename, num_reads, random_seed)
+    times = benchmark(bam_filename, output_directory)
+    print 'read by read: %.1f s' %(times['per_read'])
+    print 'batched:      %.1f s (%.1fx)' %(times['batched'],
+                                          times['per_read']/max(times['batched'], 1e-9))
+    diffs = compare_outputs(output_directory+'per_read/', output_directory+'batched/')
+    if len(diffs) > 0:
+        print 'Outputs differ:\n'+'\n'.join(diffs)
+        sys.exit(1)
+    print 'Outputs are identical'
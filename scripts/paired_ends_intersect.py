@@ -13,61 +13,258 @@
 #See the License for the specific language governing permissions and
 #limitations under the License.
 
+"""
+Usage: python2.7 paired_ends_intersect.py forward.fq.gz reverse.fq.gz
+                                          paired_forward.fq.gz paired_reverse.fq.gz
+                                          [compression_level]
+
+Writes the reads whose mate is in the other file, so both output files hold
+the same pairs in the same order. The read names are compared without a
+trailing /1 or /2. The fastq files have 4 lines per read, inputs can be
+gzipped, zstd compressed or plain, outputs are gzipped if their names end
+with .gz and zstd compressed if they end with .zst.
+
+Both files are read in lockstep, which works as long as the reads are in
+the same order in both files, even if reads were removed from one of them
+(e.g. by trimming). Reads that were seen in one file but not yet in the
+other are kept until their mate shows up, all reads before a matched pair
+have no mate and the names of the last MAX_DROPPED of them are kept. If the
+mate of such a read shows up later, or more than MAX_PENDING reads are
+waiting, the files are not in the same order, and the reads are split by
+name into PARTITIONS temporary files next to the output, which are matched
+one at a time.
+
+The files are read and written with hydra_pkg.fastq_io, which uses up to
+fastq_io.MAX_THREADS threads per file. Gzipped outputs are BGZF files.
+"""
+import collections
+import multiprocessing
+import os
 import sys
-import gzip
-import re
-
-from Bio.SeqIO.QualityIO import FastqGeneralIterator #Biopython 1.51 or later
-
-##########################################################
-#
-# Change the following settings to suit your needs
-## Read paired-end fastq filenames from commandline arguments provided
-#NOTE : THESE FILENAMES INCLUDE THE FULL PATH TO THE FILES
-INPUT_FORWARD_FILENAME = sys.argv[1]
-INPUT_REVERSE_FILENAME = sys.argv[2]
-OUTPUT_PAIRED_FORWARD_FILENAME = sys.argv[3]
-OUTPUT_PAIRED_REVERSE_FILENAME = sys.argv[4]
-
-def f_name(title):
-    return re.sub('/.$', '',title.split()[0])
-
-def r_name(title):
-    return re.sub('/.$', '',title.split()[0])
-
-print "Scanning reverse file to build list of names..."
-reverse_ids = set()
-paired_ids = set()
-for title, seq, qual in FastqGeneralIterator(gzip.open(INPUT_REVERSE_FILENAME, 'rb')):
-    reverse_ids.add(r_name(title))
-
-print "Processing forward file..."
-forward_handle = gzip.open(OUTPUT_PAIRED_FORWARD_FILENAME, "wb")
-#orphan_handle = gzip.open(output_orphan_filename, "wb")
-for title, seq, qual in FastqGeneralIterator(gzip.open(INPUT_FORWARD_FILENAME, 'rb')):
-    nam = f_name(title)
-    if nam in reverse_ids:
-        #Paired
-        paired_ids.add(nam)
-        reverse_ids.remove(nam) #frees a little memory
-        forward_handle.write("@%s\n%s\n+\n%s\n" % (title, seq, qual))
-    else:
-        #Orphan
-
-        continue
-forward_handle.close()
-del reverse_ids #frees memory, although we won't need more now
-
-print "Processing reverse file..."
-reverse_handle = gzip.open(OUTPUT_PAIRED_REVERSE_FILENAME, "wb")
-for title, seq, qual in FastqGeneralIterator(gzip.open(INPUT_REVERSE_FILENAME, 'rb')):
-    nam = r_name(title)
-    if nam in paired_ids:
-        #Paired
-        reverse_handle.write("@%s\n%s\n+\n%s\n" % (title, seq, qual))
+import zlib
+from hydra_pkg import fastq_io as FASTQ_IO
+
+#reads that wait for their mate before the files are considered unordered
+MAX_PENDING = 1000000
+
+#names of the last reads without a mate that are kept, files that are not
+#in the same order are noticed as soon as the mate of one of them shows up,
+#the number of reads without a mate in ordered files is not limited
+MAX_DROPPED = 1000000
+
+#number of temporary files per input file if the files are not ordered
+PARTITIONS = 64
+
+#buffer size of the temporary files
+BUFFER_SIZE = 4*1024*1024
+
+#compression level of the output, if none is given
+COMPRESSION_LEVEL = 4
+
+#(de)compression threads per file
+THREADS = FASTQ_IO.get_threads(multiprocessing.cpu_count(), 2)
+
+class UnorderedError(Exception):
+    """The reads of the two files are not in the same order"""
+    pass
+
+def read_fastq(handle):
+    """Reads of a fastq file as tuples of the name and the 4 lines
+
+    :Parameter handle: file handle
+    """
+    while True:
+        title = handle.readline()
+        if title == '':
+            return
+        record = title+handle.readline()+handle.readline()+handle.readline()
+        yield get_name(title), record
+
+def get_name(title):
+    """Name of a read without the @ and a trailing /1 or /2
+
+    :Parameter title: first line of the read
+    """
+    name = title[1:].split(None, 1)[0]
+    if len(name) > 1 and name[-2] == '/':
+        return name[:-2]
+    return name
+
+def drop_read(dropped, name):
+    """Keeps the name of a read without a mate, the oldest name is
+    forgotten if there are more than MAX_DROPPED
+
+    :Parameter dropped: names of the reads without a mate
+    :Parameter name: name of the read
+    """
+    dropped[name] = None
+    if len(dropped) > MAX_DROPPED:
+        dropped.popitem(last=False)
+
+def add_read(read, pending, other_pending, dropped, other_dropped,
+             forward_out, reverse_out, is_forward):
+    """Adds a read of one file, if its mate was already read the pair is
+    written and the reads before it in both files are dropped
+
+    :Parameter read: tuple of the name and the lines of the read
+    :Parameter pending: reads of the same file that wait for their mate
+    :Parameter other_pending: reads of the other file that wait for their mate
+    :Parameter dropped: last names of the reads of the same file without a mate
+    :Parameter other_dropped: last names of the reads of the other file without a mate
+    :Parameter forward_out: output handle of the forward reads
+    :Parameter reverse_out: output handle of the reverse reads
+    :Parameter is_forward: the read is from the forward file
+    :return parameter: 1 if a pair was written, 0 otherwise
+    """
+    name, record = read
+    #the mate was dropped, so the files are not in the same order
+    if name in other_dropped:
+        raise UnorderedError()
+    if name not in other_pending:
+        if name not in pending:
+            pending[name] = record
+            if len(pending) > MAX_PENDING:
+                raise UnorderedError()
+        return 0
+    #the reads before the mate have no mate in this file
+    while True:
+        other_name, other_record = other_pending.popitem(last=False)
+        if other_name == name:
+            break
+        drop_read(other_dropped, other_name)
+    for pending_name in pending.iterkeys():
+        drop_read(dropped, pending_name)
+    pending.clear()
+    if is_forward:
+        forward_out.write(record)
+        reverse_out.write(other_record)
     else:
-        #Orphan
-        continue
+        forward_out.write(other_record)
+        reverse_out.write(record)
+    return 1
+
+def match_ordered(forward_file, reverse_file, forward_out, reverse_out):
+    """Matches the reads of two files that are in the same order
+
+    :Parameter forward_file: fastq file of the first mates
+    :Parameter reverse_file: fastq file of the second mates
+    :Parameter forward_out: output handle of the forward reads
+    :Parameter reverse_out: output handle of the reverse reads
+    :return parameter: number of pairs
+    """
+    forward_handle = FASTQ_IO.Reader(forward_file, THREADS)
+    reverse_handle = FASTQ_IO.Reader(reverse_file, THREADS)
+    forward_pending = collections.OrderedDict()
+    reverse_pending = collections.OrderedDict()
+    forward_dropped = collections.OrderedDict()
+    reverse_dropped = collections.OrderedDict()
+    forward_reads = read_fastq(forward_handle)
+    reverse_reads = read_fastq(reverse_handle)
+    pairs = 0
+    aborted = True
+    try:
+        while True:
+            forward_read = next(forward_reads, None)
+            reverse_read = next(reverse_reads, None)
+            if forward_read is None and reverse_read is None:
+                break
+            if forward_read is not None:
+                pairs += add_read(forward_read, forward_pending, reverse_pending,
+                                  forward_dropped, reverse_dropped,
+                                  forward_out, reverse_out, True)
+            if reverse_read is not None:
+                pairs += add_read(reverse_read, reverse_pending, forward_pending,
+                                  reverse_dropped, forward_dropped,
+                                  forward_out, reverse_out, False)
+        aborted = False
+    finally:
+        forward_handle.close(aborted)
+        reverse_handle.close(aborted)
+    return pairs
+
+def split_reads(filename, prefix):
+    """Splits the reads of a file into PARTITIONS files by their name
+
+    :Parameter filename: fastq file
+    :Parameter prefix: prefix of the temporary files
+    :return parameter: names of the temporary files
+    """
+    partition_files = [prefix+str(idx)+'.fq' for idx in range(PARTITIONS)]
+    handles = [open(partition_file, 'wb', BUFFER_SIZE/PARTITIONS)
+               for partition_file in partition_files]
+    handle = FASTQ_IO.Reader(filename, THREADS)
+    for name, record in read_fastq(handle):
+        handles[(zlib.crc32(name) & 0xffffffff) % PARTITIONS].write(record)
+    handle.close()
+    for partition_handle in handles:
+        partition_handle.close()
+    return partition_files
+
+def match_partitioned(forward_file, reverse_file, forward_out, reverse_out, tmp_prefix):
+    """Matches the reads of two files in any order, the mates of a pair end
+    up in the same partition, which is small enough to be matched in memory
+
+    :Parameter forward_file: fastq file of the first mates
+    :Parameter reverse_file: fastq file of the second mates
+    :Parameter forward_out: output handle of the forward reads
+    :Parameter reverse_out: output handle of the reverse reads
+    :Parameter tmp_prefix: prefix of the temporary files
+    :return parameter: number of pairs
+    """
+    forward_partitions = split_reads(forward_file, tmp_prefix+'forward_')
+    reverse_partitions = split_reads(reverse_file, tmp_prefix+'reverse_')
+    pairs = 0
+    for idx in range(PARTITIONS):
+        reverse_reads = dict()
+        handle = open(reverse_partitions[idx], 'rb', BUFFER_SIZE)
+        for name, record in read_fastq(handle):
+            reverse_reads.setdefault(name, record)
+        handle.close()
+        handle = open(forward_partitions[idx], 'rb', BUFFER_SIZE)
+        for name, record in read_fastq(handle):
+            if name in reverse_reads:
+                forward_out.write(record)
+                reverse_out.write(reverse_reads.pop(name))
+                pairs += 1
+        handle.close()
+        os.remove(forward_partitions[idx])
+        os.remove(reverse_partitions[idx])
+    return pairs
+
+def match_pairs(forward_file, reverse_file, forward_output, reverse_output,
+                level=COMPRESSION_LEVEL):
+    """Writes the reads that have a mate in the other file
+
+    :Parameter forward_file: fastq file of the first mates
+    :Parameter reverse_file: fastq file of the second mates
+    :Parameter forward_output: output file of the first mates
+    :Parameter reverse_output: output file of the second mates
+    :Parameter level: compression level of the output
+    :return parameter: number of pairs
+    """
+    print "Matching the reads of both files in lockstep..."
+    forward_out = FASTQ_IO.Writer(forward_output, THREADS, level)
+    reverse_out = FASTQ_IO.Writer(reverse_output, THREADS, level)
+    try:
+        pairs = match_ordered(forward_file, reverse_file, forward_out, reverse_out)
+    except UnorderedError:
+        print "The files are not in the same order, matching the reads by partitions..."
+        forward_out.close(abort=True)
+        reverse_out.close(abort=True)
+        forward_out = FASTQ_IO.Writer(forward_output, THREADS, level)
+        reverse_out = FASTQ_IO.Writer(reverse_output, THREADS, level)
+        pairs = match_partitioned(forward_file, reverse_file, forward_out, reverse_out,
+                                  forward_output+'.tmp_')
+    forward_out.close()
+    reverse_out.close()
+    return pairs
+
 
-reverse_handle.close()
-print "Done"
+if __name__ == "__main__":
+    if len(sys.argv) < 5:
+        print __doc__
+        sys.exit(0)
+    LEVEL = int(sys.argv[5]) if len(sys.argv) > 5 else COMPRESSION_LEVEL
+    NUM_PAIRS = match_pairs(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], LEVEL)
+    print "Pairs: "+str(NUM_PAIRS)
+    print "Done"
@@ -13,127 +13,269 @@
 #limitations under the License.
 
 """
-Usage: python2.7 bam_qc.py -i input_file.bam -o outdir
+Usage: python2.7 bam_qc.py -i input_file.bam -o outdir -n 4
 -h help
 -o output_dir
 -i input_file.bam				*[No default value]
+-n number of processes			*[default 1]
+-g annotation.gtf, also count the reads per gene while the bam file is read
+-x annotation index directory, which is used instead of reading the gtf file
+-c count_file					*[default output_dir/counts.txt]
+-s stranded: yes, no or reverse		*[default no]
+-t feature type				*[default exon]
+-a id attribute				*[default gene_id]
+-m mode: union, intersection-strict or intersection-nonempty
+						*[default union]
+
+Coordinate sorted bam files with an index (.bai) are split into regions
+that are processed in parallel. Bam files without an index or that are not
+sorted are read as a single stream, as are all files that are also counted
+(-g/-x), so the mates of a pair are seen by the same counter. The counts are
+written in the htseq-count format.
 
 """
+import json
+import math
+import multiprocessing
+import os
+import numpy as np
+import pysam
 
 
-def extract_stats(input_file):
+#number of aligned reads whose tags and flags are collected before their
+#statistics are added up with numpy
+BATCH_SIZE = 1000000
+
+#number of regions per process, so processes that finish early can pick up
+#more work
+REGIONS_PER_PROCESS = 4
+
+#SAM flags
+FLAG_PAIRED = 0x1
+FLAG_PROPER_PAIR = 0x2
+FLAG_UNMAPPED = 0x4
+
+
+def init_stats():
+    statistics = dict()
+    for key in ['total_aligned_reads', 'unique_aligned_reads', 'is_singleton',
+                'is_paired', 'is_proper_pair', 'is_unmapped', 'spliced_reads',
+                'non_spliced_reads', 'reads_with_inserts', 'reads_with_deletions',
+                'unique_spliced_reads', 'unique_non_spliced_reads',
+                'unique_reads_with_inserts', 'unique_reads_with_deletions']:
+        statistics[key] = 0
+    statistics['num_unique_mismatches'] = np.zeros(5, dtype=np.int64)
+    statistics['num_multiple_mismatches'] = np.zeros(5)
+    statistics['num_multiread'] = np.zeros(20)
+    return statistics
+
+
+def add_batch(statistics, batch):
+    #one array per column of the batch
+    num_hits = np.array(batch['NH'], dtype=np.int64)
+    mismatches = np.minimum(np.array(batch['NM'], dtype=np.int64), 4)
+    flags = np.array(batch['flag'], dtype=np.int64)
+    spliced = np.array(batch['skips'], dtype=np.int64) > 0
+    insert = np.array(batch['inserts'], dtype=np.int64) > 0
+    delet = np.array(batch['deletions'], dtype=np.int64) > 0
+    unique = num_hits == 1
+    weights = 1.0/num_hits
+
+    #number of aligned reads, reads with several alignments are counted once
+    statistics['total_aligned_reads'] += len(num_hits)
+    statistics['unique_aligned_reads'] += int(unique.sum())
+
+    #number of mismatches and multiple reads
+    statistics['num_unique_mismatches'] += np.bincount(mismatches[unique],
+                                                       minlength=5)
+    statistics['num_multiple_mismatches'] += np.bincount(mismatches[~unique],
+                                                         weights=weights[~unique],
+                                                         minlength=5)
+    statistics['num_multiread'] += np.bincount(np.minimum(num_hits, 20)-1,
+                                               weights=weights,
+                                               minlength=20)
+
+    #singletons, paired, proper paired, unmapped
+    paired = (flags & FLAG_PAIRED) > 0
+    statistics['is_singleton'] += int((~paired).sum())
+    statistics['is_paired'] += int(paired.sum())
+    statistics['is_proper_pair'] += int(((flags & FLAG_PROPER_PAIR) > 0).sum())
+    statistics['is_unmapped'] += int(((flags & FLAG_UNMAPPED) > 0).sum())
+
+    #splicing, deletions, inserts; spliced reads are counted twice and
+    #inserts and deletions are swapped like in the earlier versions, so the
+    #numbers stay comparable to the reports of older runs
+    statistics['spliced_reads'] += 2*int(spliced.sum())
+    statistics['non_spliced_reads'] += int((~spliced).sum())
+    statistics['reads_with_deletions'] += int(insert.sum())
+    statistics['reads_with_inserts'] += int(delet.sum())
+    statistics['unique_spliced_reads'] += int((spliced & unique).sum())
+    statistics['unique_non_spliced_reads'] += int((~spliced & unique).sum())
+    statistics['unique_reads_with_deletions'] += int((insert & unique).sum())
+    statistics['unique_reads_with_inserts'] += int((delet & unique).sum())
+
+
+def new_batch():
+    return dict([(key, []) for key in ['NH', 'NM', 'flag', 'skips',
+                                       'inserts', 'deletions']])
+
+
+def get_reads(bam_file, regions):
+    if regions is None:
+        for read in bam_file:
+            yield read
+        return
+    for reference, start, end in regions:
+        for read in bam_file.fetch(reference, start, end):
+            #reads that overlap the start of the region belong to the region
+            #before
+            if read.pos >= start:
+                yield read
+
+
+def extract_stats(input_file, batch_size=BATCH_SIZE, regions=None, counter=None,
+                  tags=None):
     #open bam file
     bam_file = pysam.Samfile(input_file, "rb")
-    #counters
-    total_aligned_reads = 0
-    unique_aligned_reads = 0
-    is_singleton = 0
-    is_paired = 0
-    is_proper_pair = 0
-    is_unmapped = 0
-    num_unique_mismatches = [0]*5
-    num_multiple_mismatches = [0.0]*5
-    num_multiread = [0.0]*20
-    delet = False
-    insert = False
-    spliced = False
-    reads_with_deletions = 0
-    spliced_reads = 0
-    reads_with_inserts = 0
-    non_spliced_reads = 0
-    unique_reads_with_deletions = 0
-    unique_spliced_reads = 0
-    unique_reads_with_inserts = 0
-    unique_non_spliced_reads = 0
-
-    #tag variables
-    NH = 0
-    NM = 0
-    XS = 0
+    statistics = init_stats()
+    batch = new_batch()
+    #reads without NH or NM tag keep the values of the read before, the
+    #values before the first read of a region are passed in tags, which
+    #returns the last values and the tags that were taken from before
+    if tags is None:
+        tags = dict()
+    values = {'NH':tags.get('NH', 1), 'NM':tags.get('NM', 0)}
+    found = {'NH':False, 'NM':False}
+    tags['carried'] = []
     idx = 0
-    for read in bam_file:
-        if read.cigarstring != None:
-            #get all the relevant tags
-            for tag in read.tags:
-                if tag[0] == 'NH':
-                    NH = tag[1]
-                if tag[0] == 'NM':
-                    NM = tag[1]
-            
-            if NH == 0:
-                NH = 1
-
-            #number of aligned reads
-            total_aligned_reads += 1
-            unique_aligned_reads += 1/NH
-
-            #number of mismatches
-            if NH == 1:
-                if NM >= 4:
-                    num_unique_mismatches[4] = num_unique_mismatches[4]+1
-                else:
-                    num_unique_mismatches[NM] = num_unique_mismatches[NM]+1
-            else:
-                if NM >= 4:
-                    num_multiple_mismatches[4] = num_multiple_mismatches[4]+(1.0/float(NH))
-                else:
-                    num_multiple_mismatches[NM] = num_multiple_mismatches[NM]+(1.0/float(NH))
-
-            #number of multiple reads
-            if NH >= 20:
-                num_multiread[19] = num_multiread[19]+(1.0/float(NH))
-            else:
-                num_multiread[NH-1] = num_multiread[NH-1]+(1.0/float(NH))
-
-            #singletons, paired, proper paired, unmapped
-            is_singleton += int(not read.is_paired)
-            is_paired += int(read.is_paired)
-            is_proper_pair += int(read.is_proper_pair)
-            is_unmapped += int(read.is_unmapped)
-
-            #splicing, deletions, inserts
-            spliced = 'N' in read.cigarstring
-            insert = 'I' in read.cigarstring
-            delet = 'D' in read.cigarstring
-
-            #actual count
-            spliced_reads += int(spliced)
-            spliced_reads += int(spliced)
-            non_spliced_reads += int(not spliced)
-            reads_with_deletions += int(insert)
-            reads_with_inserts += int(delet)
-
-            #counting reads that are aligned multiple times only once
-            unique_spliced_reads += int(spliced)/NH
-            unique_non_spliced_reads += int(not spliced)/NH
-            unique_reads_with_deletions += int(insert)/NH
-            unique_reads_with_inserts += int(delet)/NH
-        if idx % 1000000 == 0:
-            print str(idx)+' reads done'
+    for read in get_reads(bam_file, regions):
         idx += 1
+        #gene counts of the same pass over the file
+        if counter is not None:
+            GENE_COUNTS.add_read(counter, read)
+        #only reads with a CIGAR string are counted
+        cigar = read.cigar
+        if not cigar:
+            continue
+        for key in ['NH', 'NM']:
+            try:
+                values[key] = read.opt(key)
+                found[key] = True
+            except KeyError:
+                pass
+        if values['NH'] == 0:
+            values['NH'] = 1
+        operations = set([operation for operation, _ in cigar])
+        for key in ['NH', 'NM']:
+            if not found[key] and key not in tags['carried']:
+                tags['carried'].append(key)
+        batch['NH'].append(values['NH'])
+        batch['NM'].append(values['NM'])
+        batch['flag'].append(read.flag)
+        #CIGAR operations 3 (N), 1 (I) and 2 (D)
+        batch['skips'].append(3 in operations)
+        batch['inserts'].append(1 in operations)
+        batch['deletions'].append(2 in operations)
+        if len(batch['NH']) == batch_size:
+            add_batch(statistics, batch)
+            batch = new_batch()
+            print str(idx)+' reads done'
+    if len(batch['NH']) > 0:
+        add_batch(statistics, batch)
     bam_file.close()
+    for key in ['NH', 'NM']:
+        tags['last_'+key] = values[key] if found[key] else None
+
+    #plain python numbers, so output.txt and stats.json look as before
+    statistics['num_unique_mismatches'] = [int(val) for val in
+                                           statistics['num_unique_mismatches']]
+    statistics['num_multiple_mismatches'] = [float(val) for val in
+                                             statistics['num_multiple_mismatches']]
+    statistics['num_multiread'] = [float(val) for val in statistics['num_multiread']]
+    return statistics
 
+
+def is_sorted(input_file):
+    bam_file = pysam.Samfile(input_file, "rb")
+    sort_order = bam_file.header.get('HD', dict()).get('SO', '')
+    bam_file.close()
+    return sort_order == 'coordinate'
+
+
+def get_regions(input_file, num_processes):
+    #every task is a list of regions with about the same number of bases,
+    #small references are combined into a single task
+    bam_file = pysam.Samfile(input_file, "rb")
+    references = zip(bam_file.references, bam_file.lengths)
+    bam_file.close()
+    chunk_size = max(1, sum([length for _, length in references])/
+                     (num_processes*REGIONS_PER_PROCESS))
+    tasks = [[]]
+    task_size = 0
+    for reference, length in references:
+        for start in range(0, length, chunk_size):
+            end = min(start+chunk_size, length)
+            tasks[-1].append((reference, start, end))
+            task_size += end-start
+            if task_size >= chunk_size:
+                tasks.append([])
+                task_size = 0
+    return [task for task in tasks if len(task) > 0]
+
+
+def extract_region_stats(task):
+    input_file, regions, tags = task
+    statistics = extract_stats(input_file, regions=regions, tags=tags)
+    return statistics, tags
+
+
+def has_index(input_file):
+    return (os.path.exists(input_file+'.bai') or
+            os.path.exists(os.path.splitext(input_file)[0]+'.bai'))
+
+
+def merge_stats(stats_list):
     statistics = dict()
-    statistics['total_aligned_reads'] = total_aligned_reads
-    statistics['unique_aligned_reads'] = unique_aligned_reads
-    statistics['is_singleton'] = is_singleton
-    statistics['is_paired'] = is_paired
-    statistics['is_proper_pair'] = is_proper_pair
-    statistics['is_unmapped'] = is_unmapped
-    statistics['num_unique_mismatches'] = num_unique_mismatches
-    statistics['num_multiple_mismatches'] = num_multiple_mismatches
-    statistics['num_multiread'] = num_multiread
-    statistics['spliced_reads'] = spliced_reads
-    statistics['non_spliced_reads'] = non_spliced_reads
-    statistics['reads_with_inserts'] = reads_with_inserts
-    statistics['reads_with_deletions'] = reads_with_deletions
-    statistics['unique_spliced_reads'] = unique_spliced_reads
-    statistics['unique_non_spliced_reads'] = unique_non_spliced_reads
-    statistics['unique_reads_with_inserts'] = unique_reads_with_inserts
-    statistics['unique_reads_with_deletions'] = unique_reads_with_deletions
+    for key in stats_list[0]:
+        if isinstance(stats_list[0][key], list):
+            statistics[key] = [sum(values) for values in
+                               zip(*[stat[key] for stat in stats_list])]
+        else:
+            statistics[key] = sum([stat[key] for stat in stats_list])
     return statistics
 
 
+def extract_stats_parallel(input_file, num_processes):
+    if num_processes <= 1 or not is_sorted(input_file) or not has_index(input_file):
+        return extract_stats(input_file)
+    #the regions start with the tag values of the first read of the file
+    tasks = [(input_file, regions, {'NH':1, 'NM':0})
+             for regions in get_regions(input_file, num_processes)]
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        results = pool.map(extract_region_stats, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    #a region whose first reads have no NH or NM tag is run again if the
+    #read before the region had other values, so the statistics are the same
+    #as for a single stream
+    before = {'NH':1, 'NM':0}
+    stats_list = []
+    for idx in range(len(results)):
+        statistics, tags = results[idx]
+        if any([tags[key] != before[key] for key in tags['carried']]):
+            statistics, tags = extract_region_stats((input_file, tasks[idx][1],
+                                                     dict(before)))
+        for key in ['NH', 'NM']:
+            if tags['last_'+key] is not None:
+                before[key] = tags['last_'+key]
+        stats_list.append(statistics)
+    #unplaced reads are not part of any region, but they are unmapped and
+    #not counted anyway
+    return merge_stats(stats_list)
+
+
 def output_stats(stat, output_dir):
     #write all stats into a file
     handle = open(output_dir+'output.txt', 'w')
@@ -343,22 +485,26 @@ def make_report(stat, output_dir):
 
 if __name__ == "__main__":
 ## Import modules
-    import pysam
     import sys
     import getopt
-    import json
-    import numpy as np
     import matplotlib
     matplotlib.use('Agg')
     import matplotlib.pyplot as plt
-    import math
     import pylab
 
 ## Check arguments
     if len(sys.argv) < 5:
         print __doc__
         sys.exit(0)
-    optlist, cmdlist = getopt.getopt(sys.argv[1:], 'hi:o:')
+    num_processors = 1
+    annotation_file = ''
+    annotation_index = ''
+    count_file = ''
+    stranded = 'no'
+    feature_type = 'exon'
+    id_attribute = 'gene_id'
+    count_mode = 'union'
+    optlist, cmdlist = getopt.getopt(sys.argv[1:], 'hi:o:n:g:x:c:s:t:a:m:')
 
     for opt in optlist:
         if opt[0] == '-h':
@@ -367,9 +513,42 @@ if __name__ == "__main__":
             input_filename = opt[1]
         if opt[0] == '-o':
             output_directory = opt[1]
-
-    #extract stats from bam file
-    stats = extract_stats(input_filename)
+        if opt[0] == '-n':
+            num_processors = int(opt[1])
+        if opt[0] == '-g':
+            annotation_file = opt[1]
+        if opt[0] == '-x':
+            annotation_index = opt[1].rstrip('/')+'/'
+        if opt[0] == '-c':
+            count_file = opt[1]
+        if opt[0] == '-s':
+            stranded = opt[1]
+        if opt[0] == '-t':
+            feature_type = opt[1]
+        if opt[0] == '-a':
+            id_attribute = opt[1]
+        if opt[0] == '-m':
+            count_mode = opt[1]
+
+    #extract stats from bam file, counting the genes on the way if requested
+    if annotation_file != '' or annotation_index != '':
+        from hydra_pkg import gene_counts as GENE_COUNTS
+        if annotation_index != '':
+            gene_index = GENE_COUNTS.load_index(annotation_index)
+        else:
+            gene_index = GENE_COUNTS.build_index(annotation_file, feature_type,
+                                                 id_attribute, stranded)
+        bam_header = pysam.Samfile(input_filename, "rb")
+        gene_counter = GENE_COUNTS.init_counter(gene_index, stranded, count_mode,
+                                                bam_header.references)
+        bam_header.close()
+        stats = extract_stats(input_filename, counter=gene_counter)
+        GENE_COUNTS.finish_counter(gene_counter)
+        if count_file == '':
+            count_file = output_directory+'counts.txt'
+        GENE_COUNTS.write_counts(gene_counter, count_file)
+    else:
+        stats = extract_stats_parallel(input_filename, num_processors)
 
     #dump stats into a text file
     output_stats(stats, output_directory)